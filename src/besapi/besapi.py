@@ -9,15 +9,26 @@ Maintained by James Stewart since 2021
 Library for communicating with the BES (BigFix) REST API.
 """
 
+import array
+import collections
+import concurrent.futures
+import copy
 import datetime
+import functools
+import hashlib
+import io
+import itertools
 import json
 import logging
 import os
 import random
+import re
 import site
 import string
-
-# import urllib3.poolmanager
+import threading
+import time
+import weakref
+import zlib
 
 try:
     from urllib import parse
@@ -25,12 +36,76 @@ except ImportError:
     from urlparse import parse_qs as parse
 
 import requests
-from lxml import etree, objectify
-from pkg_resources import resource_filename
+import urllib3.poolmanager
+from lxml import etree
+
+# asyncio, sqlite3 and lxml.objectify are imported where they are used,
+# so scripts that don't need them don't pay to import them
 
-logging.basicConfig(level=logging.WARNING)
 besapi_logger = logging.getLogger("besapi")
 
+# folder the XSDs are installed in, beside this module
+SCHEMAS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schemas")
+# XSDs to validate results against, in the order they are tried
+XSD_SCHEMA_NAMES = ("BES.xsd", "BESAPI.xsd", "BESActionSettings.xsd")
+
+# compiled XSDs are built on first use and shared by all threads & results
+_xsd_schemas = None
+_xsd_schemas_lock = threading.Lock()
+
+# validation policies for `RESTResult` responses:
+# always: validate every response against the XSDs
+VALIDATION_ALWAYS = "always"
+# content-type: trust `application/xml` responses, validate everything else
+VALIDATION_CONTENT_TYPE = "content-type"
+# lazy: same as content-type, but only when the xml is first used
+VALIDATION_LAZY = "lazy"
+# sample: validate 1 in N responses, trust the rest if they parse as xml
+VALIDATION_SAMPLE = "sample"
+# never: trust any response that parses as xml, parsed only when used
+VALIDATION_NEVER = "never"
+VALIDATION_POLICIES = (
+    VALIDATION_ALWAYS,
+    VALIDATION_CONTENT_TYPE,
+    VALIDATION_LAZY,
+    VALIDATION_SAMPLE,
+    VALIDATION_NEVER,
+)
+
+# file in an export folder that tracks what an incremental export wrote
+EXPORT_MANIFEST_NAME = "besapi_export_manifest.json"
+
+# where upload(dedupe=True) remembers files already uploaded to root servers
+UPLOAD_INDEX_PATH = os.path.expanduser("~/.besapi_upload_index.json")
+
+# what the resolver cache keeps, by the first part of the paths that
+# change them, see `enable_resolver_cache`
+RESOLVER_KINDS = {
+    "computergroup": "groups",
+    "computergroups": "groups",
+    "operator": "operators",
+    "operators": "operators",
+    "site": "sites",
+    "sites": "sites",
+}
+
+# cached when a name does not resolve, so TTLCache can tell it from a miss
+NOT_FOUND = "not found"
+
+# the answer session relevance gives for a query with no results or errors
+NOTHING_RETURNED = "<Nothing> Nothing returned, but no error."
+
+# where enable_content_index keeps the index of site content by default
+CONTENT_INDEX_PATH = os.path.expanduser("~/.besapi_content_index.sqlite")
+
+# the root server ends a session after 5 minutes without a request
+SESSION_TIMEOUT = datetime.timedelta(minutes=5)
+# login again this long before the session would expire
+SESSION_REFRESH_MARGIN = datetime.timedelta(minutes=1)
+
+# lxml parsers must not be shared between threads, so keep one per thread
+_xml_parsers = threading.local()
+
 
 def rand_password(length=20):
     """get a random password"""
@@ -61,32 +136,328 @@ def sanitize_txt(*args):
     return tuple(sani_args)
 
 
+def get_xsd_schemas():
+    """get the compiled XSD schemas, compiling them once per process"""
+    global _xsd_schemas  # pylint: disable=global-statement
+
+    if _xsd_schemas is None:
+        with _xsd_schemas_lock:
+            # another thread may have compiled them while waiting on the lock
+            if _xsd_schemas is None:
+                schemas = []
+                for xsd in XSD_SCHEMA_NAMES:
+                    xmlschema_doc = etree.parse(os.path.join(SCHEMAS_DIR, xsd))
+                    try:
+                        schemas.append(etree.XMLSchema(xmlschema_doc))
+                    except etree.XMLSchemaParseError as err:
+                        # this should only error if the XSD itself is malformed
+                        besapi_logger.error("ERROR with `%s`: %s", xsd, err)
+                        raise err
+                _xsd_schemas = tuple(schemas)
+
+    return _xsd_schemas
+
+
+def get_xml_parser():
+    """get this thread's parser for objectified trees that keep whitespace
+
+    Trees built with this parser can be serialized, validated and used as
+    objectified elements, so a response only ever needs to be parsed once.
+    """
+    parser = getattr(_xml_parsers, "parser", None)
+    if parser is None:
+        from lxml import objectify  # pylint: disable=import-outside-toplevel
+
+        parser = objectify.makeparser(remove_blank_text=False)
+        _xml_parsers.parser = parser
+
+    return parser
+
+
+def local_name(tag):
+    """get a tag or attribute name without its namespace"""
+    return tag.split("}")[1] if "}" in tag else tag
+
+
+def elem_text(element):
+    """get an element's text if elem2dict converts it to just text, else None"""
+    text = element.text
+    if text and text.strip() and not element.attrib:
+        return text
+    return None
+
+
+def elem_members(element):
+    """get the (key, value) pairs of an element's dict from elem2dict
+
+    Attributes are keys prefixed with `@`. An element with text keeps it
+    in `#text` and its children are ignored, otherwise children are
+    keys by tag, in the order first seen. A value is attribute text, an
+    element, or a list of elements with the same tag.
+    """
+    members = [
+        ("@" + local_name(name), value) for name, value in element.attrib.items()
+    ]
+    text = element.text
+    if text and text.strip():
+        members.append(("#text", text))
+        return members
+
+    groups = {}
+    for child in element.iterchildren(tag=etree.Element):
+        groups.setdefault(local_name(child.tag), []).append(child)
+    members.extend(
+        (key, children[0] if len(children) == 1 else children)
+        for key, children in groups.items()
+    )
+    return members
+
+
 def elem2dict(node):
     """
     Convert an lxml.etree node tree into a dict.
     https://gist.github.com/jacobian/795571?permalink_comment_id=2981870#gistcomment-2981870
+
+    Elements with only text become the text, other elements become a
+    dict of their attributes, text and children, see `elem_members`.
+    Children with the same tag become a list. Built without recursion,
+    so any depth of tree can be converted.
     """
+    text = elem_text(node)
+    if text is not None:
+        return {"#text": text}
+
     result = {}
+    # elements whose dicts have been placed in the result but not filled
+    unfilled = [(node, result)]
+    while unfilled:
+        element, target = unfilled.pop()
+        for name, value in element.items():
+            target["@" + local_name(name)] = value
+        text = element.text
+        if text and text.strip():
+            target["#text"] = text
+            continue
+
+        for child in element.iterchildren(tag=etree.Element):
+            key = local_name(child.tag)
+            value = elem_text(child)
+            if value is None:
+                value = {}
+                unfilled.append((child, value))
+            if key not in target:
+                target[key] = value
+            elif type(target[key]) is list:
+                target[key].append(value)
+            else:
+                target[key] = [target[key], value]
+
+    return result
+
 
-    for element in node.iterchildren():
-        # Remove namespace prefix
-        key = element.tag.split("}")[1] if "}" in element.tag else element.tag
+def iter_json(node, indent=None):
+    """yield the JSON of `elem2dict(node)` in pieces, straight from the tree
 
-        # Process element as tree element if the inner XML contains non-whitespace content
-        if element.text and element.text.strip():
-            value = element.text
+    The same as `json.dumps(elem2dict(node), indent=indent)` without
+    building the dict or the whole string, so it can be written to a
+    file as it is generated.
+    """
+    encode = json.encoder.encode_basestring_ascii
+    if indent is None:
+        item_separator = ", "
+    else:
+        item_separator = ","
+        if isinstance(indent, int):
+            indent = " " * indent
+
+    text = elem_text(node)
+    members = [("#text", text)] if text is not None else elem_members(node)
+    yield "{"
+    # for each open object or list: its members or items, whether it is
+    # an object and whether anything has been written in it yet
+    stack = [[iter(members), True, False]]
+    while stack:
+        frame = stack[-1]
+        item = next(frame[0], None)
+        if item is None:
+            stack.pop()
+            if frame[2] and indent is not None:
+                yield "\n" + indent * len(stack)
+            yield "}" if frame[1] else "]"
+            continue
+
+        prefix = item_separator if frame[2] else ""
+        frame[2] = True
+        if indent is not None:
+            prefix += "\n" + indent * len(stack)
+        if frame[1]:
+            key, value = item
+            prefix += encode(key) + ": "
         else:
-            value = elem2dict(element)
-        if key in result:
+            value = item
 
-            if type(result[key]) is list:
-                result[key].append(value)
+        if type(value) is str:
+            yield prefix + encode(value)
+        elif type(value) is list:
+            yield prefix + "["
+            stack.append([iter(value), False, False])
+        else:
+            text = elem_text(value)
+            if text is not None:
+                yield prefix + encode(text)
             else:
-                tempvalue = result[key].copy()
-                result[key] = [tempvalue, value]
+                yield prefix + "{"
+                stack.append([iter(elem_members(value)), True, False])
+
+
+def relevance_answer(answer_elem, typed=False):
+    """get the value of a session relevance result Answer element
+
+    If typed, the text is converted by the Answer's `type`, see
+    RELEVANCE_TYPES. Text that does not convert is kept as is.
+    """
+    text = answer_elem.text
+    if not typed or text is None:
+        return text
+    convert = RELEVANCE_TYPES.get(answer_elem.get("type"))
+    if convert is None:
+        return text
+    try:
+        return convert(text)
+    except ValueError:
+        besapi_logger.debug(
+            "Could not convert answer to %s: %s", answer_elem.get("type"), text
+        )
+        return text
+
+
+def relevance_tuple(tuple_elem, typed=False):
+    """convert a session relevance result Tuple element to a python tuple"""
+    if not typed:
+        return tuple(
+            relevance_tuple(child) if child.tag == "Tuple" else child.text
+            for child in tuple_elem.iterchildren("Answer", "Tuple")
+        )
+    return tuple(
+        relevance_tuple(child, typed)
+        if child.tag == "Tuple"
+        else relevance_answer(child, typed)
+        for child in tuple_elem.iterchildren("Answer", "Tuple")
+    )
+
+
+def iter_relevance_answers(source, typed=False, chunk_size=64 * 1024):
+    """parse session relevance results XML incrementally from a file or stream
+
+    Yields the text of each Answer, a tuple for each Tuple, or the text
+    of an Error prefixed with `ERROR: ` like `session_relevance_array`.
+    Elements are freed once yielded, so memory use stays flat no matter
+    how many answers there are.
+
+    If typed, answers are converted by their type, see `relevance_answer`,
+    an Error raises ValueError and no results yields nothing.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as source_file:
+            yield from iter_relevance_answers(source_file, typed, chunk_size)
+        return
+
+    # only the answers in Result are handled in python, once each is
+    # complete, so the Answers in Tuples don't each cost an event
+    parser = etree.XMLPullParser(events=("start", "end"), tag=("Result", "Error"))
+    result = None
+    result_complete = False
+    found = False
+
+    def take_answers():
+        """yield the answers parsed so far, freeing each once yielded"""
+        answers = list(result.iterchildren("Answer", "Tuple"))
+        # the last answer may not be complete until the next chunk
+        if not result_complete:
+            answers = answers[:-1]
+        for answer in answers:
+            if answer.tag == "Tuple":
+                yield relevance_tuple(answer, typed)
+            else:
+                yield relevance_answer(answer, typed)
+            result.remove(answer)
+
+    while True:
+        chunk = source.read(chunk_size)
+        if chunk:
+            parser.feed(chunk)
         else:
-            result[key] = value
-    return result
+            parser.close()
+        for event, elem in parser.read_events():
+            if elem.tag == "Result":
+                result = elem
+                result_complete = event == "end"
+            elif elem.tag == "Error" and event == "end":
+                # answers before the error come first, whatever the chunk size
+                if result is not None:
+                    yield from take_answers()
+                found = True
+                besapi_logger.info("Query returned an error: %s", elem.text)
+                if typed:
+                    raise ValueError(f"Query returned an error: {elem.text}")
+                yield "ERROR: " + elem.text
+
+        if result is not None:
+            for answer in take_answers():
+                found = True
+                yield answer
+        if not chunk:
+            break
+
+    if not found:
+        besapi_logger.info("Query did not return any results")
+        if not typed:
+            yield NOTHING_RETURNED
+
+
+# relevance that aggregates plural results into one answer
+RELEVANCE_AGGREGATES = (
+    r"\s*(number|sum|maxim\w*|minim\w*|extrema|conjunction|disjunction"
+    r"|concatenation|unique values?|multiplicit\w*|sets?|(not )?exists?)\b"
+)
+
+
+def partition_relevance(relevance, partitions, partition):
+    """get the relevance for one of a number of partitions of the computers
+
+    A `{partition}` placeholder is replaced with a condition on the id of
+    `it`, e.g. `(name of it) of bes computers whose {partition}`.
+    Otherwise relevance must end with `of bes computers`, which is then
+    filtered to the partition. Aggregates like `number of ...` are not
+    partitioned automatically, as their answers would need combining.
+    """
+    condition = f"(id of it mod {partitions} = {partition})"
+    if "{partition}" in relevance:
+        return relevance.replace("{partition}", condition)
+    if re.search(
+        r"\bof\s+bes\s+computers\s*$", relevance, re.IGNORECASE
+    ) and not re.match(RELEVANCE_AGGREGATES, relevance, re.IGNORECASE):
+        return f"{relevance.rstrip()} whose {condition}"
+    raise ValueError(
+        "relevance must end with `of bes computers` or contain `{partition}`"
+    )
+
+
+def bes_type_and_title(source):
+    """get the type tag and Title of the first item in a BES xml file or stream
+
+    Stops parsing as soon as the Title is found.
+    """
+    content_type = None
+    for event, elem in etree.iterparse(source, events=("start", "end")):
+        if event == "start":
+            if content_type is None and elem.getparent() is not None:
+                # first tag in XML that is the Type
+                content_type = elem.tag
+        elif elem.tag == "Title" and elem.getparent().tag == content_type:
+            return content_type, elem.text
+
+    return content_type, None
 
 
 # https://stackoverflow.com/questions/16159969/replace-all-text-between-2-strings-python
@@ -113,57 +484,958 @@ def parse_bes_modtime(string_datetime):
     return datetime.datetime.strptime(string_datetime, "%a, %d %b %Y %H:%M:%S %z")
 
 
-# # https://docs.python-requests.org/en/latest/user/advanced/#transport-adapters
-# class HTTPAdapterBiggerBlocksize(requests.adapters.HTTPAdapter):
-#     """custom HTTPAdapter for requests to override blocksize
-#     for Uploading or Downloading large files"""
+def parse_bes_date(string_date):
+    """parse date string to object"""
+    return datetime.datetime.strptime(string_date, "%a, %d %b %Y").date()
+
+
+def parse_relevance_boolean(string_boolean):
+    """parse a session relevance boolean, `True` or `False`"""
+    if string_boolean not in ("True", "False"):
+        raise ValueError(f"not a boolean: {string_boolean}")
+    return string_boolean == "True"
+
+
+# how to convert session relevance answers by their `type` attribute,
+# answers of any other type are kept as strings
+RELEVANCE_TYPES = {
+    "integer": int,
+    "floating point": float,
+    "boolean": parse_relevance_boolean,
+    "time": parse_bes_modtime,
+    "date": parse_bes_date,
+}
+
+
+def read_export_manifest(export_folder="./"):
+    """read the incremental export manifest from a folder, keyed by resource"""
+    manifest_path = os.path.join(export_folder, EXPORT_MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return {}
+
+    with open(manifest_path, "r", encoding="utf-8") as manifest_file:
+        return json.load(manifest_file)["items"]
+
+
+def write_export_manifest(manifest, export_folder="./"):
+    """write the incremental export manifest to a folder"""
+    manifest_path = os.path.join(export_folder, EXPORT_MANIFEST_NAME)
+    if export_folder and not os.path.exists(export_folder):
+        os.makedirs(export_folder)
+
+    # write to a temp file first so an interrupted export can't corrupt it
+    with open(manifest_path + ".tmp", "w", encoding="utf-8") as manifest_file:
+        json.dump({"version": 1, "items": manifest}, manifest_file, indent=1)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def open_part_file(folder):
+    """create a new, uniquely named `.part` file in a folder to write to
+
+    Unlike tempfile.mkstemp, which makes files only the owner can read,
+    the file gets the usual permissions under the umask, and keeps them
+    when it is renamed into place.
+
+    returns the file open for binary writing, and its path
+    """
+    part_path = os.path.join(folder, f".{os.urandom(8).hex()}.part")
+    return open(part_path, "xb"), part_path
+
+
+def hash_file(file_path, blocksize=1024 * 1024):
+    """get the sha1, sha256 and size of a file, reading it only once"""
+    sha1 = hashlib.sha1()
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(file_path, "rb") as hash_source:
+        for block in iter(lambda: hash_source.read(blocksize), b""):
+            sha1.update(block)
+            sha256.update(block)
+            size += len(block)
+
+    return sha1.hexdigest(), sha256.hexdigest(), size
+
+
+def _keepalive(connection_ref, stop_event, interval):
+    """login whenever a BESConnection needs it, until stopped or the
+    connection is garbage collected"""
+    while not stop_event.wait(interval):
+        connection = connection_ref()
+        if connection is None:
+            return
+        try:
+            connection.login()
+        except requests.exceptions.RequestException as err:
+            besapi_logger.warning("Keep-alive login failed: %s", err)
+        del connection
+
+
+class RelevanceColumns:
+    """memory compact column store for typed session relevance results
+
+    Each answer is a row, nested tuples are flattened into columns.
+    Integer, floating point and boolean columns are kept in arrays of
+    machine values instead of lists of python objects. A column falls
+    back to a list if a value does not fit its array.
+    """
+
+    # array typecode for columns of each python type
+    array_typecodes = {bool: "b", int: "q", float: "d"}
+
+    def __init__(self, rows=()):
+        self.columns = None
+        # python type of the values in each array column
+        self._array_types = {}
+        self.num_rows = 0
+        for row in rows:
+            self.append(row)
+
+    def __len__(self):
+        return self.num_rows
+
+    def __iter__(self):
+        return self.rows()
+
+    def __getitem__(self, index):
+        """get a column, an array or a list"""
+        if self.columns is None:
+            raise IndexError("no columns, nothing has been appended")
+        if self._array_types.get(index) is bool:
+            return [bool(value) for value in self.columns[index]]
+        return self.columns[index]
+
+    @staticmethod
+    def flatten(row):
+        """get a flat tuple of the values in a possibly nested answer"""
+        if not isinstance(row, tuple):
+            return (row,)
+        flat_row = ()
+        for item in row:
+            flat_row += (
+                RelevanceColumns.flatten(item) if isinstance(item, tuple) else (item,)
+            )
+        return flat_row
+
+    def _column_to_list(self, index):
+        """replace an array column with a list of the same values"""
+        self.columns[index] = list(self[index])
+        del self._array_types[index]
+        return self.columns[index]
+
+    def append(self, row):
+        """add a row, a single answer or a tuple"""
+        row = self.flatten(row)
+        if self.columns is None:
+            self.columns = []
+            for index, value in enumerate(row):
+                typecode = self.array_typecodes.get(type(value))
+                if typecode is None:
+                    self.columns.append([])
+                else:
+                    self.columns.append(array.array(typecode))
+                    self._array_types[index] = type(value)
+        elif len(row) != len(self.columns):
+            raise ValueError(
+                f"row has {len(row)} values, expected {len(self.columns)}: {row}"
+            )
+
+        for index, value in enumerate(row):
+            column = self.columns[index]
+            if index in self._array_types:
+                if type(value) is self._array_types[index]:
+                    try:
+                        column.append(value)
+                        continue
+                    except OverflowError:
+                        pass
+                column = self._column_to_list(index)
+            column.append(value)
+        self.num_rows += 1
+
+    def rows(self):
+        """iterate over rows as tuples"""
+        if self.columns is None:
+            return iter(())
+        return zip(*(self[index] for index in range(len(self.columns))))
+
+
+class UploadIndex:
+    """persistent record of files uploaded to root servers, by content hash"""
+
+    def __init__(self, index_path=UPLOAD_INDEX_PATH):
+        self.index_path = index_path
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(rootserver, sha256, file_name):
+        """index key for a file uploaded to a root server under a name"""
+        return f"{rootserver}|{sha256}|{file_name}"
+
+    def _read(self):
+        if not os.path.exists(self.index_path):
+            return {}
+        with open(self.index_path, "r", encoding="utf-8") as index_file:
+            return json.load(index_file)
+
+    def get(self, key):
+        """get the recorded upload for a key, or None"""
+        with self._lock:
+            return self._read().get(key)
+
+    def set(self, key, entry):
+        """record an upload"""
+        with self._lock:
+            index = self._read()
+            index[key] = entry
+            # write to a temp file first so the index can't be left corrupt
+            with open(self.index_path + ".tmp", "w", encoding="utf-8") as index_file:
+                json.dump(index, index_file, indent=1)
+            os.replace(self.index_path + ".tmp", self.index_path)
+
+    def remove(self, key):
+        """forget a recorded upload"""
+        with self._lock:
+            index = self._read()
+            if index.pop(key, None) is not None:
+                with open(
+                    self.index_path + ".tmp", "w", encoding="utf-8"
+                ) as index_file:
+                    json.dump(index, index_file, indent=1)
+                os.replace(self.index_path + ".tmp", self.index_path)
+
+
+class TTLCache:
+    """thread safe LRU cache whose entries expire after a time to live"""
+
+    def __init__(self, maxsize=256, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # key: (time stored, time expires, value), oldest used first
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key, count=False) is not None
+
+    def get(self, key, default=None, max_age=None, count=True):
+        """get a value if it has not expired, and is newer than max_age seconds"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored, expires, value = entry
+                if now >= expires:
+                    del self._entries[key]
+                elif max_age is None or now - stored <= max_age:
+                    self._entries.move_to_end(key)
+                    if count:
+                        self.hits += 1
+                    return value
+            if count:
+                self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        """store a value, expiring after ttl seconds or the cache default"""
+        now = time.monotonic()
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            self._entries[key] = (now, now + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """remove a single key, or everything if no key is given"""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def invalidate_prefix(self, prefix):
+        """remove every tuple key that starts with the items of a tuple"""
+        with self._lock:
+            for key in list(self._entries):
+                if isinstance(key, tuple) and key[: len(prefix)] == prefix:
+                    del self._entries[key]
+
+    def stats(self):
+        """get hit/miss counts and size of the cache"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+        }
+
+
+class HTTPCache:
+    """thread safe cache of GET results to revalidate by ETag or Last-Modified
+
+    Results are kept in memory up to max_bytes of response bodies,
+    dropping the least recently used first. If cache_path is given,
+    responses are also kept in an SQLite file up to max_bytes, so later
+    processes can revalidate them instead of downloading them again.
+    See `BESConnection.enable_http_cache`.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, cache_path=None):
+        self.max_bytes = max_bytes
+        self.cache_path = cache_path
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # bytes of response bodies that did not have to be downloaded
+        self.bytes_saved = 0
+        # key: (etag, last modified, RESTResult, size), oldest used first
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._db = None
+        if cache_path:
+            import sqlite3  # pylint: disable=import-outside-toplevel
+
+            self._db = sqlite3.connect(cache_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, "
+                "etag TEXT, last_modified TEXT, headers TEXT, body BLOB, "
+                "size INTEGER, used REAL)"
+            )
+            self._db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, key):
+        """get the (etag, last modified, stored) kept for a key, or None
+
+        stored is a RESTResult if it is in memory, otherwise the
+        (headers, body) of the response from the cache file.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry[:3]
+            if self._db is None:
+                return None
+            row = self._db.execute(
+                "SELECT etag, last_modified, headers, body FROM responses "
+                "WHERE key = ?",
+                (key,),
+            ).fetchone()
+        if row is None:
+            return None
+        etag, last_modified, headers, body = row
+        return etag, last_modified, (json.loads(headers), zlib.decompress(body))
+
+    def set(self, key, etag, last_modified, result, persist=True):
+        """keep a result with the validators to revalidate it with"""
+        size = len(result.request.content)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old_entry = self._entries.pop(key, None)
+            if old_entry is not None:
+                self._bytes -= old_entry[3]
+            self._entries[key] = (etag, last_modified, result, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, old_entry = self._entries.popitem(last=False)
+                self._bytes -= old_entry[3]
+                self.evictions += 1
+
+            if self._db is None or not persist:
+                return
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    etag,
+                    last_modified,
+                    json.dumps(dict(result.request.headers)),
+                    zlib.compress(result.request.content),
+                    size,
+                    time.time(),
+                ),
+            )
+            # drop the least recently stored responses over the size limit
+            total = 0
+            evicted = []
+            for stored_key, stored_size in self._db.execute(
+                "SELECT key, size FROM responses ORDER BY used DESC"
+            ).fetchall():
+                total += stored_size
+                if total > self.max_bytes:
+                    evicted.append((stored_key,))
+            self._db.executemany("DELETE FROM responses WHERE key = ?", evicted)
+            self._db.commit()
+
+    def record(self, hit, size=0):
+        """count a revalidation, and the bytes it saved if it was a hit"""
+        with self._lock:
+            if hit:
+                self.hits += 1
+                self.bytes_saved += size
+            else:
+                self.misses += 1
+
+    def invalidate(self, key=None):
+        """forget a single key, or everything if no key is given"""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+                self._bytes = 0
+            elif key in self._entries:
+                self._bytes -= self._entries.pop(key)[3]
+            if self._db is not None:
+                if key is None:
+                    self._db.execute("DELETE FROM responses")
+                else:
+                    self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._db.commit()
+
+    def stats(self):
+        """get hit/miss counts, bytes saved and size of the cache"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "bytes_saved": self.bytes_saved,
+            "evictions": self.evictions,
+            "size": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+    def close(self):
+        """close the cache file, if there is one"""
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+class RequestMetrics:
+    """thread safe per endpoint request latency, size and status counts,
+    and timings of other work like parsing and validating responses"""
+
+    # upper bounds in milliseconds of the latency histogram buckets
+    latency_buckets = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    @staticmethod
+    def endpoint(method, url):
+        """get the endpoint name for a request, like `GET computer`"""
+        path = parse.urlsplit(url).path
+        if "/api/" in path:
+            path = path.split("/api/", 1)[1]
+        return f"{method.upper()} {path.strip('/').split('/')[0]}"
+
+    def reset(self):
+        """forget everything recorded"""
+        with self._lock:
+            self.endpoints = {}
+            self.timings = {}
+
+    def record_request(self, endpoint, elapsed, status_code=None, size=None):
+        """record a request's latency in seconds, status code and response size"""
+        milliseconds = elapsed * 1000
+        with self._lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = {
+                    "count": 0,
+                    "total_seconds": 0.0,
+                    "min_seconds": elapsed,
+                    "max_seconds": elapsed,
+                    "bytes": 0,
+                    "retries": 0,
+                    "status_codes": collections.Counter(),
+                    "latency_ms": [0] * (len(self.latency_buckets) + 1),
+                }
+            stats["count"] += 1
+            stats["total_seconds"] += elapsed
+            stats["min_seconds"] = min(stats["min_seconds"], elapsed)
+            stats["max_seconds"] = max(stats["max_seconds"], elapsed)
+            if size:
+                stats["bytes"] += size
+            if status_code is not None:
+                stats["status_codes"][status_code] += 1
+            for bucket, bound in enumerate(self.latency_buckets):
+                if milliseconds <= bound:
+                    break
+            else:
+                bucket = len(self.latency_buckets)
+            stats["latency_ms"][bucket] += 1
+
+    def record_retry(self, endpoint):
+        """count a request that was sent again"""
+        with self._lock:
+            if endpoint in self.endpoints:
+                self.endpoints[endpoint]["retries"] += 1
+
+    def record_timing(self, name, elapsed):
+        """record seconds spent on other work, like `parse` or `validate`"""
+        with self._lock:
+            count, total = self.timings.get(name, (0, 0.0))
+            self.timings[name] = (count + 1, total + elapsed)
+
+    def stats(self):
+        """get a snapshot of everything recorded"""
+        labels = [f"<={bound}" for bound in self.latency_buckets]
+        labels.append(f">{self.latency_buckets[-1]}")
+        with self._lock:
+            endpoints = {}
+            for endpoint, stats in self.endpoints.items():
+                endpoints[endpoint] = dict(
+                    stats,
+                    mean_seconds=stats["total_seconds"] / stats["count"],
+                    status_codes=dict(stats["status_codes"]),
+                    latency_ms=dict(zip(labels, stats["latency_ms"])),
+                )
+            timings = {
+                name: {"count": count, "total_seconds": total}
+                for name, (count, total) in self.timings.items()
+            }
+        return {"endpoints": endpoints, "timings": timings}
+
+
+# https://docs.python-requests.org/en/latest/user/advanced/#transport-adapters
+class HTTPAdapterBiggerBlocksize(requests.adapters.HTTPAdapter):
+    """custom HTTPAdapter for requests to override blocksize
+    for Uploading large files, and to set a default timeout"""
+
+    __attrs__ = requests.adapters.HTTPAdapter.__attrs__ + ["blocksize", "timeout"]
+
+    def __init__(self, blocksize=None, timeout=None, **kwargs):
+        # must be set before HTTPAdapter.__init__ calls init_poolmanager
+        self.blocksize = blocksize
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    # override init_poolmanager from regular HTTPAdapter
+    # https://stackoverflow.com/questions/22915295/python-requests-post-and-big-content/22915488#comment125583017_22915488
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        """Initializes a urllib3 PoolManager, with a larger blocksize if set"""
+        if self.blocksize:
+            # urllib3 before 2.0 fails on unknown pool kwargs like blocksize
+            if "key_blocksize" in urllib3.poolmanager.PoolKey._fields:
+                pool_kwargs["blocksize"] = self.blocksize
+            else:
+                besapi_logger.warning(
+                    "urllib3 %s can't set blocksize, urllib3 2.0+ is required",
+                    urllib3.__version__,
+                )
+        super().init_poolmanager(connections, maxsize, block, **pool_kwargs)
+
+    def send(self, request, timeout=None, **kwargs):  # pylint: disable=arguments-differ
+        """Sends PreparedRequest object, using the default timeout if none given"""
+        if timeout is None:
+            timeout = self.timeout
+        return super().send(request, timeout=timeout, **kwargs)
+
+
+class Cassette:
+    """recorded responses in an SQLite file, see RecordingAdapter
+
+    Responses are looked up by method, path and a hash of the body, so
+    a cassette recorded from one root server replays for any other.
+    Only the responses looked up are read from disk. Repeated requests
+    replay in the order they were recorded, then repeat the last one.
+    """
+
+    # response headers that don't apply to the decoded body that is kept
+    skip_headers = ("content-encoding", "content-length", "transfer-encoding")
+
+    def __init__(self, cassette_path):
+        self.cassette_path = cassette_path
+        import sqlite3  # pylint: disable=import-outside-toplevel
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(cassette_path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT, sequence INTEGER, "
+            "status INTEGER, reason TEXT, headers TEXT, body BLOB, "
+            "PRIMARY KEY (key, sequence))"
+        )
+        self._db.commit()
+        # how many times each key was recorded or replayed so far
+        self._recorded = collections.Counter()
+        self._replayed = collections.Counter()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def key(method, url, body=None):
+        """get the lookup key for a request, its method, path and body hash"""
+        url_parts = parse.urlsplit(url)
+        path = url_parts.path + ("?" + url_parts.query if url_parts.query else "")
+        if body is None:
+            return f"{method.upper()} {path}"
+
+        body_hash = hashlib.sha256()
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        if isinstance(body, bytes):
+            body_hash.update(body)
+        elif hasattr(body, "seek"):
+            position = body.tell()
+            for block in iter(lambda: body.read(1024 * 1024), b""):
+                body_hash.update(block)
+            body.seek(position)
+        else:
+            # a generator can only be read once, by sending it
+            return f"{method.upper()} {path} stream"
+        return f"{method.upper()} {path} {body_hash.hexdigest()}"
+
+    def record(self, key, status, reason, headers, body):
+        """store a response, replacing any from an earlier recording"""
+        headers = {
+            name: value
+            for name, value in headers.items()
+            if name.lower() not in self.skip_headers
+        }
+        with self._lock:
+            sequence = self._recorded[key]
+            self._recorded[key] += 1
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    sequence,
+                    status,
+                    reason,
+                    json.dumps(headers),
+                    zlib.compress(body),
+                ),
+            )
+            self._db.commit()
+
+    def lookup(self, key):
+        """get the next recorded (status, reason, headers, body), or None"""
+        with self._lock:
+            sequence = self._replayed[key]
+            row = self._db.execute(
+                "SELECT status, reason, headers, body FROM responses "
+                "WHERE key = ? AND sequence <= ? ORDER BY sequence DESC LIMIT 1",
+                (key, sequence),
+            ).fetchone()
+            if row is None:
+                return None
+            self._replayed[key] += 1
+        status, reason, headers, body = row
+        return status, reason, json.loads(headers), zlib.decompress(body)
+
+    def close(self):
+        """close the cassette file"""
+        with self._lock:
+            self._db.close()
+
+
+class ContentIndex:
+    """local index of site content in an SQLite file, see refresh_content_index
+
+    Keeps the site, type, ID, name, resource and LastModified of every
+    item in the sites that were refreshed, for each root server, so
+    items can be found by name or by when they changed without asking
+    the server. Sites are refreshed from their content listings, only
+    writing the items that were added, changed or removed.
+    """
+
+    # columns of an item, in the order they are stored
+    columns = ("site_path", "type", "id", "name", "resource", "last_modified")
+
+    def __init__(self, index_path=CONTENT_INDEX_PATH):
+        self.index_path = index_path
+        import sqlite3  # pylint: disable=import-outside-toplevel
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(index_path, check_same_thread=False)
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS items (rootserver TEXT, site_path TEXT, "
+            "type TEXT, id INTEGER, name TEXT COLLATE NOCASE, resource TEXT, "
+            "last_modified TEXT, modified REAL, PRIMARY KEY (rootserver, resource));"
+            "CREATE INDEX IF NOT EXISTS items_name ON items (rootserver, name);"
+            "CREATE INDEX IF NOT EXISTS items_modified ON items (rootserver, modified);"
+            "CREATE INDEX IF NOT EXISTS items_site ON items (rootserver, site_path, id);"
+            "CREATE TABLE IF NOT EXISTS sites (rootserver TEXT, site_path TEXT, "
+            "refreshed REAL, PRIMARY KEY (rootserver, site_path));"
+        )
+        self._db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+
+    def update_site(self, rootserver, site_path, site_items):
+        """replace the items of a site with those in its current listing
+
+        site_items are dicts like `list_site_items` returns. Only items
+        that were added, changed or removed are written.
+        returns a dict of the number of items added, changed, removed
+        and unchanged
+        """
+        counts = {"added": 0, "changed": 0, "removed": 0, "unchanged": 0}
+        with self._lock:
+            indexed = dict(
+                self._db.execute(
+                    "SELECT resource, last_modified FROM items "
+                    "WHERE rootserver = ? AND site_path = ?",
+                    (rootserver, site_path),
+                )
+            )
+            rows = []
+            for item in site_items:
+                resource = item["resource"]
+                if resource not in indexed:
+                    counts["added"] += 1
+                elif indexed.pop(resource) != item["last_modified"]:
+                    counts["changed"] += 1
+                else:
+                    counts["unchanged"] += 1
+                    continue
+                modified = (
+                    parse_bes_modtime(item["last_modified"]).timestamp()
+                    if item["last_modified"]
+                    else None
+                )
+                rows.append(
+                    (rootserver,)
+                    + tuple(item[column] for column in self.columns)
+                    + (modified,)
+                )
+            counts["removed"] = len(indexed)
+
+            self._db.executemany(
+                "INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows
+            )
+            self._db.executemany(
+                "DELETE FROM items WHERE rootserver = ? AND resource = ?",
+                ((rootserver, resource) for resource in indexed),
+            )
+            self._db.execute(
+                "INSERT OR REPLACE INTO sites VALUES (?, ?, ?)",
+                (rootserver, site_path, time.time()),
+            )
+            self._db.commit()
+        return counts
+
+    def _items(self, where, params, order="site_path, id", limit=None):
+        """get items from the index as dicts"""
+        sql = f"SELECT {', '.join(self.columns)} FROM items WHERE {where} ORDER BY {order}"
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        with self._lock:
+            return [
+                dict(zip(self.columns, row)) for row in self._db.execute(sql, params)
+            ]
+
+    def find(self, rootserver, name, site_path=None, item_type=None, limit=100):
+        """find items by name, case insensitive, `*` matches any text"""
+        where = "rootserver = ? AND name LIKE ? ESCAPE '\\'"
+        pattern = name.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        params = [rootserver, pattern.replace("*", "%")]
+        if site_path:
+            where += " AND site_path = ?"
+            params.append(site_path)
+        if item_type:
+            where += " AND type = ? COLLATE NOCASE"
+            params.append(item_type)
+        return self._items(where, params, limit=limit)
+
+    def get(self, rootserver, site_path, item_id):
+        """get the items with an ID in a site, there can be one of each type"""
+        return self._items(
+            "rootserver = ? AND site_path = ? AND id = ?",
+            (rootserver, site_path, int(item_id)),
+        )
 
-#     # override inti_poolmanager from regular HTTPAdapter
-#     # https://stackoverflow.com/questions/22915295/python-requests-post-and-big-content/22915488#comment125583017_22915488
-#     def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
-#         """Initializes a urllib3 PoolManager.
+    def changed_since(self, rootserver, since, site_path=None, limit=None):
+        """get the items last modified at or after a datetime, newest first"""
+        where = "rootserver = ? AND modified >= ?"
+        params = [rootserver, since.timestamp()]
+        if site_path:
+            where += " AND site_path = ?"
+            params.append(site_path)
+        return self._items(where, params, order="modified DESC", limit=limit)
+
+    def sites(self, rootserver):
+        """get a dict of each indexed site's refresh time and number of items"""
+        with self._lock:
+            return {
+                site_path: {
+                    "refreshed": datetime.datetime.fromtimestamp(refreshed),
+                    "items": num_items,
+                }
+                for site_path, refreshed, num_items in self._db.execute(
+                    "SELECT site_path, refreshed, (SELECT COUNT(*) FROM items "
+                    "WHERE items.rootserver = sites.rootserver "
+                    "AND items.site_path = sites.site_path) "
+                    "FROM sites WHERE rootserver = ? ORDER BY site_path",
+                    (rootserver,),
+                )
+            }
+
+    def close(self):
+        """close the index file"""
+        with self._lock:
+            self._db.close()
+
+
+def cassette_response(status, reason, headers, body):
+    """make a urllib3 response to build a requests.Response from"""
+    return urllib3.HTTPResponse(
+        body=io.BytesIO(body),
+        headers=headers,
+        status=status,
+        reason=reason,
+        preload_content=False,
+    )
 
-#         This method should not be called from user code, and is only
-#         exposed for use when subclassing the
-#         :class:`HTTPAdapter <requests.adapters.HTTPAdapter>`.
 
-#         :param connections: The number of urllib3 connection pools to cache.
-#         :param maxsize: The maximum number of connections to save in the pool.
-#         :param block: Block when no free connections are available.
-#         :param pool_kwargs: Extra keyword arguments used to initialize the Pool Manager.
-#         """
-#         # save these values for pickling
-#         self._pool_connections = connections
-#         self._pool_maxsize = maxsize
-#         self._pool_block = block
+class RecordingAdapter(HTTPAdapterBiggerBlocksize):
+    """HTTPAdapter that records every response it receives to a Cassette"""
 
-#         # This doesn't work until urllib3 is updated to a future version:
-#         # updating blocksize to be larger:
-#         # pool_kwargs["blocksize"] = 8 * 1024 * 1024
+    def __init__(self, cassette, **kwargs):
+        self.cassette = cassette
+        super().__init__(**kwargs)
 
-#         self.poolmanager = urllib3.poolmanager.PoolManager(
-#             num_pools=connections,
-#             maxsize=maxsize,
-#             block=block,
-#             strict=True,
-#             **pool_kwargs,
-#         )
+    def send(self, request, **kwargs):  # pylint: disable=arguments-differ
+        """Sends PreparedRequest object, recording the response"""
+        # the body can only be hashed before a file body is sent
+        key = Cassette.key(request.method, request.url, request.body)
+        response = super().send(request, **kwargs)
+        body = response.content
+        self.cassette.record(
+            key, response.status_code, response.reason, response.headers, body
+        )
+
+        # the body was read to record it, so read it again from memory
+        raw = cassette_response(
+            response.status_code, response.reason, response.headers, body
+        )
+        raw.headers.discard("content-encoding")
+        # the session still needs the original headers to store cookies from
+        raw._original_response = (  # pylint: disable=protected-access
+            response.raw._original_response  # pylint: disable=protected-access
+        )
+        response.raw = raw
+        response._content = False  # pylint: disable=protected-access
+        response._content_consumed = False  # pylint: disable=protected-access
+        return response
+
+
+class ReplayAdapter(requests.adapters.HTTPAdapter):
+    """HTTPAdapter that answers from a Cassette without any network access
+
+    A request that was not recorded raises ConnectionError.
+    """
+
+    def __init__(self, cassette, **kwargs):
+        self.cassette = cassette
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):  # pylint: disable=arguments-differ
+        """Sends PreparedRequest object to the cassette"""
+        recorded = self.cassette.lookup(
+            Cassette.key(request.method, request.url, request.body)
+        )
+        if recorded is None:
+            raise requests.exceptions.ConnectionError(
+                f"No recorded response for {request.method} {request.url} "
+                f"in `{self.cassette.cassette_path}`",
+                request=request,
+            )
+        return self.build_response(request, cassette_response(*recorded))
 
 
 class BESConnection:
     """BigFix RESTAPI connection abstraction class"""
 
-    def __init__(self, username, password, rootserver, verify=False):
+    def __init__(
+        self,
+        username,
+        password,
+        rootserver,
+        verify=False,
+        validation=VALIDATION_CONTENT_TYPE,
+        validation_sample_rate=100,
+        pool_connections=10,
+        pool_maxsize=10,
+        upload_blocksize=None,
+        timeout=None,
+        compression=True,
+        cassette=None,
+        replay=False,
+    ):
+
+        if validation not in VALIDATION_POLICIES:
+            raise ValueError(
+                f"Validation policy `{validation}` is not one of {VALIDATION_POLICIES}"
+            )
+        if validation == VALIDATION_SAMPLE and int(validation_sample_rate) < 1:
+            raise ValueError("Validation sample rate must be 1 or more")
+        # how every RESTResult from this connection is validated
+        self.validation = validation
+        self.validation_sample_rate = int(validation_sample_rate)
+        self._validation_count = itertools.count()
+        # opt in with `enable_relevance_cache`
+        self.relevance_cache = None
+        # opt in with `enable_content_index`
+        self.content_index = None
+        # opt in with `enable_resolver_cache`
+        self.resolver_cache = None
+        # opt in with `enable_http_cache`
+        self.http_cache = None
 
         if not verify:
             # disable SSL warnings
             requests.packages.urllib3.disable_warnings()  # pylint: disable=no-member
         self.verify = verify
         self.last_connected = None
+        # when the server session will expire, see `track_session`
+        self.session_expires = None
+        # how many requests were retried after logging in again
+        self.login_retries = 0
+        # logins so far, and a lock so threads that all find the session
+        # expired login again only once, see `request`
+        self.logins = 0
+        self._login_lock = threading.Lock()
+        self._keepalive_thread = None
+        self._keepalive_stop = None
+        # see `stats` and `add_hook`
+        self.metrics = RequestMetrics()
+        self.hooks = {"pre_request": [], "post_request": []}
 
         self.username = username
         self.session = requests.Session()
         self.session.auth = (username, password)
+        self.transport_options = {}
+        self.configure_transport(
+            pool_connections,
+            pool_maxsize,
+            upload_blocksize,
+            timeout,
+            compression,
+            cassette,
+            replay,
+        )
         # store info on operator used to login
         # self.operator_info = {}
 
@@ -203,12 +1475,70 @@ class BESConnection:
 
     def __del__(self):
         """cleanup on deletion of instance"""
+        if getattr(self, "session", None) is None:
+            # __init__ failed before there was anything to clean up
+            return
         self.logout()
         self.session.auth = None
 
     def __bool__(self):
-        """get true or false"""
-        return self.login()
+        """get true or false, only contacts the server if never logged in"""
+        if self.last_connected is None:
+            return self.login()
+        return True
+
+    def configure_transport(
+        self,
+        pool_connections=10,
+        pool_maxsize=10,
+        upload_blocksize=None,
+        timeout=None,
+        compression=True,
+        cassette=None,
+        replay=False,
+    ):
+        """mount a connection pool adapter on the session with these settings
+
+        pool_maxsize should be at least the number of threads sharing this
+        connection, or connections beyond it are closed after every request.
+        upload_blocksize is the size of blocks sent from files, requests to
+        the server can be much faster with blocks of 1 MiB or more.
+        timeout is the default for every request, in seconds or a
+        (connect, read) tuple. compression asks for gzip responses.
+        cassette is a Cassette or a path to one to record every response
+        to, or if replay, to answer every request from instead of the
+        server, see RecordingAdapter and ReplayAdapter.
+        """
+        if cassette is not None and not isinstance(cassette, Cassette):
+            cassette = Cassette(cassette)
+        self.transport_options = {
+            "pool_connections": pool_connections,
+            "pool_maxsize": pool_maxsize,
+            "upload_blocksize": upload_blocksize,
+            "timeout": timeout,
+            "compression": compression,
+            "cassette": cassette,
+            "replay": replay,
+        }
+        adapter_options = {
+            "pool_connections": pool_connections,
+            "pool_maxsize": pool_maxsize,
+        }
+        if cassette is None:
+            adapter = HTTPAdapterBiggerBlocksize(
+                blocksize=upload_blocksize, timeout=timeout, **adapter_options
+            )
+        elif replay:
+            adapter = ReplayAdapter(cassette, **adapter_options)
+        else:
+            adapter = RecordingAdapter(
+                cassette, blocksize=upload_blocksize, timeout=timeout, **adapter_options
+            )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers["Accept-Encoding"] = (
+            "gzip, deflate" if compression else "identity"
+        )
 
     def url(self, path):
         """get absolute url"""
@@ -219,46 +1549,655 @@ class BESConnection:
 
         return url
 
-    def get(self, path="help", **kwargs):
-        """HTTP GET request"""
-        self.last_connected = datetime.datetime.now()
-        return RESTResult(
-            self.session.get(self.url(path), verify=self.verify, **kwargs)
+    def resource_url(self, resource_url):
+        """get the url for a resource, which may be listed with http://
+        even though the root server only serves https"""
+        if self.rootserver.startswith("https://"):
+            return resource_url.replace("http://", "https://")
+        return resource_url
+
+    def rest_result(self, request):
+        """wrap a response in a RESTResult using this connection's validation"""
+        validation = self.validation
+        if validation == VALIDATION_SAMPLE:
+            if next(self._validation_count) % self.validation_sample_rate == 0:
+                validation = VALIDATION_ALWAYS
+            else:
+                validation = VALIDATION_NEVER
+
+        return RESTResult(request, validation, self.metrics)
+
+    def request(self, method, path, retry_login=True, **kwargs):
+        """HTTP request, returns the requests.Response
+
+        If the server responds 401 because the session expired, login
+        again and retry the request once. File data is rewound first.
+        When many threads find the session expired at once, only one
+        logs in, the rest wait for it and retry.
+        """
+        kwargs.setdefault("verify", self.verify)
+        data = kwargs.get("data")
+        data_position = data.tell() if hasattr(data, "seek") else None
+        url = self.url(path)
+        endpoint = RequestMetrics.endpoint(method, url)
+        for hook in self.hooks["pre_request"]:
+            hook(method, url, kwargs)
+
+        logins_before = self.logins
+        response = self._send(method, url, endpoint, kwargs)
+
+        if response.status_code == 401 and retry_login:
+            with self._login_lock:
+                # another thread may have logged in since this request was sent
+                if self.logins == logins_before:
+                    try:
+                        self.login(force=True)
+                    except requests.exceptions.HTTPError:
+                        # the credentials were rejected, not just the session
+                        return response
+            besapi_logger.info("Session expired, retrying %s %s", method, path)
+            response.close()
+            if data_position is not None:
+                data.seek(data_position)
+            self.login_retries += 1
+            self.metrics.record_retry(endpoint)
+            response = self._send(method, url, endpoint, kwargs)
+
+        if self.resolver_cache is not None and method.lower() != "get":
+            self.invalidate_resolver_cache(url.split("/api/", 1)[-1])
+
+        return response
+
+    def _send(self, method, url, endpoint, kwargs):
+        """send a request, recording metrics and running post_request hooks"""
+        start_time = time.perf_counter()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            self.metrics.record_request(
+                endpoint, time.perf_counter() - start_time, "error"
+            )
+            raise
+        elapsed = time.perf_counter() - start_time
+
+        # bytes received, which are compressed if the response was
+        size = response.headers.get("content-length")
+        if size is None and not kwargs.get("stream"):
+            size = len(response.content)
+        self.metrics.record_request(
+            endpoint, elapsed, response.status_code, int(size) if size else None
         )
+        for hook in self.hooks["post_request"]:
+            hook(response, elapsed)
+
+        self.track_session(response)
+        return response
+
+    def add_hook(self, event, hook):
+        """call hook on every request, event is `pre_request` or `post_request`
+
+        pre_request hooks are called with the method, url and a dict of
+        keyword arguments for requests, which they can change.
+        post_request hooks are called with the response and elapsed seconds.
+        """
+        if event not in self.hooks:
+            raise ValueError(f"Hook event `{event}` is not one of {list(self.hooks)}")
+        self.hooks[event].append(hook)
+
+    def remove_hook(self, event, hook):
+        """stop calling a hook added with `add_hook`"""
+        self.hooks[event].remove(hook)
+
+    def stats(self):
+        """get request metrics, see RequestMetrics, and cache statistics"""
+        stats = self.metrics.stats()
+        stats["login_retries"] = self.login_retries
+        if self.relevance_cache is not None:
+            stats["relevance_cache"] = self.relevance_cache.stats()
+        if self.resolver_cache is not None:
+            stats["resolver_cache"] = self.resolver_cache.stats()
+        if self.http_cache is not None:
+            stats["http_cache"] = self.http_cache.stats()
+        return stats
+
+    def track_session(self, response):
+        """note when the server session will expire after a response
+
+        Every request keeps the session alive for SESSION_TIMEOUT, or
+        until the server's session cookie expires if that is sooner.
+        """
+        if response.status_code == 401:
+            self.last_connected = None
+            self.session_expires = None
+            return
+
+        now = datetime.datetime.now()
+        session_expires = now + SESSION_TIMEOUT
+        for cookie in self.session.cookies:
+            if cookie.expires:
+                session_expires = min(
+                    session_expires, datetime.datetime.fromtimestamp(cookie.expires)
+                )
+        self.last_connected = now
+        self.session_expires = session_expires
+
+    def get(self, path="help", **kwargs):
+        """HTTP GET request
+
+        If the HTTP cache is enabled, a result kept from an earlier
+        response with an ETag or Last-Modified is asked for again with
+        If-None-Match or If-Modified-Since, and returned if the server
+        responds 304 Not Modified, see `enable_http_cache`.
+        """
+        if self.http_cache is None or kwargs.get("stream"):
+            return self.rest_result(self.request("get", path, **kwargs))
+
+        # the url as it is requested, with any params as its query string
+        prepared = requests.models.PreparedRequest()
+        prepared.prepare_url(self.url(path), kwargs.get("params"))
+        cache_key = f"{self.username} {prepared.url}"
+        cached = self.http_cache.get(cache_key)
+        headers = dict(kwargs.pop("headers", None) or {})
+        if cached is not None:
+            etag, last_modified, _ = cached
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+
+        response = self.request("get", path, headers=headers, **kwargs)
+        if response.status_code == 304 and cached is not None:
+            etag, last_modified, cached_result = cached
+            if not isinstance(cached_result, RESTResult):
+                # kept in the cache file, so rebuild it from the response there
+                cached_result = self.cached_result(prepared.url, *cached_result)
+                self.http_cache.set(
+                    cache_key, etag, last_modified, cached_result, persist=False
+                )
+            self.http_cache.record(True, len(cached_result.request.content))
+            besapi_logger.debug("HTTP cache hit: %s", path)
+            return cached_result.cache_copy()
+
+        self.http_cache.record(False)
+        result = self.rest_result(response)
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if response.status_code == 200 and (etag or last_modified):
+            self.http_cache.set(cache_key, etag, last_modified, result)
+        return result
+
+    def cached_result(self, path, headers, body):
+        """make a RESTResult from a response kept in the HTTP cache file"""
+        response = requests.models.Response()
+        response.status_code = 200
+        response.url = self.url(path)
+        response.headers.update(headers)
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response._content = body  # pylint: disable=protected-access
+        return self.rest_result(response)
 
     def post(self, path, data, **kwargs):
         """HTTP POST request"""
-        self.last_connected = datetime.datetime.now()
-        return RESTResult(
-            self.session.post(self.url(path), data=data, verify=self.verify, **kwargs)
-        )
+        return self.rest_result(self.request("post", path, data=data, **kwargs))
 
     def put(self, path, data, **kwargs):
         """HTTP PUT request"""
-        self.last_connected = datetime.datetime.now()
-        return RESTResult(
-            self.session.put(self.url(path), data=data, verify=self.verify, **kwargs)
-        )
+        return self.rest_result(self.request("put", path, data=data, **kwargs))
 
     def delete(self, path, **kwargs):
         """HTTP DELETE request"""
-        self.last_connected = datetime.datetime.now()
-        return RESTResult(
-            self.session.delete(self.url(path), verify=self.verify, **kwargs)
+        return self.rest_result(self.request("delete", path, **kwargs))
+
+    def enable_relevance_cache(self, maxsize=256, ttl=60, cache=None):
+        """cache session relevance results by relevance, operator and server
+
+        A TTLCache can be given to share it between connections.
+        """
+        if cache is None:
+            cache = TTLCache(maxsize, ttl)
+        self.relevance_cache = cache
+        return self.relevance_cache
+
+    def disable_relevance_cache(self):
+        """stop caching session relevance results"""
+        self.relevance_cache = None
+
+    def invalidate_relevance_cache(self, relevance=None):
+        """forget a cached relevance result, or all of them"""
+        if self.relevance_cache is not None:
+            if relevance is None:
+                self.relevance_cache.invalidate()
+            else:
+                self.relevance_cache.invalidate(
+                    (self.rootserver, self.username, relevance)
+                )
+
+    def enable_http_cache(
+        self, max_bytes=64 * 1024 * 1024, cache_path=None, cache=None
+    ):
+        """revalidate GET results instead of downloading them again
+
+        Responses with an ETag or Last-Modified are kept, up to max_bytes
+        of bodies, in memory and in cache_path if given, see HTTPCache.
+        The server is still asked every time, so results are never stale.
+        An HTTPCache can be given to share it between connections.
+        """
+        if cache is None:
+            cache = HTTPCache(max_bytes, cache_path)
+        self.http_cache = cache
+        return self.http_cache
+
+    def disable_http_cache(self):
+        """stop revalidating GET results"""
+        self.http_cache = None
+
+    def enable_resolver_cache(self, maxsize=1024, ttl=300, cache=None):
+        """cache looking up computer groups, operators and sites by name
+
+        Lookups by get_computergroup, get_user and validate_site_path are
+        kept for ttl seconds, including names that were not found. Any
+        request that is not a GET to a computergroup, operator or site
+        path forgets the lookups of that kind.
+        A TTLCache can be given to share it between connections.
+        """
+        if cache is None:
+            cache = TTLCache(maxsize, ttl)
+        self.resolver_cache = cache
+        return self.resolver_cache
+
+    def disable_resolver_cache(self):
+        """stop caching lookups by name"""
+        self.resolver_cache = None
+
+    def invalidate_resolver_cache(self, path=None):
+        """forget cached lookups of the kind a REST API path changes, or all"""
+        if self.resolver_cache is None:
+            return
+        if path is None:
+            self.resolver_cache.invalidate()
+            return
+        kind = RESOLVER_KINDS.get(path.strip("/").split("/", 1)[0].split("?", 1)[0])
+        if kind == "sites":
+            # groups belong to sites, so changing a site can change them
+            self.resolver_cache.invalidate_prefix(("groups", self.rootserver))
+        if kind is not None:
+            # for every operator, they may see what this one changed
+            self.resolver_cache.invalidate_prefix((kind, self.rootserver))
+
+    def _resolve(self, kind, name, lookup):
+        """get a value by lookup, or from the resolver cache if enabled
+
+        Values are kept by kind, root server, operator and name, so a
+        shared cache keeps connections apart. lookup returns the value
+        and whether it can be cached.
+        """
+        key = (kind, self.rootserver, self.username, name)
+        if self.resolver_cache is not None:
+            value = self.resolver_cache.get(key)
+            if value is not None:
+                return None if value is NOT_FOUND else value
+
+        value, cacheable = lookup()
+        if self.resolver_cache is not None and cacheable:
+            self.resolver_cache.set(key, NOT_FOUND if value is None else value)
+        return value
+
+    def enable_content_index(self, index_path=CONTENT_INDEX_PATH, index=None):
+        """keep a local index of site content, see ContentIndex
+
+        A ContentIndex can be given to share it between connections.
+        """
+        if index is None:
+            index = ContentIndex(index_path)
+        self.content_index = index
+        return self.content_index
+
+    def _require_content_index(self):
+        if self.content_index is None:
+            raise ValueError("No content index, see enable_content_index")
+        return self.content_index
+
+    def refresh_content_index(self, site_paths=None, max_workers=1, max_age=None):
+        """refresh the content index from site content listings
+
+        site_paths defaults to every site. Sites refreshed less than
+        max_age seconds ago are skipped.
+        returns a dict of the number of sites refreshed, skipped and
+        items added, changed, removed and unchanged, and a list of
+        (site_path, exception) for sites that could not be listed
+        """
+        content_index = self._require_content_index()
+        if site_paths is None:
+            results_sites = self.get("sites")
+            results_sites.request.raise_for_status()
+            site_paths = [
+                item.attrib["Resource"].split("/api/site/", 1)[1]
+                for item in results_sites().iterchildren()
+            ]
+        if max_age is not None:
+            refreshed = content_index.sites(self.rootserver)
+            skip_before = datetime.datetime.now() - datetime.timedelta(seconds=max_age)
+            fresh = {
+                site_path
+                for site_path, site in refreshed.items()
+                if site["refreshed"] > skip_before
+            }
+        else:
+            fresh = set()
+
+        summary = {
+            "sites": 0,
+            "skipped": 0,
+            "added": 0,
+            "changed": 0,
+            "removed": 0,
+            "unchanged": 0,
+            "errors": [],
+        }
+
+        def refresh_site(site_path):
+            site_items = self.list_site_items(site_path)
+            if site_items is None:
+                raise ValueError(f"Could not list the content of site `{site_path}`")
+            return content_index.update_site(self.rootserver, site_path, site_items)
+
+        stale_sites = [site_path for site_path in site_paths if site_path not in fresh]
+        summary["skipped"] = len(site_paths) - len(stale_sites)
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, max_workers)
+        ) as executor:
+            futures = {
+                executor.submit(refresh_site, site_path): site_path
+                for site_path in stale_sites
+            }
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    counts = future.result()
+                except Exception as err:  # pylint: disable=broad-except
+                    summary["errors"].append((futures[future], err))
+                    continue
+                summary["sites"] += 1
+                for name, count in counts.items():
+                    summary[name] += count
+
+        besapi_logger.info("Refreshed content index: %s", summary)
+        return summary
+
+    def find_content(self, name, site_path=None, item_type=None, limit=100):
+        """find indexed items by name, case insensitive, `*` matches any text
+
+        returns a list of dicts like `list_site_items`, see
+        `refresh_content_index`
+        """
+        return self._require_content_index().find(
+            self.rootserver, name, site_path, item_type, limit
         )
 
-    def session_relevance_xml(self, relevance, **kwargs):
-        """Get Session Relevance Results XML"""
-        self.last_connected = datetime.datetime.now()
-        return RESTResult(
-            self.session.post(
-                self.url("query"),
+    def get_indexed_content(self, site_path, item_id):
+        """get the indexed items with an ID in a site"""
+        return self._require_content_index().get(self.rootserver, site_path, item_id)
+
+    def content_changed_since(self, since, site_path=None, limit=None):
+        """get the indexed items last modified at or after a datetime"""
+        return self._require_content_index().changed_since(
+            self.rootserver, since, site_path, limit
+        )
+
+    def get_to_file(self, path, file_path, chunk_size=1024 * 1024, **kwargs):
+        """HTTP GET request streamed to a file in chunks, returns file_path
+
+        The response is never held in memory. It is written to a
+        temporary file next to file_path which replaces file_path once
+        complete, so a failed download never leaves a partial file.
+        """
+        with self.request("get", path, stream=True, **kwargs) as response:
+            if response.status_code == 403:
+                raise PermissionError(
+                    f"\n - HTTP Response Status Code: `403` Forbidden\n - URL: `{response.url}`"
+                )
+            response.raise_for_status()
+
+            file_folder = os.path.dirname(os.path.abspath(file_path))
+            temp_file, temp_path = open_part_file(file_folder)
+            try:
+                with temp_file:
+                    for chunk in response.iter_content(chunk_size):
+                        temp_file.write(chunk)
+                os.replace(temp_path, file_path)
+            except BaseException:
+                os.remove(temp_path)
+                raise
+
+        return file_path
+
+    def session_relevance_xml(self, relevance, cache_ttl=None, **kwargs):
+        """Get Session Relevance Results XML
+
+        If the relevance cache is enabled, a cached result is returned if
+        it is newer than cache_ttl seconds, and new results are kept for
+        cache_ttl seconds. cache_ttl=0 always queries the server.
+        """
+        cache_key = (self.rootserver, self.username, relevance)
+        if self.relevance_cache is not None and cache_ttl != 0:
+            cached_result = self.relevance_cache.get(cache_key, max_age=cache_ttl)
+            if cached_result is not None:
+                besapi_logger.debug("Relevance cache hit: %s", relevance)
+                return cached_result.cache_copy()
+
+        result = self.rest_result(
+            self.request(
+                "post",
+                "query",
                 data=f"relevance={parse.quote(relevance, safe=':+')}",
-                verify=self.verify,
                 **kwargs,
             )
         )
 
+        if self.relevance_cache is not None and result.request.status_code == 200:
+            # a forced refresh (cache_ttl=0) is kept for the default ttl
+            self.relevance_cache.set(
+                cache_key, result, cache_ttl if cache_ttl else None
+            )
+
+        return result
+
+    def session_relevance_iter(self, relevance, typed=False, **kwargs):
+        """Get Session Relevance Results one at a time as they are received
+
+        Answers are parsed straight from the response stream without
+        holding the whole response, see `iter_relevance_answers`.
+        """
+        response = self.request(
+            "post",
+            "query",
+            data=f"relevance={parse.quote(relevance, safe=':+')}",
+            stream=True,
+            **kwargs,
+        )
+        try:
+            if response.status_code == 403:
+                raise PermissionError(
+                    f"\n - HTTP Response Status Code: `403` Forbidden\n - URL: `{response.url}`"
+                )
+            # let urllib3 decompress the stream if it is gzip encoded
+            response.raw.decode_content = True
+            try:
+                yield from iter_relevance_answers(response.raw, typed)
+            except etree.XMLSyntaxError as err:
+                besapi_logger.error(
+                    "%s\nHTTP Response Status Code: `%d`", err, response.status_code
+                )
+                raise
+        finally:
+            response.close()
+
+    def session_relevance_many(self, queries, max_workers=8, **kwargs):
+        """Get Session Relevance Results for many queries at once
+
+        Queries run concurrently on up to max_workers threads sharing this
+        connection's session. Keep max_workers at or below the connection
+        pool size, see `configure_transport`.
+
+        returns a dict with `results` in the same order as queries, each a
+        dict of relevance, answers (None on error), error (None on
+        success), result (the RESTResult if there was a response) and
+        elapsed seconds. Also `num_errors` and total `elapsed` seconds.
+        """
+        start_time = time.perf_counter()
+
+        def run_query(relevance):
+            query_start = time.perf_counter()
+            query_result = {
+                "relevance": relevance,
+                "answers": None,
+                "error": None,
+                "result": None,
+            }
+            try:
+                result = self.session_relevance_xml(relevance, **kwargs)
+                query_result["result"] = result
+                root = result.xmlroot
+                if root is None:
+                    query_result[
+                        "error"
+                    ] = f"HTTP {result.request.status_code}: {result.text}"
+                elif root.find("Query/Error") is not None:
+                    query_result["error"] = root.find("Query/Error").text
+                else:
+                    query_result["answers"] = [
+                        relevance_tuple(elem) if elem.tag == "Tuple" else elem.text
+                        for elem in root.iterfind("Query/Result/*")
+                    ]
+            except Exception as err:  # pylint: disable=broad-except
+                query_result["error"] = f"{type(err).__name__}: {err}"
+            query_result["elapsed"] = time.perf_counter() - query_start
+            return query_result
+
+        queries = list(queries)
+        if max_workers and max_workers > 1 and len(queries) > 1:
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_workers
+            ) as executor:
+                results = list(executor.map(run_query, queries))
+        else:
+            results = [run_query(relevance) for relevance in queries]
+
+        num_errors = sum(1 for result in results if result["error"] is not None)
+        elapsed = time.perf_counter() - start_time
+        besapi_logger.info(
+            "Ran %d queries with %d errors in %.3f seconds",
+            len(results),
+            num_errors,
+            elapsed,
+        )
+
+        return {"results": results, "num_errors": num_errors, "elapsed": elapsed}
+
+    def session_relevance_partitioned(
+        self,
+        relevance,
+        partitions=8,
+        max_workers=None,
+        typed=False,
+        progress=None,
+        **kwargs,
+    ):
+        """Get Session Relevance Results for all computers, split into partitions
+
+        A query over every computer can take minutes in one request. This
+        splits it into queries on computers by id modulo partitions, see
+        `partition_relevance`, and runs them concurrently on up to
+        max_workers threads, by default the connection pool size.
+
+        Answers are yielded as each partition completes, so they are not
+        in the same order as a single query. If typed, answers are
+        converted, see `session_relevance_typed`. progress is called after
+        each partition with a dict of partition, partitions, completed,
+        answers, elapsed seconds for the partition and relevance.
+        Raises ValueError if a partition returns an error.
+        """
+        queries = [
+            partition_relevance(relevance, partitions, partition)
+            for partition in range(partitions)
+        ]
+        if max_workers is None:
+            max_workers = self.transport_options.get("pool_maxsize", 10)
+        start_time = time.perf_counter()
+
+        def run_partition(partition):
+            partition_start = time.perf_counter()
+            answers = list(
+                self.session_relevance_iter(queries[partition], typed, **kwargs)
+            )
+            if not typed:
+                # typed answers raise ValueError for an error themselves
+                if answers == [NOTHING_RETURNED]:
+                    answers = []
+                for answer in answers:
+                    if type(answer) is str and answer.startswith("ERROR: "):
+                        raise ValueError(f"Query returned an error: {answer[7:]}")
+            return partition, answers, time.perf_counter() - partition_start
+
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, min(max_workers, partitions))
+        )
+        futures = [
+            executor.submit(run_partition, partition) for partition in range(partitions)
+        ]
+        num_answers = 0
+        try:
+            for completed, future in enumerate(
+                concurrent.futures.as_completed(futures), 1
+            ):
+                partition, answers, elapsed = future.result()
+                num_answers += len(answers)
+                besapi_logger.info(
+                    "Partition %d of %d: %d answers in %.3f seconds",
+                    partition + 1,
+                    partitions,
+                    len(answers),
+                    elapsed,
+                )
+                if progress is not None:
+                    progress(
+                        {
+                            "partition": partition,
+                            "partitions": partitions,
+                            "completed": completed,
+                            "answers": len(answers),
+                            "elapsed": elapsed,
+                            "relevance": queries[partition],
+                        }
+                    )
+                yield from answers
+        finally:
+            # stop partitions that have not started if the caller stops early
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+        besapi_logger.info(
+            "Ran %d partitions with %d answers in %.3f seconds",
+            partitions,
+            num_answers,
+            time.perf_counter() - start_time,
+        )
+
+    def session_relevance_typed(self, relevance, columnar=False, **kwargs):
+        """Get Session Relevance Results converted to python types
+
+        Answers are converted by their type: integers, floating points,
+        booleans, times and dates, anything else is a string.
+        returns a list with a tuple for each answer, or a RelevanceColumns
+        if columnar. Raises ValueError if the query has an error.
+        """
+        answers = self.session_relevance_iter(relevance, typed=True, **kwargs)
+        if columnar:
+            return RelevanceColumns(answers)
+        return [
+            answer if isinstance(answer, tuple) else (answer,) for answer in answers
+        ]
+
     def session_relevance_array(self, relevance, **kwargs):
         """Get Session Relevance Results array"""
         rel_result = self.session_relevance_xml(relevance, **kwargs)
@@ -274,7 +2213,7 @@ class BESConnection:
                     result.append("ERROR: " + rel_result.besobj.Query.Error.text)
                 except AttributeError as err:
                     if "no such child: Error" in str(err):
-                        result.append("<Nothing> Nothing returned, but no error.")
+                        result.append(NOTHING_RETURNED)
                         besapi_logger.info("Query did not return any results")
                     else:
                         besapi_logger.error("%s\n%s", err, rel_result.text)
@@ -288,39 +2227,64 @@ class BESConnection:
         rel_result_array = self.session_relevance_array(relevance, **kwargs)
         return "\n".join(rel_result_array)
 
-    def login(self):
-        """do login"""
-        if bool(self.last_connected):
-            duration_obj = datetime.datetime.now() - self.last_connected
-            duration_minutes = duration_obj / datetime.timedelta(minutes=1)
+    def needs_login(self):
+        """check if login() would contact the server to login or refresh"""
+        if self.last_connected is None or self.session_expires is None:
+            return True
+        return datetime.datetime.now() >= self.session_expires - SESSION_REFRESH_MARGIN
+
+    def login(self, force=False):
+        """do login, unless the session is far enough from expiring"""
+        if not force and not self.needs_login():
+            return True
+
+        if self.last_connected is not None:
             besapi_logger.info(
-                "Connection Time: `%s` - Duration: %d minutes",
+                "Refreshing Login to prevent timeout. Connection Time: `%s`",
                 self.last_connected,
-                duration_minutes,
             )
-            # default timeout is 5 minutes
-            # I'm not sure if this is required
-            # or if 'requests' would handle this automatically anyway
-            if int(duration_minutes) > 3:
-                besapi_logger.info("Refreshing Login to prevent timeout.")
-                self.last_connected = None
-
-        if not bool(self.last_connected):
-            result_login = self.get("login")
-            if not result_login.request.status_code == 200:
-                result_login.request.raise_for_status()
-            if result_login.request.status_code == 200:
-                # set time of connection
-                self.last_connected = datetime.datetime.now()
-
-        # This doesn't work until urllib3 is updated to a future version:
-        # if self.connected():
-        #     self.session.mount(self.url("upload"), HTTPAdapterBiggerBlocksize())
+
+        response = self.request("get", "login", retry_login=False)
+        response.raise_for_status()
+        if response.status_code != 200:
+            self.last_connected = None
+            self.session_expires = None
+        else:
+            self.logins += 1
 
         return bool(self.last_connected)
 
+    def start_keepalive(self, interval=30):
+        """refresh the login from a background thread
+
+        Long running jobs then never stop to login again part way
+        through. interval in seconds should be less than
+        SESSION_REFRESH_MARGIN. Stopped by `stop_keepalive` or `logout`.
+        """
+        self.stop_keepalive()
+        self._keepalive_stop = threading.Event()
+        self._keepalive_thread = threading.Thread(
+            target=_keepalive,
+            args=(weakref.ref(self), self._keepalive_stop, interval),
+            name="besapi-keepalive",
+            daemon=True,
+        )
+        self._keepalive_thread.start()
+
+    def stop_keepalive(self):
+        """stop the background login refresh"""
+        if self._keepalive_thread is not None:
+            self._keepalive_stop.set()
+            # the last reference can be dropped by the keep-alive thread itself
+            if self._keepalive_thread is not threading.current_thread():
+                self._keepalive_thread.join()
+            self._keepalive_thread = None
+
     def logout(self):
         """clear session and close it"""
+        self.stop_keepalive()
+        self.last_connected = None
+        self.session_expires = None
         self.session.cookies.clear()
         self.session.close()
 
@@ -351,8 +2315,13 @@ class BESConnection:
                     return site_path
                 else:
                     # check site exists first
-                    site_result = self.get(f"site/{site_path}")
-                    if site_result.request.status_code != 200:
+                    def lookup():
+                        status_code = self.get(f"site/{site_path}").request.status_code
+                        # only remember the answer if the server gave one
+                        return status_code, status_code in (200, 404)
+
+                    site_status = self._resolve("sites", site_path, lookup)
+                    if site_status != 200:
                         besapi_logger.info("Site `%s` does not exist", site_path)
                         if not raise_error:
                             return None
@@ -409,9 +2378,15 @@ class BESConnection:
     def get_user(self, user_name):
         """get a user"""
 
-        result_users = self.get(f"operator/{user_name}")
+        def lookup():
+            result_users = self.get(f"operator/{user_name}")
+            if result_users and "Operator does not exist" not in str(result_users):
+                return result_users, True
+            # only remember that it doesn't exist if the server said so
+            return None, result_users.request.status_code < 500
 
-        if result_users and "Operator does not exist" not in str(result_users):
+        result_users = self._resolve("operators", user_name, lookup)
+        if result_users is not None:
             return result_users
 
         besapi_logger.info("User `%s` Not Found!", user_name)
@@ -434,14 +2409,23 @@ class BESConnection:
         """get computer group resource URI"""
 
         site_path = self.get_current_site_path(site_path)
-        result_groups = self.get(f"computergroups/{site_path}")
 
-        for group in result_groups.besobj.ComputerGroup:
-            if group_name == str(group.Name):
-                besapi_logger.info(
-                    "Found Group With Resource: %s", group.attrib["Resource"]
-                )
-                return group
+        def lookup():
+            # the groups in the site by name, so one listing finds them all
+            result_groups = self.get(f"computergroups/{site_path}")
+            if result_groups.besobj is None:
+                return {}, False
+            groups = {}
+            for group in result_groups.besobj.iterchildren("ComputerGroup"):
+                groups.setdefault(str(group.Name), group)
+            return groups, True
+
+        group = self._resolve("groups", site_path, lookup).get(group_name)
+        if group is not None:
+            besapi_logger.info(
+                "Found Group With Resource: %s", group.attrib["Resource"]
+            )
+            return group
 
         besapi_logger.info("Group `%s` Not Found!", group_name)
 
@@ -461,12 +2445,25 @@ class BESConnection:
 
         _ = self.post(f"computergroups/{site_path}", etree.tostring(xml_parsed))
 
-        return self.get_computergroup(site_path, new_group_name)
+        return self.get_computergroup(new_group_name, site_path)
 
-    def upload(self, file_path, file_name=None):
+    def upload(
+        self,
+        file_path,
+        file_name=None,
+        dedupe=False,
+        upload_index=None,
+        verify_on_server=True,
+    ):
         """
         upload a single file
         https://developer.bigfix.com/rest-api/api/upload.html
+
+        If dedupe, the file is hashed and looked up in the upload_index,
+        an UploadIndex which defaults to UPLOAD_INDEX_PATH. If this root
+        server already has the same content under the same name, the
+        recorded upload result is returned without sending the file.
+        If verify_on_server, the recorded file URL is checked first.
         """
         if not os.access(file_path, os.R_OK):
             besapi_logger.error(file_path, "is not readable")
@@ -476,10 +2473,60 @@ class BESConnection:
         if not file_name:
             file_name = os.path.basename(file_path)
 
+        if dedupe:
+            if upload_index is None:
+                upload_index = UploadIndex()
+            file_sha1, file_sha256, file_size = hash_file(file_path)
+            index_key = UploadIndex.key(self.rootserver, file_sha256, file_name)
+            index_entry = upload_index.get(index_key)
+            if index_entry and (
+                not verify_on_server or self.upload_exists(index_entry["url"])
+            ):
+                besapi_logger.info("Skipping upload of existing `%s`", file_name)
+                return self.recorded_upload_result(index_entry["result"])
+            if index_entry:
+                upload_index.remove(index_key)
+
         # Example Header::  Content-Disposition: attachment; filename="file.xml"
         headers = {"Content-Disposition": f'attachment; filename="{file_name}"'}
         with open(file_path, "rb") as f:
-            return self.post(self.url("upload"), data=f, headers=headers)
+            result_upload = self.post(self.url("upload"), data=f, headers=headers)
+
+        if dedupe and result_upload.request.status_code == 200:
+            file_upload = result_upload.besobj.FileUpload
+            # only record it if the server got the same content we hashed
+            if (
+                str(file_upload.SHA256).lower() == file_sha256
+                and str(file_upload.SHA1).lower() == file_sha1
+                and int(file_upload.Size) == file_size
+            ):
+                upload_index.set(
+                    index_key,
+                    {"url": str(file_upload.URL), "result": result_upload.text},
+                )
+
+        return result_upload
+
+    def upload_exists(self, file_url):
+        """check if the root server still has an uploaded file"""
+        try:
+            return self.session.head(file_url, verify=self.verify).status_code == 200
+        except requests.exceptions.RequestException as err:
+            besapi_logger.info("Could not check upload `%s`: %s", file_url, err)
+            return False
+
+    def recorded_upload_result(self, result_text):
+        """make a RESTResult from a recorded upload response"""
+        response = requests.models.Response()
+        response.status_code = 200
+        response.url = self.url("upload")
+        response.headers["content-type"] = "application/xml"
+        response.encoding = "utf-8"
+        # pylint: disable=protected-access
+        response._content = result_text.encode("utf-8")
+        result = self.rest_result(response)
+        result.from_cache = True
+        return result
 
     def parse_upload_result_to_prefetch(
         self, result_upload, use_localhost=True, use_https=True
@@ -509,7 +2556,7 @@ class BESConnection:
         # Get Specific Content
         content = None
         try:
-            content = self.get(resource_url.replace("http://", "https://"))
+            content = self.get(self.resource_url(resource_url))
         except PermissionError as err:
             logging.error("Could not export item:")
             logging.error(err)
@@ -583,38 +2630,275 @@ class BESConnection:
          - https://localhost:52311/api/content_type/site_type/site/id
         """
 
-        # Get Specific Content
-        content = self.get_content_by_resource(content_resource)
-        if not content:
-            besapi_logger.warning("Content not found")
+        if not os.path.exists(export_folder):
+            os.makedirs(export_folder)
+
+        # Stream Specific Content to disk, the name comes from its Title
+        temp_file, temp_path = open_part_file(export_folder)
+        temp_file.close()
+        try:
+            try:
+                self.get_to_file(self.resource_url(content_resource), temp_path)
+            except PermissionError as err:
+                besapi_logger.error("Could not export item:\n%s", err)
+                besapi_logger.warning("Content not found")
+                return None
+            content_type_tag, item_title = bes_type_and_title(temp_path)
+            if item_title is None:
+                raise ValueError(f"Item `{content_resource}` has no Title to name it")
+
+            item_id = int(content_resource.split("/")[-1])
+            item_folder = export_folder
+            if include_item_type_folder:
+                item_folder = export_folder + "%s" % sanitize_txt(content_type_tag)
+            # print(item_folder)
+            if not os.path.exists(item_folder):
+                os.makedirs(item_folder)
+            item_path = item_folder + "/%s.bes" % sanitize_txt(
+                item_title[:name_trim],
+            )
+            if include_item_id:
+                item_path = item_folder + "/%s-%s.bes" % sanitize_txt(
+                    item_id,
+                    item_title[:name_trim],
+                )
+            item_path = item_path.replace("//", "/")
+            os.replace(temp_path, item_path)
+            return item_path
+        finally:
+            # only still there if the export failed
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def list_site_export_items(
+        self,
+        site_path=None,
+        export_folder="./",
+        name_trim=100,
+        verbose=False,
+        include_site_folder=True,
+        include_item_ids=True,
+    ):
+        """list the contents of a site along with the file path to export each to
+
+        returns a list of dicts in site listing order, or None if the site
+        contents could not be listed.
+        """
+        site_path = self.get_current_site_path(site_path)
+        export_items = self.list_site_items(site_path, verbose)
+        if export_items is None:
             return None
 
-        # get first tag in XML that is the Type
-        content_type_tag = list(content.besobj.__dict__.keys())[0]
-        item_id = int(content_resource.split("/")[-1])
-        item = content.besobj[content_type_tag]
-        # print(item.__dict__.keys())
-        item_folder = export_folder
-        if include_item_type_folder:
-            item_folder = export_folder + "%s" % sanitize_txt(content_type_tag)
-        # print(item_folder)
-        if not os.path.exists(item_folder):
-            os.makedirs(item_folder)
-        item_path = item_folder + "/%s.bes" % sanitize_txt(
-            item.Title.text[:name_trim],
-        )
-        if include_item_id:
-            item_path = item_folder + "/%s-%s.bes" % sanitize_txt(
-                item_id,
-                item.Title.text[:name_trim],
+        print("Archiving %d items from %s..." % (len(export_items), site_path))
+
+        for item in export_items:
+            if verbose:
+                print(
+                    "{%s} (%s) [%s] %s - %s    "
+                    % (
+                        site_path,
+                        item["type"],
+                        item["id"],
+                        item["name"],
+                        item["last_modified"],
+                    )
+                )
+
+            item_path = export_folder + "%s/%s/%s-%s.bes" % sanitize_txt(
+                site_path,
+                item["type"],
+                item["id"],
+                item["name"][:name_trim],
             )
-        item_path = item_path.replace("//", "/")
-        with open(
-            item_path,
-            "wb",
-        ) as bes_file:
-            bes_file.write(content.text.encode("utf-8"))
-        return item_path
+            if not include_item_ids:
+                item_path = export_folder + "%s/%s/%s.bes" % sanitize_txt(
+                    site_path,
+                    item["type"],
+                    item["name"][:name_trim],
+                )
+            if not include_site_folder:
+                item_path = export_folder + "%s/%s-%s.bes" % sanitize_txt(
+                    item["type"],
+                    item["id"],
+                    item["name"][:name_trim],
+                )
+                if not include_item_ids:
+                    item_path = export_folder + "%s/%s.bes" % sanitize_txt(
+                        item["type"],
+                        item["name"][:name_trim],
+                    )
+
+            item["path"] = item_path
+
+        return export_items
+
+    def list_site_items(self, site_path=None, verbose=False):
+        """list the contents of a site
+
+        returns a list of dicts of site_path, type, id, name, resource
+        and last_modified in site listing order, or None if the site
+        contents could not be listed.
+        """
+        site_path = self.get_current_site_path(site_path)
+        content = self.get("site/" + site_path + "/content")
+        if verbose:
+            print(content)
+        if content.request.status_code != 200:
+            return None
+
+        return [
+            {
+                "site_path": site_path,
+                "type": item.tag,
+                "id": int(item.findtext("ID")),
+                "name": item.findtext("Name"),
+                "resource": item.get("Resource"),
+                "last_modified": item.get("LastModified"),
+            }
+            for item in content.xmlroot.iterchildren(tag=etree.Element)
+        ]
+
+    def export_item_to_file(self, resource_url, item_path):
+        """stream a single content item by resource to item_path"""
+        return self.get_to_file(self.resource_url(resource_url), item_path)
+
+    def export_items_to_files(self, export_items, max_workers=1):
+        """export items from `list_site_export_items` to their file paths
+
+        Up to max_workers items are fetched and written at once over this
+        connection's session. Keep max_workers at or below the connection
+        pool size, see `configure_transport`. An item that fails does not stop the
+        others, instead it is returned as a (resource, exception) tuple.
+        The returned errors are in the order the items were given.
+        """
+        # when items map to the same file, the last one wins, same as if
+        # they were written one by one, so the output does not depend on
+        # which worker finishes first:
+        item_paths = {}
+        for index, item in enumerate(export_items):
+            item_paths[item["path"]] = index
+        export_items = [
+            item
+            for index, item in enumerate(export_items)
+            if item_paths[item["path"]] == index
+        ]
+
+        for item in export_items:
+            item_folder = os.path.dirname(item["path"])
+            if item_folder and not os.path.exists(item_folder):
+                os.makedirs(item_folder)
+
+        def export_item(item):
+            try:
+                self.export_item_to_file(item["resource"], item["path"])
+            except Exception as err:  # pylint: disable=broad-except
+                besapi_logger.error("Could not export `%s`: %s", item["resource"], err)
+                return (item["resource"], err)
+            return None
+
+        if max_workers and max_workers > 1:
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_workers
+            ) as executor:
+                results = list(executor.map(export_item, export_items))
+        else:
+            results = [export_item(item) for item in export_items]
+
+        return [result for result in results if result is not None]
+
+    def export_items_incremental(
+        self,
+        export_items,
+        export_folder="./",
+        site_paths=None,
+        max_workers=1,
+        remove_deleted=False,
+    ):
+        """export only the items that are new or changed since the last export
+
+        A manifest of each item's id, resource, LastModified and file path
+        is kept in the export folder. Items whose LastModified and file
+        path match the manifest, with the file still on disk, are skipped.
+
+        Items in the manifest from site_paths that are no longer listed
+        were removed from the server. If remove_deleted, their files are
+        deleted, otherwise they are flagged as removed in the manifest.
+
+        returns a list of (resource, exception) for items that failed
+        """
+        export_folder = export_folder if export_folder else "./"
+        manifest = read_export_manifest(export_folder)
+        if site_paths is None:
+            site_paths = {item["site_path"] for item in export_items}
+
+        def relative_path(item_path):
+            return os.path.relpath(item_path, export_folder)
+
+        def manifest_file(entry):
+            return os.path.join(export_folder, entry["path"])
+
+        changed_items = []
+        for item in export_items:
+            entry = manifest.get(item["resource"])
+            if (
+                entry is None
+                or entry.get("removed")
+                or entry["last_modified"] != item["last_modified"]
+                or entry["path"] != relative_path(item["path"])
+                or not os.path.exists(item["path"])
+            ):
+                changed_items.append(item)
+
+        print(
+            "Exporting %d new or changed of %d items..."
+            % (len(changed_items), len(export_items))
+        )
+        errors = self.export_items_to_files(changed_items, max_workers)
+
+        listed_items = {item["resource"] for item in export_items}
+        listed_paths = {relative_path(item["path"]) for item in export_items}
+        failed_items = {resource for resource, _ in errors}
+
+        def remove_old_file(entry):
+            # only remove a file if no currently listed item uses it
+            if entry["path"] not in listed_paths and os.path.exists(
+                manifest_file(entry)
+            ):
+                os.remove(manifest_file(entry))
+
+        for resource, entry in list(manifest.items()):
+            if resource in listed_items or entry["site_path"] not in site_paths:
+                continue
+            if remove_deleted:
+                besapi_logger.info("Removing deleted item `%s`", entry["path"])
+                remove_old_file(entry)
+                del manifest[resource]
+            elif not entry.get("removed"):
+                besapi_logger.warning("Item was deleted `%s`", entry["path"])
+                entry["removed"] = True
+
+        for item in changed_items:
+            if item["resource"] in failed_items:
+                # keep the old entry so it is tried again next time
+                continue
+            entry = manifest.get(item["resource"])
+            if (
+                remove_deleted
+                and entry
+                and entry["path"] != relative_path(item["path"])
+            ):
+                remove_old_file(entry)
+            manifest[item["resource"]] = {
+                "id": item["id"],
+                "site_path": item["site_path"],
+                "resource": item["resource"],
+                "last_modified": item["last_modified"],
+                "path": relative_path(item["path"]),
+            }
+
+        write_export_manifest(manifest, export_folder)
+
+        return errors
 
     def export_site_contents(
         self,
@@ -624,96 +2908,81 @@ class BESConnection:
         verbose=False,
         include_site_folder=True,
         include_item_ids=True,
+        max_workers=1,
+        incremental=False,
+        remove_deleted=False,
     ):
         """export contents of site
         Originally here:
         - https://gist.github.com/jgstew/1b2da12af59b71c9f88a
         - https://bigfix.me/fixlet/details/21282
+
+        If incremental, only new or changed items are exported,
+        see `export_items_incremental`.
+        returns a list of (resource, exception) for items that failed
         """
-        site_path = self.get_current_site_path(site_path)
         if verbose:
             print("export_site_contents()")
-        # Iterate Over All Site Content
-        content = self.get("site/" + site_path + "/content")
-        if verbose:
-            print(content)
-        if content.request.status_code == 200:
-            print(
-                "Archiving %d items from %s..." % (content().countchildren(), site_path)
-            )
-
-            for item in content().iterchildren():
-                if verbose:
-                    print(
-                        "{%s} (%s) [%s] %s - %s    "
-                        % (
-                            site_path,
-                            item.tag,
-                            item.ID,
-                            item.Name.text,
-                            item.attrib["LastModified"],
-                        )
-                    )
-
-                # Get Specific Content
-                content = self.get_content_by_resource(item.attrib["Resource"])
+        site_path = self.get_current_site_path(site_path)
+        export_items = self.list_site_export_items(
+            site_path,
+            export_folder,
+            name_trim,
+            verbose,
+            include_site_folder,
+            include_item_ids,
+        )
+        if export_items is None:
+            return []
 
-                if not content:
-                    continue
+        if incremental:
+            return self.export_items_incremental(
+                export_items, export_folder, {site_path}, max_workers, remove_deleted
+            )
 
-                # Write Content to Disk
-                item_folder = export_folder + "%s/%s" % sanitize_txt(
-                    site_path, item.tag
-                )
-                if not include_site_folder:
-                    item_folder = export_folder + "%s" % sanitize_txt(item.tag)
-                if not os.path.exists(item_folder):
-                    os.makedirs(item_folder)
-
-                item_path = export_folder + "%s/%s/%s-%s.bes" % sanitize_txt(
-                    site_path,
-                    item.tag,
-                    item.ID,
-                    item.Name.text[:name_trim],
-                )
-                if not include_item_ids:
-                    item_path = export_folder + "%s/%s/%s.bes" % sanitize_txt(
-                        site_path,
-                        item.tag,
-                        item.Name.text[:name_trim],
-                    )
-                if not include_site_folder:
-                    item_path = export_folder + "%s/%s-%s.bes" % sanitize_txt(
-                        item.tag,
-                        item.ID,
-                        item.Name.text[:name_trim],
-                    )
-                    if not include_item_ids:
-                        item_path = export_folder + "%s/%s.bes" % sanitize_txt(
-                            item.tag,
-                            item.Name.text[:name_trim],
-                        )
-                with open(
-                    item_path,
-                    "wb",
-                ) as bes_file:
-                    bes_file.write(content.text.encode("utf-8"))
+        return self.export_items_to_files(export_items, max_workers)
 
     def export_all_sites(
-        self, include_external=False, export_folder="./", name_trim=70, verbose=False
+        self,
+        include_external=False,
+        export_folder="./",
+        name_trim=70,
+        verbose=False,
+        max_workers=1,
+        incremental=False,
+        remove_deleted=False,
     ):
-        """export all bigfix sites to a folder"""
+        """export all bigfix sites to a folder
+
+        Items from all sites share one pool of max_workers workers.
+        If incremental, only new or changed items are exported,
+        see `export_items_incremental`.
+        returns a list of (resource, exception) for items that failed
+        """
         results_sites = self.get("sites")
         if verbose:
             print(results_sites)
+        export_items = []
+        # only sites that were listed can have items detected as removed
+        listed_sites = set()
         if results_sites.request.status_code == 200:
             for item in results_sites().iterchildren():
                 site_path = item.attrib["Resource"].split("/api/site/", 1)[1]
                 if include_external or "external/" not in site_path:
                     print("Exporting Site:", site_path)
-                    self.export_site_contents(
+                    site_items = self.list_site_export_items(
                         site_path, export_folder, name_trim, verbose
                     )
+                    if site_items is not None:
+                        listed_sites.add(site_path)
+                        export_items.extend(site_items)
+
+        if incremental:
+            return self.export_items_incremental(
+                export_items, export_folder, listed_sites, max_workers, remove_deleted
+            )
+
+        return self.export_items_to_files(export_items, max_workers)
 
     __call__ = login
     # https://stackoverflow.com/q/40536821/861745
@@ -723,9 +2992,20 @@ class BESConnection:
 class RESTResult:
     """BigFix REST API Result Abstraction Class"""
 
-    def __init__(self, request):
+    def __init__(self, request, validation=VALIDATION_CONTENT_TYPE, metrics=None):
+        if validation not in VALIDATION_POLICIES or validation == VALIDATION_SAMPLE:
+            # sampling is decided per result by `BESConnection.rest_result`
+            raise ValueError(f"Validation policy `{validation}` is not supported")
         self.request = request
-        self.text = request.text
+        self.validation = validation
+        # a RequestMetrics to record parse and validation time in
+        self.metrics = metrics
+        # set on copies of results returned from a cache
+        self.from_cache = False
+        self._valid = None
+        self._text = None
+        self._content = None
+        self._xmlroot = None
         self._besxml = None
         self._besobj = None
         self._besdict = None
@@ -747,21 +3027,27 @@ class RESTResult:
         except AttributeError as err:
             besapi_logger.warning("Error (expected during tests) %s", err)
 
-        if (
-            "content-type" in request.headers
-            and request.headers["content-type"] == "application/xml"
-        ):
-            self.valid = True
-        elif type(request.text) is str and self.validate_xsd(
-            request.text.encode("utf-8")
-        ):
-            self.valid = True
-        else:
-            if self.validate_xsd(request.text):
-                self.valid = True
-            else:
-                # print("WARNING: response appears invalid")
-                self.valid = False
+        if validation in (VALIDATION_ALWAYS, VALIDATION_CONTENT_TYPE):
+            # decide validity up front, other policies wait until it is used
+            self._valid = self.check_valid()
+
+    def cache_copy(self):
+        """copy of a cached result that can be changed without changing the cache
+
+        The response bytes are shared, but the copy parses them again into
+        its own tree rather than sharing `besobj` and the others.
+        """
+        result = copy.copy(self)
+        result.request = copy.copy(self.request)
+        result.request.headers = copy.copy(self.request.headers)
+        result.from_cache = True
+        result._text = None
+        result._xmlroot = None
+        result._besxml = None
+        result._besobj = None
+        result._besdict = None
+        result._besjson = None
+        return result
 
     def __str__(self):
         if self.valid:
@@ -776,11 +3062,85 @@ class RESTResult:
     def __call__(self):
         return self.besobj
 
+    @property
+    def valid(self):
+        """property for whether the response is usable xml, per validation policy"""
+        if self._valid is None:
+            self._valid = self.check_valid()
+
+        return self._valid
+
+    @valid.setter
+    def valid(self, value):
+        self._valid = value
+
+    def check_valid(self):
+        """check if the response is valid according to the validation policy"""
+        if self.validation in (VALIDATION_CONTENT_TYPE, VALIDATION_LAZY) and (
+            "content-type" in self.request.headers
+            and self.request.headers["content-type"] == "application/xml"
+        ):
+            return True
+
+        if self.xmlroot is None:
+            # print("WARNING: response appears invalid")
+            return False
+
+        if self.validation == VALIDATION_NEVER:
+            return True
+
+        start_time = time.perf_counter()
+        valid = self.validate_xsd(self.xmlroot)
+        if self.metrics is not None:
+            self.metrics.record_timing("validate", time.perf_counter() - start_time)
+        return valid
+
+    @property
+    def text(self):
+        """property for the response text, only decoded if used"""
+        if self._text is None:
+            self._text = self.request.text
+
+        return self._text
+
+    @text.setter
+    def text(self, value):
+        self._text = value
+
+    @property
+    def content(self):
+        """property for the raw response bytes"""
+        if self._content is None:
+            content = getattr(self.request, "content", None)
+            if content is None:
+                content = self.text.encode("utf-8")
+            self._content = content
+
+        return self._content
+
+    @property
+    def xmlroot(self):
+        """property for the response parsed once from bytes, None if not xml
+
+        This single tree backs `besxml`, `besobj`, `besdict` and validation.
+        """
+        if self._xmlroot is None:
+            start_time = time.perf_counter()
+            try:
+                self._xmlroot = self.objectify_text(self.content)
+            except BaseException:
+                # don't try to parse it again
+                self._xmlroot = False
+            if self.metrics is not None:
+                self.metrics.record_timing("parse", time.perf_counter() - start_time)
+
+        return self._xmlroot if self._xmlroot is not False else None
+
     @property
     def besxml(self):
         """property for parsed xml representation"""
         if self.valid and self._besxml is None:
-            self._besxml = self.xmlparse_text(self.text)
+            self._besxml = self.xmlparse_text(self.xmlroot)
 
         return self._besxml
 
@@ -788,7 +3148,7 @@ class RESTResult:
     def besobj(self):
         """property for xml object representation"""
         if self.valid and self._besobj is None:
-            self._besobj = self.objectify_text(self.text)
+            self._besobj = self.xmlroot
 
         return self._besobj
 
@@ -797,7 +3157,7 @@ class RESTResult:
         """property for python dict representation"""
         if self._besdict is None:
             if self.valid:
-                self._besdict = elem2dict(etree.fromstring(self.besxml))
+                self._besdict = elem2dict(self.xmlroot)
             else:
                 self._besdict = {"text": str(self)}
 
@@ -807,29 +3167,40 @@ class RESTResult:
     def besjson(self):
         """property for json representation"""
         if self._besjson is None:
-            self._besjson = json.dumps(self.besdict, indent=2)
+            self._besjson = "".join(self.iter_json())
 
         return self._besjson
 
+    def iter_json(self, indent=2):
+        """yield the json representation in pieces, see `iter_json`"""
+        if self._besdict is None and self.valid:
+            return iter_json(self.xmlroot, indent)
+        return iter([json.dumps(self.besdict, indent=indent)])
+
+    def write_json(self, json_file, indent=2):
+        """write the json representation to a file or file path, without
+        building it all in memory first"""
+        if isinstance(json_file, (str, os.PathLike)):
+            with open(json_file, "w", encoding="utf-8") as json_file_obj:
+                return self.write_json(json_file_obj, indent)
+        for chunk in self.iter_json(indent):
+            json_file.write(chunk)
+        return json_file
+
     def validate_xsd(self, doc):
         """validate results using XML XSDs"""
-        try:
-            xmldoc = etree.fromstring(doc)
-        except BaseException:
-            return False
+        if type(doc) is str:
+            doc = doc.encode("utf-8")
 
-        for xsd in ["BES.xsd", "BESAPI.xsd", "BESActionSettings.xsd"]:
-            xmlschema_doc = etree.parse(resource_filename(__name__, "schemas/%s" % xsd))
-
-            # one schema may throw an error while another will validate
+        if type(doc) is bytes:
             try:
-                xmlschema = etree.XMLSchema(xmlschema_doc)
-            except etree.XMLSchemaParseError as err:
-                # this should only error if the XSD itself is malformed
-                besapi_logger.error("ERROR with `%s`: %s", xsd, err)
-                raise err
+                doc = etree.fromstring(doc)
+            except BaseException:
+                return False
 
-            if xmlschema.validate(xmldoc):
+        for xmlschema in get_xsd_schemas():
+            # one schema may not validate while another will
+            if xmlschema.validate(doc):
                 return True
 
         return False
@@ -850,7 +3221,226 @@ class RESTResult:
         else:
             root_xml = text
 
-        return objectify.fromstring(root_xml)
+        from lxml import objectify  # pylint: disable=import-outside-toplevel
+
+        return objectify.fromstring(root_xml, get_xml_parser())
+
+
+class AsyncBESConnection:
+    """asyncio BigFix RESTAPI connection abstraction class
+
+    Mirrors BESConnection with awaitable methods that return the same
+    RESTResult objects. Requests run on a pool of max_connections
+    threads sharing one session whose connection pool is the same size,
+    so at most max_connections requests are in flight at once.
+    """
+
+    # how many answers session_relevance_iter fetches per executor call
+    iter_batch_size = 1000
+
+    def __init__(
+        self, username, password, rootserver, verify=False, max_connections=10, **kwargs
+    ):
+        self.max_connections = max_connections
+        self.connection = None
+        # arguments for BESConnection, which logs in when created
+        self._connection_args = (username, password, rootserver, verify)
+        kwargs.setdefault("pool_maxsize", max_connections)
+        self._connection_kwargs = kwargs
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_connections
+        )
+        self._login_lock = None
+
+    @classmethod
+    def from_connection(cls, connection, max_connections=10):
+        """wrap an existing BESConnection
+
+        The wrapper uses a copy of the connection with its own session and
+        a connection pool of max_connections, logged in with the same
+        cookies and sharing its caches, metrics and hooks. The connection
+        given is not changed, and is not logged out by `close`.
+        """
+        # pylint: disable=protected-access
+        async_conn = cls(
+            connection.username,
+            None,
+            connection.rootserver,
+            connection.verify,
+            max_connections,
+        )
+        wrapped = copy.copy(connection)
+        wrapped.session = requests.Session()
+        wrapped.session.auth = connection.session.auth
+        wrapped.session.headers.update(connection.session.headers)
+        wrapped.session.cookies.update(connection.session.cookies)
+        wrapped._login_lock = threading.Lock()
+        wrapped._keepalive_thread = None
+        wrapped._keepalive_stop = None
+        transport_options = dict(connection.transport_options)
+        transport_options["pool_maxsize"] = max_connections
+        wrapped.configure_transport(**transport_options)
+        async_conn.connection = wrapped
+        return async_conn
+
+    def __repr__(self):
+        """object representation"""
+        return f"Object: besapi.AsyncBESConnection( username={self._connection_args[0]}, rootserver={self._connection_args[2]} )"
+
+    async def __aenter__(self):
+        await self.login()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def _in_executor(self, func, *args, **kwargs):
+        """run a blocking call on this connection's thread pool"""
+        import asyncio  # pylint: disable=import-outside-toplevel
+
+        return await asyncio.get_event_loop().run_in_executor(
+            self._executor, functools.partial(func, *args, **kwargs)
+        )
+
+    async def login(self):
+        """do login, only one task at a time will login or refresh the login"""
+        if self._login_lock is None:
+            import asyncio  # pylint: disable=import-outside-toplevel
+
+            # created here so it belongs to the running event loop
+            self._login_lock = asyncio.Lock()
+
+        async with self._login_lock:
+            # another task may have logged in while waiting on the lock
+            if self.connection is None:
+                self.connection = await self._in_executor(
+                    BESConnection, *self._connection_args, **self._connection_kwargs
+                )
+                return bool(self.connection.last_connected)
+            return await self._in_executor(self.connection.login)
+
+    async def _call(self, method_name, *args, **kwargs):
+        """login if needed, then run a BESConnection method on the thread pool"""
+        if self.connection is None or self.connection.needs_login():
+            await self.login()
+        return await self._in_executor(
+            getattr(self.connection, method_name), *args, **kwargs
+        )
+
+    async def close(self):
+        """logout and stop the thread pool"""
+        if self.connection is not None:
+            await self._in_executor(self.connection.logout)
+        self._executor.shutdown(wait=False)
+
+    async def logout(self):
+        """clear session and close it"""
+        if self.connection is not None:
+            await self._in_executor(self.connection.logout)
+
+    async def get(self, path="help", **kwargs):
+        """HTTP GET request"""
+        return await self._call("get", path, **kwargs)
+
+    async def post(self, path, data, **kwargs):
+        """HTTP POST request"""
+        return await self._call("post", path, data, **kwargs)
+
+    async def put(self, path, data, **kwargs):
+        """HTTP PUT request"""
+        return await self._call("put", path, data, **kwargs)
+
+    async def delete(self, path, **kwargs):
+        """HTTP DELETE request"""
+        return await self._call("delete", path, **kwargs)
+
+    async def session_relevance_xml(self, relevance, **kwargs):
+        """Get Session Relevance Results XML"""
+        return await self._call("session_relevance_xml", relevance, **kwargs)
+
+    async def session_relevance_array(self, relevance, **kwargs):
+        """Get Session Relevance Results array"""
+        return await self._call("session_relevance_array", relevance, **kwargs)
+
+    async def session_relevance_string(self, relevance, **kwargs):
+        """Get Session Relevance Results string"""
+        return await self._call("session_relevance_string", relevance, **kwargs)
+
+    async def session_relevance_typed(self, relevance, columnar=False, **kwargs):
+        """Get Session Relevance Results converted to python types"""
+        return await self._call(
+            "session_relevance_typed", relevance, columnar, **kwargs
+        )
+
+    async def session_relevance_iter(self, relevance, **kwargs):
+        """Get Session Relevance Results one at a time as they are received"""
+        if self.connection is None or self.connection.needs_login():
+            await self.login()
+        answers = self.connection.session_relevance_iter(relevance, **kwargs)
+
+        def next_batch():
+            return list(itertools.islice(answers, self.iter_batch_size))
+
+        try:
+            while True:
+                batch = await self._in_executor(next_batch)
+                if not batch:
+                    break
+                for answer in batch:
+                    yield answer
+        finally:
+            await self._in_executor(answers.close)
+
+    async def session_relevance_many(self, queries, **kwargs):
+        """Get Session Relevance Results for many queries at once
+
+        returns the same as BESConnection.session_relevance_many, with
+        queries limited by max_connections instead of max_workers.
+        """
+        import asyncio  # pylint: disable=import-outside-toplevel
+
+        start_time = time.perf_counter()
+        results = await asyncio.gather(
+            *(
+                self._call("session_relevance_many", [relevance], 1, **kwargs)
+                for relevance in queries
+            )
+        )
+        results = [result["results"][0] for result in results]
+        num_errors = sum(1 for result in results if result["error"] is not None)
+        return {
+            "results": results,
+            "num_errors": num_errors,
+            "elapsed": time.perf_counter() - start_time,
+        }
+
+    async def upload(self, file_path, file_name=None, **kwargs):
+        """upload a single file, see BESConnection.upload for dedupe options"""
+        return await self._call("upload", file_path, file_name, **kwargs)
+
+    def parse_upload_result_to_prefetch(self, result_upload, *args, **kwargs):
+        """take a rest response from an upload and parse into prefetch"""
+        return self.connection.parse_upload_result_to_prefetch(
+            result_upload, *args, **kwargs
+        )
+
+    async def get_content_by_resource(self, resource_url):
+        """get a single content item by resource"""
+        return await self._call("get_content_by_resource", resource_url)
+
+    async def export_item_by_resource(self, content_resource, *args, **kwargs):
+        """export a single item by resource"""
+        return await self._call(
+            "export_item_by_resource", content_resource, *args, **kwargs
+        )
+
+    async def export_site_contents(self, site_path=None, *args, **kwargs):
+        """export contents of site, see BESConnection.export_site_contents"""
+        return await self._call("export_site_contents", site_path, *args, **kwargs)
+
+    async def export_all_sites(self, *args, **kwargs):
+        """export all bigfix sites to a folder, see BESConnection.export_all_sites"""
+        return await self._call("export_all_sites", *args, **kwargs)
 
 
 def main():
@@ -9,10 +9,17 @@ Maintained by James Stewart since 2021
 Simple command line interface for the BES (BigFix) REST API.
 """
 
+import concurrent.futures
+import csv
+import datetime
 import getpass
+import itertools
+import json
 import logging
 import os
 import site
+import sys
+import time
 from configparser import ConfigParser as SafeConfigParser
 
 import requests.exceptions
@@ -31,6 +38,312 @@ except ImportError:
 from besapi import __version__
 
 
+def split_max_workers(statement, default=1):
+    """split an optional trailing max_workers number off of command arguments"""
+    args = str(statement if statement else "").strip()
+    max_workers = default
+    if args:
+        parts = args.rsplit(" ", 1)
+        if parts[-1].isdigit():
+            max_workers = int(parts[-1])
+            args = parts[0] if len(parts) > 1 else ""
+
+    return args.strip(), max_workers
+
+
+# output formats for `query --format`
+QUERY_FORMATS = ("csv", "jsonl", "tsv")
+
+
+def split_query_options(text):
+    """split leading `--format fmt` and `--out path` options off of a query
+
+    returns a dict of the options found, and the rest of the text
+    """
+    options = {}
+    text = text.strip()
+    while text.startswith("--"):
+        parts = text.split(None, 2)
+        if len(parts) < 2 or parts[0] not in ("--format", "--out"):
+            break
+        options[parts[0][2:]] = parts[1]
+        text = parts[2] if len(parts) > 2 else ""
+    return options, text
+
+
+def write_query_rows(answers, out_file, output_format="csv", progress=None):
+    """write session relevance answers to a file as they arrive, a row each
+
+    Tuples are split into columns, see RelevanceColumns.flatten. csv and
+    tsv rows are written with the csv module, jsonl rows as JSON arrays.
+    progress, if given, is called with the number of rows written so far
+    every 100000 rows.
+
+    returns the number of rows written
+    """
+    if output_format == "jsonl":
+
+        def write_row(row):
+            out_file.write(json.dumps(row) + "\n")
+
+    else:
+        write_row = csv.writer(
+            out_file, dialect="excel-tab" if output_format == "tsv" else "excel"
+        ).writerow
+
+    num_rows = 0
+    for answer in answers:
+        write_row(besapi.RelevanceColumns.flatten(answer))
+        num_rows += 1
+        if progress and num_rows % 100000 == 0:
+            progress(num_rows)
+    return num_rows
+
+
+def result_value(rest_result):
+    """get a RESTResult as a value that can be written as JSON"""
+    if rest_result.valid:
+        return rest_result.besdict
+    return rest_result.text
+
+
+def batch_query(bes_conn, args):
+    """batch command: session relevance answers"""
+    result = bes_conn.session_relevance_many([args], 1)["results"][0]
+    if result["error"] is not None:
+        raise ValueError(result["error"])
+    return result["answers"]
+
+
+def batch_get(bes_conn, args):
+    """batch command: GET a REST API path"""
+    if "/api/" in args:
+        args = args.split("/api/", 1)[1]
+    rest_result = bes_conn.get(args)
+    if rest_result.request.status_code >= 400:
+        raise ValueError(f"HTTP {rest_result.request.status_code}: {rest_result}")
+    return result_value(rest_result)
+
+
+def batch_export_site(bes_conn, args):
+    """batch command: export site contents to the current folder"""
+    site_path, max_workers = split_max_workers(args)
+    errors = bes_conn.export_site_contents(
+        site_path,
+        include_site_folder=False,
+        include_item_ids=False,
+        max_workers=max_workers,
+    )
+    if errors:
+        raise ValueError(
+            "; ".join(
+                f"Could not export `{resource}`: {err}" for resource, err in errors
+            )
+        )
+    return site_path
+
+
+def batch_export_item_by_resource(bes_conn, args):
+    """batch command: export a content item to the current folder"""
+    return bes_conn.export_item_by_resource(args)
+
+
+def batch_upload(bes_conn, args):
+    """batch command: upload a file, with its prefetch"""
+    if not os.access(args, os.R_OK):
+        raise ValueError(f"{args} is not a readable file")
+    upload_result = bes_conn.upload(args)
+    return {
+        "upload": result_value(upload_result),
+        "prefetch": bes_conn.parse_upload_result_to_prefetch(upload_result),
+    }
+
+
+# commands batch jobs can run: name: function(bes_conn, args) returning
+# a value for the JSON output, or raising an exception if the job failed
+BATCH_COMMANDS = {
+    "query": batch_query,
+    "get": batch_get,
+    "export_site": batch_export_site,
+    "export_item_by_resource": batch_export_item_by_resource,
+    "upload": batch_upload,
+}
+
+
+def load_batch_jobs(batch_path):
+    """load batch jobs from a JSON, YAML or script file
+
+    JSON and YAML files hold a list of jobs, or a dict with a `jobs`
+    list. A job is a command line string like `query names of bes sites`,
+    or a dict of `command`, `args`, an optional `id` and an optional
+    `after` list of ids of jobs that must finish first.
+
+    A script file has one command line per line. Jobs run concurrently,
+    a `wait` line makes the jobs after it wait for all the jobs before it.
+    Blank lines and lines starting with `#` are ignored.
+
+    returns a list of dicts of id, command, args and after
+    """
+    with open(batch_path, "r", encoding="utf-8") as batch_file:
+        if batch_path.lower().endswith(".json"):
+            raw_jobs = json.load(batch_file)
+        elif batch_path.lower().endswith((".yaml", ".yml")):
+            try:
+                import yaml  # pylint: disable=import-outside-toplevel
+            except ImportError as err:
+                raise ValueError(
+                    "PyYAML is required for YAML batch files: pip install pyyaml"
+                ) from err
+            raw_jobs = yaml.safe_load(batch_file)
+        else:
+            raw_jobs = []
+            after = []
+            for line in batch_file:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                if line == "wait":
+                    after = [job["id"] for job in raw_jobs]
+                    continue
+                command, _, args = line.partition(" ")
+                raw_jobs.append(
+                    {
+                        "id": len(raw_jobs) + 1,
+                        "command": command,
+                        "args": args.strip(),
+                        "after": after,
+                    }
+                )
+
+    if isinstance(raw_jobs, dict):
+        raw_jobs = raw_jobs.get("jobs")
+    if not isinstance(raw_jobs, list):
+        raise ValueError(f"No list of jobs in batch file `{batch_path}`")
+
+    jobs = []
+    for number, raw_job in enumerate(raw_jobs, 1):
+        if isinstance(raw_job, str):
+            command, _, args = raw_job.strip().partition(" ")
+            raw_job = {"command": command, "args": args.strip()}
+        job = {
+            "id": raw_job.get("id", number),
+            "command": raw_job.get("command"),
+            "args": str(raw_job.get("args", "")),
+            "after": list(raw_job.get("after", [])),
+        }
+        if job["command"] not in BATCH_COMMANDS:
+            raise ValueError(
+                f"Unknown command `{job['command']}` in job {job['id']}, "
+                f"expected one of {list(BATCH_COMMANDS)}"
+            )
+        jobs.append(job)
+
+    ids = [job["id"] for job in jobs]
+    if len(set(ids)) != len(ids):
+        raise ValueError(f"Duplicate job ids in batch file `{batch_path}`")
+    for job in jobs:
+        for after_id in job["after"]:
+            if after_id not in ids:
+                raise ValueError(f"Job {job['id']} is after unknown job {after_id}")
+
+    # drop jobs that can run in order until none can, what is left is a cycle
+    ordered = set()
+    remaining = list(jobs)
+    while remaining:
+        ready = [
+            job
+            for job in remaining
+            if all(after_id in ordered for after_id in job["after"])
+        ]
+        if not ready:
+            raise ValueError(
+                "Jobs are after each other in a cycle: "
+                f"{[job['id'] for job in remaining]}"
+            )
+        ordered.update(job["id"] for job in ready)
+        remaining = [job for job in remaining if job["id"] not in ordered]
+
+    return jobs
+
+
+def run_batch(bes_conn, jobs, max_workers=4):
+    """run batch jobs concurrently over one connection
+
+    Jobs start as soon as the jobs they are after have finished, up to
+    max_workers at a time. A job after a job that failed is not run,
+    and fails.
+
+    yields a result dict for each job as it finishes, of id, command,
+    args, ok, the result or the error, and elapsed seconds
+    """
+    pending = list(jobs)
+    finished = {}
+    running = {}
+
+    def run_job(job):
+        start_time = time.perf_counter()
+        job_result = {
+            "id": job["id"],
+            "command": job["command"],
+            "args": job["args"],
+            "ok": False,
+        }
+        try:
+            job_result["result"] = BATCH_COMMANDS[job["command"]](bes_conn, job["args"])
+            job_result["ok"] = True
+        except Exception as err:  # pylint: disable=broad-except
+            job_result["error"] = f"{type(err).__name__}: {err}"
+        job_result["elapsed"] = time.perf_counter() - start_time
+        return job_result
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for job in list(pending):
+                if not all(after_id in finished for after_id in job["after"]):
+                    continue
+                pending.remove(job)
+                failed = [
+                    after_id for after_id in job["after"] if not finished[after_id]
+                ]
+                if failed:
+                    finished[job["id"]] = False
+                    yield {
+                        "id": job["id"],
+                        "command": job["command"],
+                        "args": job["args"],
+                        "ok": False,
+                        "error": f"Not run, jobs it is after failed: {failed}",
+                        "elapsed": 0.0,
+                    }
+                else:
+                    running[executor.submit(run_job, job)] = job
+
+            if not running:
+                # nothing running and nothing can start, the rest never can
+                stuck_ids = [job["id"] for job in pending]
+                for job in pending:
+                    finished[job["id"]] = False
+                    yield {
+                        "id": job["id"],
+                        "command": job["command"],
+                        "args": job["args"],
+                        "ok": False,
+                        "error": "Not run, jobs it is after never finish: "
+                        f"{[a for a in job['after'] if a in stuck_ids]}",
+                        "elapsed": 0.0,
+                    }
+                pending = []
+                continue
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                job = running.pop(future)
+                job_result = future.result()
+                finished[job["id"]] = job_result["ok"]
+                yield job_result
+
+
 class BESCLInterface(Cmd):
     """BigFix command-line interface processor."""
 
@@ -42,6 +355,14 @@ class BESCLInterface(Cmd):
         self.BES_ROOT_SERVER = None
         self.BES_USER_NAME = None
         self.BES_PASSWORD = None
+        # optional cassette file to record responses to, or replay them from
+        self.BES_CASSETTE = None
+        # `record` or `replay`
+        self.BES_CASSETTE_MODE = None
+        # where the local index of site content is kept, see `index`
+        self.BES_CONTENT_INDEX = None
+        # False when run without a terminal, like `--batch`, so never prompt
+        self.interactive = True
         self.bes_conn = None
         # set default config file path
         self.conf_path = os.path.expanduser("~/.besapi.conf")
@@ -127,6 +448,20 @@ class BESCLInterface(Cmd):
             except BaseException:
                 self.BES_PASSWORD = None
 
+            self.BES_CASSETTE = self.CONFPARSER.get(
+                "besapi", "BES_CASSETTE", fallback=None
+            )
+            if self.BES_CASSETTE:
+                self.BES_CASSETTE = os.path.expanduser(self.BES_CASSETTE)
+            self.BES_CASSETTE_MODE = self.CONFPARSER.get(
+                "besapi", "BES_CASSETTE_MODE", fallback="record"
+            )
+            self.BES_CONTENT_INDEX = self.CONFPARSER.get(
+                "besapi", "BES_CONTENT_INDEX", fallback=None
+            )
+            if self.BES_CONTENT_INDEX:
+                self.BES_CONTENT_INDEX = os.path.expanduser(self.BES_CONTENT_INDEX)
+
         if self.BES_USER_NAME and self.BES_PASSWORD and self.BES_ROOT_SERVER:
             self.pfeedback(" - all values loaded from config file - ")
             # self.do_ls()
@@ -177,7 +512,11 @@ class BESCLInterface(Cmd):
         if self.BES_USER_NAME and self.BES_ROOT_SERVER and self.BES_PASSWORD:
             try:
                 self.bes_conn = besapi.BESConnection(
-                    self.BES_USER_NAME, self.BES_PASSWORD, self.BES_ROOT_SERVER
+                    self.BES_USER_NAME,
+                    self.BES_PASSWORD,
+                    self.BES_ROOT_SERVER,
+                    cassette=self.BES_CASSETTE,
+                    replay=self.BES_CASSETTE_MODE == "replay",
                 )
                 if self.bes_conn.login():
                     self.pfeedback("Login Successful!")
@@ -301,7 +640,11 @@ class BESCLInterface(Cmd):
         return self.do_quit("")
 
     def do_query(self, statement):
-        """Get Session Relevance Results"""
+        """Get Session Relevance Results
+        usage: query [--format csv|jsonl|tsv] [--out file_path] relevance
+
+        With --format or --out, rows are streamed as they are received,
+        in csv if --out has no format or extension given."""
         if not self.bes_conn:
             self.do_login()
         if not self.bes_conn:
@@ -310,11 +653,290 @@ class BESCLInterface(Cmd):
             if statement.raw:
                 # get everything after `query `
                 rel_text = statement.raw.split(" ", 1)[1]
+                options, rel_text = split_query_options(rel_text)
+                if options:
+                    self.query_to_file(rel_text, **options)
+                    return
                 self.pfeedback(f"Q: {rel_text}")
+                cache_hits = (
+                    self.bes_conn.relevance_cache.hits
+                    if self.bes_conn.relevance_cache is not None
+                    else 0
+                )
                 rel_result = self.bes_conn.session_relevance_string(rel_text)
-                self.pfeedback("A: ")
+                if (
+                    self.bes_conn.relevance_cache is not None
+                    and self.bes_conn.relevance_cache.hits > cache_hits
+                ):
+                    self.pfeedback("A (from cache): ")
+                else:
+                    self.pfeedback("A: ")
                 self.poutput(rel_result)
 
+    def query_to_file(self, rel_text, format=None, out=None):
+        """stream session relevance results to a file or the output"""
+        # pylint: disable=redefined-builtin
+        output_format = format
+        if output_format is None:
+            extension = os.path.splitext(out)[1].lstrip(".").lower()
+            output_format = extension if extension in QUERY_FORMATS else "csv"
+        if output_format not in QUERY_FORMATS:
+            self.perror(f"Unknown format `{output_format}`, use one of {QUERY_FORMATS}")
+            self.num_errors += 1
+            return
+
+        self.pfeedback(f"Q: {rel_text}")
+        start_time = time.perf_counter()
+        answers = self.bes_conn.session_relevance_iter(rel_text)
+        first_answer = next(answers, None)
+        if type(first_answer) is str and first_answer.startswith("ERROR: "):
+            self.perror(first_answer)
+            self.num_errors += 1
+            return
+        if first_answer == besapi.NOTHING_RETURNED:
+            # no results, not a row
+            answers = iter(())
+        elif first_answer is not None:
+            answers = itertools.chain((first_answer,), answers)
+
+        # an error can also come after some answers, it is never a row
+        errors = []
+
+        def checked(answers):
+            for answer in answers:
+                if type(answer) is str and answer.startswith("ERROR: "):
+                    errors.append(answer)
+                else:
+                    yield answer
+
+        def progress(num_rows):
+            self.pfeedback(
+                f"{num_rows} rows, {time.perf_counter() - start_time:.2f} seconds"
+            )
+
+        if out:
+            with open(out, "w", newline="", encoding="utf-8") as out_file:
+                num_rows = write_query_rows(
+                    checked(answers), out_file, output_format, progress
+                )
+        else:
+            num_rows = write_query_rows(checked(answers), self.stdout, output_format)
+        for error in errors:
+            self.perror(error)
+            self.num_errors += 1
+        self.pfeedback(
+            f"{num_rows} rows{' to ' + out if out else ''} in "
+            f"{time.perf_counter() - start_time:.2f} seconds"
+        )
+
+    def do_query_cache(self, statement=None):
+        """cache session relevance query results
+        usage: query_cache on [ttl_seconds] | off | clear | stats"""
+        if not self.bes_conn:
+            self.poutput("ERROR: can't cache queries without login")
+            return
+        args = str(statement if statement else "").split()
+        setting = args[0].lower() if args else "stats"
+        if setting == "on":
+            ttl = int(args[1]) if len(args) > 1 else 60
+            self.bes_conn.enable_relevance_cache(ttl=ttl)
+            self.pfeedback(f"Query cache enabled, ttl {ttl} seconds")
+        elif setting == "off":
+            self.bes_conn.disable_relevance_cache()
+            self.pfeedback("Query cache disabled")
+        elif setting == "clear":
+            self.bes_conn.invalidate_relevance_cache()
+            self.pfeedback("Query cache cleared")
+        elif self.bes_conn.relevance_cache is None:
+            self.poutput("Query cache is disabled")
+        else:
+            self.poutput(f"Query cache: {self.bes_conn.relevance_cache.stats()}")
+
+    def do_cassette(self, statement=None):
+        """record responses to a cassette file, or replay them from one
+        usage: cassette record path | replay path | off"""
+        args = str(statement if statement else "").split(maxsplit=1)
+        mode = args[0].lower() if args else ""
+        if mode in ("record", "replay") and len(args) == 2:
+            self.BES_CASSETTE = os.path.expanduser(args[1])
+            self.BES_CASSETTE_MODE = mode
+        elif mode == "off":
+            self.BES_CASSETTE = None
+        else:
+            self.poutput("usage: cassette record path | replay path | off")
+            return
+
+        if self.bes_conn:
+            transport_options = dict(self.bes_conn.transport_options)
+            transport_options["cassette"] = self.BES_CASSETTE
+            transport_options["replay"] = self.BES_CASSETTE_MODE == "replay"
+            self.bes_conn.configure_transport(**transport_options)
+        if self.BES_CASSETTE:
+            self.pfeedback(f"Cassette {self.BES_CASSETTE_MODE}: {self.BES_CASSETTE}")
+        else:
+            self.pfeedback("Cassette off")
+
+    def do_stats(self, statement=None):
+        """show request statistics for this session
+        usage: stats [reset]"""
+        if not self.bes_conn:
+            self.poutput("ERROR: no request statistics without login")
+            return
+        if str(statement if statement else "").strip().lower() == "reset":
+            self.bes_conn.metrics.reset()
+            self.pfeedback("Request statistics reset")
+            return
+        stats = self.bes_conn.stats()
+        for endpoint, endpoint_stats in sorted(stats["endpoints"].items()):
+            self.poutput(
+                f"{endpoint}: {endpoint_stats['count']} requests, "
+                f"mean {endpoint_stats['mean_seconds'] * 1000:.1f} ms, "
+                f"max {endpoint_stats['max_seconds'] * 1000:.1f} ms, "
+                f"{endpoint_stats['bytes']} bytes, "
+                f"{endpoint_stats['retries']} retries, "
+                f"status codes {endpoint_stats['status_codes']}"
+            )
+            latency = {
+                bucket: count
+                for bucket, count in endpoint_stats["latency_ms"].items()
+                if count
+            }
+            self.poutput(f"  latency ms: {latency}")
+        for name, timing in sorted(stats["timings"].items()):
+            self.poutput(
+                f"{name}: {timing['count']} times, "
+                f"{timing['total_seconds'] * 1000:.1f} ms total"
+            )
+        self.poutput(f"Login retries: {stats['login_retries']}")
+        if "relevance_cache" in stats:
+            self.poutput(f"Query cache: {stats['relevance_cache']}")
+
+    complete_batch = Cmd.path_complete
+
+    def do_batch(self, statement):
+        """run jobs from a JSON, YAML or script file concurrently,
+        outputting a JSON line for each job as it finishes
+        usage: batch file_path [max_workers]"""
+        batch_path, max_workers = split_max_workers(statement, default=4)
+        if not batch_path:
+            self.poutput("usage: batch file_path [max_workers]")
+            return
+        try:
+            jobs = load_batch_jobs(batch_path)
+        except (OSError, ValueError) as err:
+            self.perror(err)
+            self.num_errors += 1
+            return
+        if not self.bes_conn and (
+            self.interactive
+            or (self.BES_USER_NAME and self.BES_ROOT_SERVER and self.BES_PASSWORD)
+        ):
+            self.do_login()
+        if not self.bes_conn:
+            self.perror(
+                "ERROR: can't run batch without login, set BES_USER_NAME, "
+                "BES_ROOT_SERVER and BES_PASSWORD in the config file"
+            )
+            self.num_errors += 1
+            return
+
+        start_time = time.perf_counter()
+        num_errors = 0
+        for job_result in run_batch(self.bes_conn, jobs, max_workers):
+            if not job_result["ok"]:
+                num_errors += 1
+            self.poutput(json.dumps(job_result, default=str))
+        self.num_errors += num_errors
+        self.pfeedback(
+            f"Batch: {len(jobs)} jobs, {num_errors} errors, "
+            f"{time.perf_counter() - start_time:.2f} seconds"
+        )
+
+    def content_index(self):
+        """get the connection's content index, enabling it if needed"""
+        if self.bes_conn.content_index is None:
+            if self.BES_CONTENT_INDEX:
+                self.bes_conn.enable_content_index(self.BES_CONTENT_INDEX)
+            else:
+                self.bes_conn.enable_content_index()
+        return self.bes_conn.content_index
+
+    def output_items(self, items, start_time):
+        """output indexed content items, one per line"""
+        for item in items:
+            self.poutput(
+                f"{{{item['site_path']}}} ({item['type']}) [{item['id']}] "
+                f"{item['name']} - {item['last_modified']}"
+            )
+        self.pfeedback(
+            f"{len(items)} items in {(time.perf_counter() - start_time) * 1000:.1f} ms"
+        )
+
+    def do_index(self, statement=None):
+        """refresh or show the local index of site content
+        usage: index refresh [site_path] [max_workers] | stats"""
+        if not self.bes_conn:
+            self.poutput("ERROR: can't use the content index without login")
+            return
+        args, max_workers = split_max_workers(statement)
+        setting, _, site_path = args.partition(" ")
+        if setting.lower() == "refresh":
+            summary = self.bes_conn.refresh_content_index(
+                [site_path.strip()] if site_path.strip() else None,
+                max_workers=max_workers,
+            )
+            for failed_site, err in summary["errors"]:
+                self.perror(f"Could not index `{failed_site}`: {err}")
+            self.num_errors += len(summary["errors"])
+            self.poutput(
+                f"Indexed {summary['sites']} sites: {summary['added']} added, "
+                f"{summary['changed']} changed, {summary['removed']} removed, "
+                f"{summary['unchanged']} unchanged"
+            )
+            return
+
+        sites = self.content_index().sites(self.bes_conn.rootserver)
+        for indexed_site, site_info in sites.items():
+            self.poutput(
+                f"{indexed_site}: {site_info['items']} items, "
+                f"refreshed {site_info['refreshed']:%Y-%m-%d %H:%M:%S}"
+            )
+        if not sites:
+            self.poutput("Nothing indexed yet, use: index refresh")
+
+    def do_search(self, statement=None):
+        """find indexed content by name, `*` matches any text
+        usage: search name"""
+        name = str(statement if statement else "").strip()
+        if not self.bes_conn or not name:
+            self.poutput("usage: search name, after login and `index refresh`")
+            return
+        if "*" not in name:
+            name = f"*{name}*"
+        start_time = time.perf_counter()
+        self.content_index()
+        self.output_items(self.bes_conn.find_content(name, limit=None), start_time)
+
+    def do_changed(self, statement=None):
+        """list indexed content changed since a date, or in the last days
+        usage: changed 2022-03-01 | changed 7"""
+        since = str(statement if statement else "").strip()
+        if not self.bes_conn or not since:
+            self.poutput("usage: changed date | days, after login and `index refresh`")
+            return
+        try:
+            if since.isdigit():
+                since = datetime.datetime.now() - datetime.timedelta(days=int(since))
+            else:
+                since = datetime.datetime.strptime(since, "%Y-%m-%d")
+        except ValueError as err:
+            self.perror(err)
+            self.num_errors += 1
+            return
+        start_time = time.perf_counter()
+        self.content_index()
+        self.output_items(self.bes_conn.content_changed_since(since), start_time)
+
     def do_version(self, statement=None):
         """output version of besapi"""
         self.poutput(f"besapi version: {__version__}")
@@ -349,15 +971,31 @@ class BESCLInterface(Cmd):
         """export content itemb to current folder"""
         print(self.bes_conn.export_item_by_resource(statement))
 
-    def do_export_site(self, site_path):
-        """export site contents to current folder"""
-        self.bes_conn.export_site_contents(
-            site_path, verbose=True, include_site_folder=False, include_item_ids=False
+    def do_export_site(self, statement):
+        """export site contents to current folder
+        usage: export_site site_path [max_workers]"""
+        site_path, max_workers = split_max_workers(statement)
+        errors = self.bes_conn.export_site_contents(
+            site_path,
+            verbose=True,
+            include_site_folder=False,
+            include_item_ids=False,
+            max_workers=max_workers,
         )
+        self.report_export_errors(errors)
 
     def do_export_all_sites(self, statement=None):
-        """export site contents to current folder"""
-        self.bes_conn.export_all_sites(verbose=False)
+        """export site contents to current folder
+        usage: export_all_sites [max_workers]"""
+        _, max_workers = split_max_workers(statement)
+        errors = self.bes_conn.export_all_sites(verbose=False, max_workers=max_workers)
+        self.report_export_errors(errors)
+
+    def report_export_errors(self, errors):
+        """output and count errors from exporting items"""
+        for resource, err in errors:
+            self.perror(f"Could not export `{resource}`: {err}")
+        self.num_errors += len(errors)
 
     complete_upload = Cmd.path_complete
 
@@ -409,6 +1047,16 @@ class BESCLInterface(Cmd):
 
 def main():
     """Run the command loop if invoked"""
+    # configured here, not when besapi is imported, so importing it
+    # leaves logging alone for the applications that use it
+    logging.basicConfig(level=logging.WARNING)
+    # non-interactive: bescli --batch file_path [max_workers]
+    if len(sys.argv) > 2 and sys.argv[1] == "--batch":
+        bigfix_cli = BESCLInterface(allow_cli_args=False)
+        bigfix_cli.interactive = False
+        bigfix_cli.do_batch(" ".join(sys.argv[2:]))
+        # exit codes over 255 wrap around, so don't let errors look like success
+        sys.exit(min(bigfix_cli.num_errors, 255))
     BESCLInterface().cmdloop()
 
 
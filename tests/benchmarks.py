@@ -0,0 +1,539 @@
+#!/usr/bin/env python
+"""
+Benchmark besapi
+
+Offline benchmarks against a mock server, no BigFix server required.
+Run with: python tests/benchmarks.py
+
+Save results with --save results.jsonl to compare a later run or release
+against them with --compare results.jsonl, results for releases are kept
+in tests/benchmark_results.jsonl
+"""
+
+import argparse
+import concurrent.futures
+import datetime
+import io
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import timeit
+import tracemalloc
+
+# check for --test_pip arg
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--test_pip", help="to benchmark package installed with pip", action="store_true"
+)
+parser.add_argument("--number", help="iterations per benchmark", type=int, default=200)
+parser.add_argument("--save", help="append results to this json lines file")
+parser.add_argument(
+    "--compare", help="compare results to the last run saved in this json lines file"
+)
+args = parser.parse_args()
+
+if not args.test_pip:
+    # add module folder to import paths for testing local src
+    sys.path.append(
+        os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+    )
+    # reverse the order so we make sure to get the local src module
+    sys.path.reverse()
+
+import besapi
+import bescli
+import mock_server
+
+# name: (value, unit) of each result, in the order they were measured
+results = {}
+
+# most milliseconds importing each module should take, with bytecode cached
+IMPORT_TIME_BUDGET_MS = {"besapi": 200, "bescli": 500}
+
+
+class RequestResult(object):
+    """minimal stand in for a requests.Response"""
+
+    def __init__(self, text, headers=None):
+        self.text = text
+        self.content = text.encode("utf-8")
+        self.headers = headers if headers else {}
+        self.status_code = 200
+        self.url = "https://localhost:52311/api/sites"
+
+
+def sites_xml(num_sites=20):
+    """build a BESAPI sites listing like `GET /api/sites` returns"""
+    sites = "".join(
+        f'<CustomSite Resource="https://localhost:52311/api/site/custom/Site{i}">'
+        f"<Name>Site{i}</Name></CustomSite>\n"
+        for i in range(num_sites)
+    )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<BESAPI xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+        'xsi:noNamespaceSchemaLocation="BESAPI.xsd">\n'
+        f"{sites}</BESAPI>\n"
+    )
+
+
+def record(name, value, unit):
+    """print and keep a benchmark result"""
+    results[name] = (value, unit)
+    print(f"{name:<40} {value:10.3f} {unit}")
+
+
+def report(name, seconds, number):
+    """record the milliseconds per operation of a timed benchmark"""
+    record(name, seconds / number * 1000, "ms/op")
+
+
+def best_of(func, number, repeat=3):
+    """fastest total seconds of `repeat` runs of `number` calls, to reduce noise"""
+    return min(timeit.repeat(func, number=number, repeat=repeat))
+
+
+def import_time(module, repeat=5):
+    """fastest milliseconds to import a module in a fresh python, from -X importtime"""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    # cache bytecode outside the source tree, so only the first import compiles
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    env["PYTHONPYCACHEPREFIX"] = os.path.join(tempfile.gettempdir(), "besapi-pycache")
+    times = []
+    for _ in range(repeat + 1):
+        stderr = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            env=env,
+            check=True,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        ).stderr
+        # the last line is the module itself: self us | cumulative us | name
+        times.append(int(stderr.strip().splitlines()[-1].split("|")[1]) / 1000)
+    return min(times[1:])
+
+
+def bench_import_time():
+    """time to import each module, against IMPORT_TIME_BUDGET_MS"""
+    if sys.version_info < (3, 7):
+        # -X importtime is new in python 3.7
+        return
+    for module, budget in IMPORT_TIME_BUDGET_MS.items():
+        milliseconds = import_time(module)
+        record(f"import {module}", milliseconds, "ms")
+        if milliseconds > budget:
+            print(f"  over the {budget} ms budget for importing {module}!")
+
+
+def bench_validate_response(number):
+    """cost of building a RESTResult that must be validated against the XSDs"""
+    request_result = RequestResult(sites_xml())
+    seconds = best_of(
+        lambda: besapi.besapi.RESTResult(request_result).besobj, number=number
+    )
+    report("RESTResult xsd validation + besobj", seconds, number)
+
+
+def computers_xml(num_computers=20000):
+    """build a BESAPI computers listing like `GET /api/computers` returns"""
+    computers = "".join(
+        f'<Computer Resource="https://localhost:52311/api/computer/{i}">'
+        f"<LastReportTime>Tue, 01 Mar 2022 12:00:00 +0000</LastReportTime>"
+        f"<ID>{i}</ID></Computer>\n"
+        for i in range(num_computers)
+    )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<BESAPI xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+        'xsi:noNamespaceSchemaLocation="BESAPI.xsd">\n'
+        f"{computers}</BESAPI>\n"
+    )
+
+
+def bench_large_response(number):
+    """cost of using every representation of a multi-megabyte response"""
+    request_result = RequestResult(computers_xml())
+
+    size_mb = len(request_result.content) / 1024 / 1024
+
+    def parse_result():
+        rest_result = besapi.besapi.RESTResult(request_result)
+        return rest_result.besxml, rest_result.besobj
+
+    def use_result():
+        rest_result = besapi.besapi.RESTResult(request_result)
+        return rest_result.besxml, rest_result.besobj, rest_result.besdict
+
+    seconds = best_of(parse_result, number)
+    report(f"RESTResult {size_mb:.1f} MB besxml + besobj", seconds, number)
+
+    seconds = best_of(use_result, number)
+    report(f"RESTResult {size_mb:.1f} MB all views", seconds, number)
+
+    for name, func in (("besxml + besobj", parse_result), ("all views", use_result)):
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        record(f"  peak python memory {name}", peak / 1024 / 1024, "MB")
+
+
+def recursive_elem2dict(node):
+    """how elem2dict worked before it was iterative, for comparison"""
+    result = {}
+    for element in node.iterchildren():
+        key = element.tag.split("}")[1] if "}" in element.tag else element.tag
+        if element.text and element.text.strip():
+            value = element.text
+        else:
+            value = recursive_elem2dict(element)
+        if key in result:
+            if type(result[key]) is list:
+                result[key].append(value)
+            else:
+                tempvalue = result[key].copy()
+                result[key] = [tempvalue, value]
+        else:
+            result[key] = value
+    return result
+
+
+def bench_besjson():
+    """time and peak memory to convert a large response to a dict and to JSON"""
+    root = besapi.besapi.RESTResult(RequestResult(computers_xml(100000))).xmlroot
+
+    for name, func in (
+        ("recursive elem2dict", lambda: recursive_elem2dict(root)),
+        ("iterative elem2dict", lambda: besapi.besapi.elem2dict(root)),
+        ("json.dumps", lambda: json.dumps(besapi.besapi.elem2dict(root), indent=2)),
+        (
+            "iter_json to file",
+            lambda: io.StringIO().writelines(besapi.besapi.iter_json(root, 2)),
+        ),
+    ):
+        report(f"100k computers {name}", best_of(func, 1), 1)
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        record(f"  peak python memory {name}", peak / 1024 / 1024, "MB")
+
+
+def query_tuples_xml(num_answers=100000):
+    """build typed session relevance results of (id, locked, free space) tuples"""
+    answers = b"".join(
+        b'<Tuple><Answer type="integer">%d</Answer>'
+        b'<Answer type="boolean">False</Answer>'
+        b'<Answer type="integer">%d</Answer></Tuple>' % (i, i * 1024)
+        for i in range(num_answers)
+    )
+    return b"<BESAPI><Query><Result>" + answers + b"</Result></Query></BESAPI>"
+
+
+def bench_typed_relevance():
+    """time and memory to parse typed results as tuples or as columns"""
+    xml = query_tuples_xml()
+
+    def parse_text():
+        return list(besapi.besapi.iter_relevance_answers(io.BytesIO(xml)))
+
+    def parse_tuples():
+        return list(besapi.besapi.iter_relevance_answers(io.BytesIO(xml), True))
+
+    def parse_columns():
+        return besapi.besapi.RelevanceColumns(
+            besapi.besapi.iter_relevance_answers(io.BytesIO(xml), True)
+        )
+
+    for name, func in (
+        ("text tuples", parse_text),
+        ("typed tuples", parse_tuples),
+        ("typed columns", parse_columns),
+    ):
+        report(f"relevance 100k {name}", best_of(func, 1), 1)
+        tracemalloc.start()
+        result = func()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del result
+        record(f"  memory held {name}", size / 1024 / 1024, "MB")
+
+
+def bench_upload(rootserver, size_mb=64):
+    """upload throughput with the default and a 1 MiB blocksize"""
+    with tempfile.NamedTemporaryFile() as upload_file:
+        upload_file.write(os.urandom(1024 * 1024) * size_mb)
+        upload_file.flush()
+        for blocksize in (None, 1024 * 1024):
+            conn = besapi.besapi.BESConnection(
+                "user", "pass", rootserver, upload_blocksize=blocksize
+            )
+            seconds = best_of(lambda: conn.upload(upload_file.name), 1)
+            record(f"upload blocksize {blocksize}", size_mb / seconds, "MB/s")
+
+
+def bench_concurrent_gets(rootserver, workers=16, number=100):
+    """GET throughput from one thread and from many sharing the pooled session"""
+    conn = besapi.besapi.BESConnection("user", "pass", rootserver, pool_maxsize=workers)
+    for num_threads in (1, workers):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+            seconds = best_of(
+                lambda: list(executor.map(lambda _: conn.get("sites"), range(number))),
+                1,
+            )
+        record(f"GET from {num_threads} threads", number / seconds, "req/s")
+
+
+def export_in_process(rootserver, streamed, rss_queue):
+    """export a large fixlet, sending the process peak RSS to the queue"""
+    conn = besapi.besapi.BESConnection("user", "pass", rootserver)
+    with tempfile.TemporaryDirectory() as export_folder:
+        if streamed:
+            conn.export_item_by_resource("fixlet/custom/Test/1", export_folder + "/")
+        else:
+            # how export_item_by_resource worked before it was streamed:
+            content = conn.get("fixlet/custom/Test/1")
+            with open(export_folder + "/Large_Fixlet.bes", "wb") as bes_file:
+                bes_file.write(content.text.encode("utf-8"))
+    rss_queue.put(peak_rss_mb())
+
+
+def peak_rss_mb():
+    """peak RSS of this process in MB, or None where it can't be measured
+
+    On linux VmHWM is used, ru_maxrss carries over the parent's peak
+    into a child process, even through exec.
+    """
+    try:
+        with open("/proc/self/status", "r", encoding="utf-8") as status_file:
+            for line in status_file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        # windows
+        return None
+    # ru_maxrss is KiB on linux, bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def bench_export_memory(rootserver):
+    """peak RSS exporting a large fixlet, each in a fresh process"""
+    # spawned, not forked, so the peak doesn't include this process's memory
+    spawn_context = multiprocessing.get_context("spawn")
+    for streamed in (False, True):
+        rss_queue = spawn_context.Queue()
+        export_process = spawn_context.Process(
+            target=export_in_process, args=(rootserver, streamed, rss_queue)
+        )
+        export_process.start()
+        peak_rss = rss_queue.get()
+        export_process.join()
+        if peak_rss is None:
+            print("peak RSS can't be measured on this platform")
+            return
+        record(
+            f"export 64 MB fixlet {'streamed' if streamed else 'in memory'}",
+            peak_rss,
+            "MB peak RSS",
+        )
+
+
+def bench_relevance_queries(rootserver):
+    """query every computer in one request, streamed, and in partitions"""
+    conn = besapi.besapi.BESConnection("user", "pass", rootserver)
+    relevance = "(id of it, name of it, last report time of it) of bes computers"
+    for name, func in (
+        ("xml", lambda: conn.session_relevance_xml(relevance).besobj),
+        ("iter", lambda: list(conn.session_relevance_iter(relevance))),
+        ("typed columns", lambda: conn.session_relevance_typed(relevance, True)),
+        (
+            "8 partitions",
+            lambda: list(conn.session_relevance_partitioned(relevance, 8)),
+        ),
+    ):
+        report(f"query all computers {name}", best_of(func, 1), 1)
+
+
+def bench_query_export(rootserver):
+    """time and peak memory to write every computer to a file, built or streamed"""
+    conn = besapi.besapi.BESConnection("user", "pass", rootserver)
+    relevance = "(id of it, name of it, last report time of it) of bes computers"
+
+    def in_memory(out_file):
+        # the whole response parsed and every row built, then written:
+        root = conn.session_relevance_xml(relevance).xmlroot
+        rows = [
+            besapi.besapi.relevance_tuple(elem) if elem.tag == "Tuple" else elem.text
+            for elem in root.iterfind("Query/Result/*")
+        ]
+        bescli.bescli.write_query_rows(rows, out_file, "csv")
+
+    def streamed(out_file):
+        bescli.bescli.write_query_rows(
+            conn.session_relevance_iter(relevance), out_file, "csv"
+        )
+
+    for name, func in (("in memory", in_memory), ("streamed", streamed)):
+        with tempfile.TemporaryFile("w+", newline="") as out_file:
+            report(f"query to file {name}", best_of(lambda: func(out_file), 1), 1)
+            tracemalloc.start()
+            func(out_file)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        record(f"  peak python memory {name}", peak / 1024 / 1024, "MB")
+
+
+def bench_content_index(rootserver):
+    """find an item by name in the site content listing, or in the local index"""
+    conn = besapi.besapi.BESConnection("user", "pass", rootserver)
+
+    def listing():
+        # how items were found before they were indexed:
+        return [
+            item
+            for item in conn.get("site/custom/Site0/content")().iterchildren()
+            if item.Name.text == "Task 42"
+        ]
+
+    with tempfile.TemporaryDirectory() as index_folder:
+        conn.enable_content_index(os.path.join(index_folder, "index.sqlite"))
+        report(
+            "content index refresh all sites",
+            best_of(conn.refresh_content_index, 1),
+            1,
+        )
+        report("find item in site listing", best_of(listing, 20), 20)
+        report(
+            "find item in content index",
+            best_of(lambda: conn.find_content("task 42", "custom/Site0"), 1000),
+            1000,
+        )
+        conn.content_index.close()
+
+
+def bench_resolver(rootserver, number=200):
+    """look up groups, operators and sites by name, uncached and cached"""
+    conn = besapi.besapi.BESConnection("user", "pass", rootserver)
+
+    def lookups():
+        for _ in range(number):
+            conn.get_computergroup("Group3", "custom/Site0")
+            conn.get_user("user")
+            conn.validate_site_path("custom/Site1")
+
+    report("resolve group, operator, site", best_of(lookups, 1), number)
+    conn.enable_resolver_cache()
+    report("  with resolver cache", best_of(lookups, 1), number)
+
+
+def bench_http_cache(rootserver, number=20):
+    """GET an unchanged 4 MB content item, and parse it, uncached and cached"""
+    conn = besapi.besapi.BESConnection("user", "pass", rootserver)
+
+    def get_item():
+        return conn.get("fixlet/custom/Site0/1").besobj
+
+    report("GET 4 MB item", best_of(get_item, number), number)
+    conn.enable_http_cache()
+    report("  with http cache", best_of(get_item, number), number)
+    record(
+        "  http cache MB saved",
+        conn.http_cache.bytes_saved / 1024 / 1024,
+        "MB",
+    )
+
+
+def bench_export_site(rootserver):
+    """export a site from one thread and from many"""
+    conn = besapi.besapi.BESConnection("user", "pass", rootserver)
+    for max_workers in (1, 8):
+        with tempfile.TemporaryDirectory() as export_folder:
+            report(
+                f"export site {max_workers} workers",
+                best_of(
+                    lambda: conn.export_site_contents(
+                        "custom/Site0", export_folder + "/", max_workers=max_workers
+                    ),
+                    1,
+                ),
+                1,
+            )
+
+
+def save_results(results_path):
+    """append this run's results to a json lines file"""
+    with open(results_path, "a", encoding="utf-8") as results_file:
+        results_file.write(
+            json.dumps(
+                {
+                    "version": besapi.__version__,
+                    "date": datetime.datetime.now().isoformat(timespec="seconds"),
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "results": results,
+                }
+            )
+            + "\n"
+        )
+
+
+def compare_results(results_path):
+    """print the change in each result since the last run saved to a file"""
+    with open(results_path, "r", encoding="utf-8") as results_file:
+        saved = json.loads(results_file.readlines()[-1])
+    print(f"\ncompared to besapi {saved['version']} on {saved['date']}:")
+    for name, (value, unit) in results.items():
+        if name in saved["results"] and saved["results"][name][0]:
+            saved_value = saved["results"][name][0]
+            change = (value - saved_value) / saved_value * 100
+            print(
+                f"{name:<40} {saved_value:10.3f} -> {value:10.3f} {unit} {change:+7.1f}%"
+            )
+
+
+if __name__ == "__main__":
+    print("besapi version: " + str(besapi.__version__))
+    bench_import_time()
+    bench_validate_response(args.number)
+    bench_large_response(max(1, args.number // 40))
+    bench_besjson()
+    bench_typed_relevance()
+    server, rootserver = mock_server.start_mock_server(
+        latency=0.02,
+        connect_latency=0.02,
+        answer_latency=0.00002,
+        num_computers=50000,
+        num_items=100,
+        hash_uploads=False,
+    )
+    bench_upload(rootserver)
+    bench_concurrent_gets(rootserver)
+    bench_relevance_queries(rootserver)
+    bench_query_export(rootserver)
+    bench_content_index(rootserver)
+    bench_resolver(rootserver)
+    bench_export_site(rootserver)
+    mock_server.stop_mock_server(server)
+    item_server, item_rootserver = mock_server.start_mock_server(
+        latency=0.02, connect_latency=0.02, item_size=4 * 1024 * 1024
+    )
+    bench_http_cache(item_rootserver)
+    mock_server.stop_mock_server(item_server)
+    large_item_server, large_item_rootserver = mock_server.start_mock_server(
+        item_size=64 * 1024 * 1024
+    )
+    bench_export_memory(large_item_rootserver)
+    mock_server.stop_mock_server(large_item_server)
+    if args.compare:
+        compare_results(args.compare)
+    if args.save:
+        save_results(args.save)
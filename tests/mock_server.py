@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+"""
+Mock BigFix REST API server
+
+Serves realistic responses for the parts of the REST API besapi uses, at
+configurable sizes and latencies, so tests and benchmarks can run
+without a BigFix root server.
+
+Run with: python tests/mock_server.py [port]
+"""
+
+import hashlib
+import http.server
+import multiprocessing
+import re
+import socketserver
+import sys
+import threading
+import time
+from urllib import parse
+
+LAST_MODIFIED = "Tue, 01 Mar 2022 12:00:00 +0000"
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """http.server.ThreadingHTTPServer, which is new in python 3.7"""
+
+    daemon_threads = True
+
+
+class MockBigFixHandler(http.server.BaseHTTPRequestHandler):
+    """request handler for a mock BigFix REST API
+
+    Class attributes are the settings, see `start_mock_server`.
+    """
+
+    # keep-alive, so connection pooling matters
+    protocol_version = "HTTP/1.1"
+    # headers and body are separate writes, don't let them wait on acks
+    disable_nagle_algorithm = True
+
+    # seconds each request waits, like a real server doing work
+    latency = 0.0
+    # seconds each new connection waits, like a TLS handshake to a remote server
+    connect_latency = 0.0
+    # seconds each answer to a query adds, like evaluating relevance
+    answer_latency = 0.0
+    num_sites = 5
+    # items in each site
+    num_items = 20
+    # bytes of script in each content item
+    item_size = 4096
+    num_computers = 1000
+    # computer groups in each site
+    num_groups = 10
+    # hash uploads like a real server, turn off to measure only the client
+    hash_uploads = True
+    # sha1 of files uploaded so far
+    uploads = set()
+    # names of computer groups created so far, by site path
+    groups = {}
+    # names of operators that exist
+    operators = {"user"}
+    # require the session cookie from /api/login, change the token to
+    # expire every session
+    require_session = False
+    session_token = "1"
+
+    def setup(self):
+        time.sleep(self.connect_latency)
+        super().setup()
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    @property
+    def base_url(self):
+        """url of this server, used in Resource attributes"""
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def send_body(self, body, status=200, content_type="application/xml", headers=()):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for header, value in headers:
+            self.send_header(header, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def send_cacheable(self, body):
+        """send a body with an ETag and Last-Modified, or 304 if it is unchanged"""
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if etag == self.headers.get("If-None-Match") or (
+            self.headers.get("If-None-Match") is None
+            and self.headers.get("If-Modified-Since") == LAST_MODIFIED
+        ):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", LAST_MODIFIED)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def iter_body(self):
+        remaining = int(self.headers.get("Content-Length", 0))
+        while remaining:
+            chunk = self.rfile.read(min(remaining, 1024 * 1024))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+    def authorized(self):
+        if not self.headers.get("Authorization", "").startswith("Basic "):
+            self.send_body("Login failed", status=401, content_type="text/plain")
+            return False
+        if (
+            self.require_session
+            and parse.urlsplit(self.path).path != "/api/login"
+            and f"session={self.session_token}" not in self.headers.get("Cookie", "")
+        ):
+            self.send_body("Session expired", status=401, content_type="text/plain")
+            return False
+        return True
+
+    def do_HEAD(self):
+        """check an uploaded file exists"""
+        match = re.match(r"/Uploads/(\w+)/", self.path)
+        if match and match.group(1) in self.uploads:
+            self.send_body(b"", content_type="application/octet-stream")
+        else:
+            self.send_body(b"", status=404, content_type="text/plain")
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        path = parse.urlsplit(self.path).path
+        if path == "/api/login":
+            self.send_body(
+                "ok",
+                content_type="text/plain",
+                headers=[("Set-Cookie", f"session={self.session_token}; Path=/")],
+            )
+            return
+
+        time.sleep(self.latency)
+        if path == "/api/sites":
+            self.send_body(sites_xml(self.base_url, self.num_sites))
+        elif re.match(r"/api/computergroups/", path):
+            site_path = path[len("/api/computergroups/") :]
+            self.send_body(
+                computergroups_xml(
+                    self.base_url,
+                    site_path,
+                    self.num_groups,
+                    self.groups.get(site_path, ()),
+                )
+            )
+        elif path.startswith("/api/operator/"):
+            operator_name = parse.unquote(path[len("/api/operator/") :])
+            if operator_name in self.operators:
+                self.send_body(
+                    besapi_xml(f"<Operator><Name>{operator_name}</Name></Operator>")
+                )
+            else:
+                self.send_body(
+                    "Operator does not exist", status=404, content_type="text/plain"
+                )
+        elif re.match(r"/api/site/[^/]+/Site(\d+)$", path):
+            site_number = int(path.rsplit("Site", 1)[1])
+            if site_number < self.num_sites:
+                self.send_body(sites_xml(self.base_url, 1))
+            else:
+                self.send_body("Site not found", status=404, content_type="text/plain")
+        elif re.match(r"/api/site/[^/]+/[^/]+/content$", path):
+            site_path = path[len("/api/site/") : -len("/content")]
+            self.send_cacheable(
+                site_content_xml(self.base_url, site_path, self.num_items)
+            )
+        elif re.match(r"/api/(fixlet|task|baseline|analysis)/", path):
+            item_type = path.split("/")[2]
+            item_id = path.rstrip("/").split("/")[-1]
+            self.send_cacheable(content_item_xml(item_type, item_id, self.item_size))
+        else:
+            self.send_body("Not found", status=404, content_type="text/plain")
+
+    def do_POST(self):
+        path = parse.urlsplit(self.path).path
+        if path == "/api/upload":
+            self.upload()
+            return
+        body = b"".join(self.iter_body())
+        if not self.authorized():
+            return
+        time.sleep(self.latency)
+        if path == "/api/query":
+            relevance = parse.unquote(body.decode("utf-8").split("relevance=", 1)[1])
+            answers = query_xml(relevance, self.num_computers)
+            time.sleep(self.answer_latency * answers.count(b"<Tuple>"))
+            self.send_body(answers)
+        elif path.startswith("/api/computergroups/"):
+            site_path = path[len("/api/computergroups/") :]
+            title = re.search(rb"<Title>([^<]*)</Title>", body).group(1).decode()
+            self.groups.setdefault(site_path, []).append(title)
+            self.send_body(
+                besapi_xml(f"<ComputerGroup><Name>{title}</Name></ComputerGroup>")
+            )
+        elif path == "/api/operators":
+            name = re.search(rb"<Name>([^<]*)</Name>", body).group(1).decode()
+            self.operators.add(name)
+            self.send_body(besapi_xml(f"<Operator><Name>{name}</Name></Operator>"))
+        else:
+            self.send_body("Not found", status=404, content_type="text/plain")
+
+    def upload(self):
+        """receive a file, hashing it as it is read"""
+        sha1 = hashlib.sha1()
+        sha256 = hashlib.sha256()
+        size = 0
+        for chunk in self.iter_body():
+            size += len(chunk)
+            if self.hash_uploads:
+                sha1.update(chunk)
+                sha256.update(chunk)
+        if not self.authorized():
+            return
+        time.sleep(self.latency)
+
+        match = re.search(r'filename="([^"]+)"', self.headers["Content-Disposition"])
+        file_name = match.group(1) if match else "upload"
+        self.uploads.add(sha1.hexdigest())
+        self.send_body(
+            "<BESAPI><FileUpload>"
+            f"<Name>{file_name}</Name><Size>{size}</Size>"
+            f"<URL>{self.base_url}/Uploads/{sha1.hexdigest()}/{file_name}.bfswd</URL>"
+            f"<SHA1>{sha1.hexdigest()}</SHA1><SHA256>{sha256.hexdigest()}</SHA256>"
+            "</FileUpload></BESAPI>"
+        )
+
+
+def besapi_xml(children):
+    """wrap elements in a BESAPI document"""
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<BESAPI xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+        'xsi:noNamespaceSchemaLocation="BESAPI.xsd">\n'
+        f"{children}</BESAPI>\n"
+    )
+
+
+def sites_xml(base_url, num_sites):
+    """build a sites listing like `GET /api/sites` returns"""
+    return besapi_xml(
+        "".join(
+            f'<CustomSite Resource="{base_url}/api/site/custom/Site{i}">'
+            f"<Name>Site{i}</Name></CustomSite>\n"
+            for i in range(num_sites)
+        )
+    )
+
+
+def computergroups_xml(base_url, site_path, num_groups, created_groups=()):
+    """build a computer group listing like `GET /api/computergroups/...` returns"""
+    group_names = [f"Group{i}" for i in range(num_groups)] + list(created_groups)
+    return besapi_xml(
+        "".join(
+            f'<ComputerGroup Resource="{base_url}/api/computergroup/{site_path}/'
+            f'{i + 1}"><Name>{name}</Name><ID>{i + 1}</ID></ComputerGroup>\n'
+            for i, name in enumerate(group_names)
+        )
+    )
+
+
+def site_content_xml(base_url, site_path, num_items):
+    """build a site content listing like `GET /api/site/.../content` returns"""
+    item_types = ("Fixlet", "Task", "Analysis", "Baseline")
+    items = []
+    for i in range(num_items):
+        item_type = item_types[i % len(item_types)]
+        items.append(
+            f'<{item_type} Resource="{base_url}/api/{item_type.lower()}/'
+            f'{site_path}/{i + 1}" LastModified="{LAST_MODIFIED}">'
+            f"<Name>{item_type} {i + 1}</Name><ID>{i + 1}</ID></{item_type}>\n"
+        )
+    return besapi_xml("".join(items))
+
+
+def content_item_xml(item_type, item_id, item_size):
+    """build a content item with a script of about item_size bytes
+
+    Item 0, which sites don't list, has an empty Title.
+    """
+    item_tag = item_type.capitalize()
+    title = b"" if item_id == "0" else b"%s %s" % (item_tag.encode(), item_id.encode())
+    line = b"echo content item script\n"
+    return (
+        b'<?xml version="1.0" encoding="UTF-8"?>\n'
+        b'<BES xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+        b'xsi:noNamespaceSchemaLocation="BES.xsd">'
+        b"<%s><Title>%s</Title><Description>Mock content</Description>"
+        b'<DefaultAction ID="Action1"><Script>' % (item_tag.encode(), title)
+        + line * (item_size // len(line))
+        + b"</Script></DefaultAction></%s></BES>\n" % item_tag.encode()
+    )
+
+
+def query_xml(relevance, num_computers):
+    """answer session relevance about computers
+
+    `number of bes computers` is a count, relevance containing `error`
+    is an error, after 3 answers if it also contains `partial`, anything
+    else is an (id, name, last report time) tuple for each computer,
+    filtered by `id of it mod N = K` if present.
+    """
+    if "error" in relevance:
+        answers = b"".join(
+            b"<Answer>%d</Answer>" % answer
+            for answer in range(3 if "partial" in relevance else 0)
+        )
+        return (
+            b"<BESAPI><Query><Result>" + answers + b"</Result>"
+            b'<Error>The operator "error" is not defined.</Error></Query></BESAPI>'
+        )
+    if relevance.strip().startswith("number of bes computers"):
+        return (
+            b'<BESAPI><Query><Result><Answer type="integer">%d</Answer>'
+            b"</Result></Query></BESAPI>" % num_computers
+        )
+
+    computer_ids = range(num_computers)
+    match = re.search(r"id of it mod (\d+) = (\d+)", relevance)
+    if match:
+        partitions, partition = int(match.group(1)), int(match.group(2))
+        computer_ids = range(partition, num_computers, partitions)
+    answers = b"".join(
+        b'<Tuple><Answer type="integer">%d</Answer>'
+        b'<Answer type="string">computer%d</Answer>'
+        b'<Answer type="time">%s</Answer></Tuple>'
+        % (computer_id, computer_id, LAST_MODIFIED.encode())
+        for computer_id in computer_ids
+    )
+    return b"<BESAPI><Query><Result>" + answers + b"</Result></Query></BESAPI>"
+
+
+def make_server(settings, port=0):
+    """make a mock server on localhost with settings for MockBigFixHandler"""
+    handler = type("MockBigFixHandler", (MockBigFixHandler,), dict(settings))
+    handler.uploads = set()
+    handler.groups = {}
+    handler.operators = {"user"}
+    return ThreadingHTTPServer(("127.0.0.1", port), handler)
+
+
+def serve_mock_server(port_queue, settings):
+    """run a mock server, sending its port to the queue"""
+    server = make_server(settings)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_mock_server(thread=False, **settings):
+    """start a mock server, returns it and the root server url to connect to
+
+    settings override MockBigFixHandler class attributes, e.g. latency.
+    The server runs in its own process so it doesn't compete with the
+    client for the GIL, returning the process, or in a thread if thread,
+    returning the server. Stop either with `stop_mock_server`.
+    """
+    if thread:
+        server = make_server(settings)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+    port_queue = multiprocessing.Queue()
+    server_process = multiprocessing.Process(
+        target=serve_mock_server, args=(port_queue, settings), daemon=True
+    )
+    server_process.start()
+    return server_process, f"http://127.0.0.1:{port_queue.get()}"
+
+
+def stop_mock_server(server):
+    """stop a server started with `start_mock_server`"""
+    if isinstance(server, multiprocessing.Process):
+        server.terminate()
+        server.join()
+    else:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    mock_server = make_server({}, int(sys.argv[1]) if len(sys.argv) > 1 else 52311)
+    print("Mock BigFix REST API on http://127.0.0.1:%d" % mock_server.server_address[1])
+    mock_server.serve_forever()
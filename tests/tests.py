@@ -4,9 +4,17 @@ Test besapi
 """
 
 import argparse
+import asyncio
+import concurrent.futures
+import datetime
+import hashlib
+import io
+import json
 import os
 import subprocess
 import sys
+import tempfile
+import types
 
 # check for --test_pip arg
 parser = argparse.ArgumentParser()
@@ -24,11 +32,31 @@ if not args.test_pip:
     sys.path.reverse()
 
 import besapi
+from lxml import etree
 
 print("besapi version: " + str(besapi.__version__))
 
 assert 15 == len(besapi.besapi.rand_password(15))
 
+# importing besapi should not import what it only needs later, or configure logging:
+import_check = subprocess.run(
+    [
+        sys.executable,
+        "-c",
+        "import logging, sys; sys.path.insert(0, sys.argv[1]); import besapi; "
+        "print(sorted({'asyncio', 'lxml.objectify', 'pkg_resources', 'sqlite3'} "
+        "& set(sys.modules)), logging.getLogger().handlers)",
+        os.path.dirname(os.path.dirname(os.path.abspath(besapi.__file__))),
+    ],
+    check=True,
+    stdout=subprocess.PIPE,
+    universal_newlines=True,
+)
+assert "[] []" == import_check.stdout.strip(), import_check.stdout
+assert os.path.isfile(
+    os.path.join(besapi.besapi.SCHEMAS_DIR, besapi.besapi.XSD_SCHEMA_NAMES[0])
+)
+
 assert ("test--string", "test") == besapi.besapi.sanitize_txt(r"test/\string", "test%")
 
 assert "http://localhost:52311/file.example" == besapi.besapi.replace_text_between(
@@ -89,8 +117,927 @@ assert b"<BES>Example</BES>" in rest_result.xmlparse_text("<BES>Example</BES>")
 
 assert rest_result.text == "this is just a test"
 
+# compiled XSDs should be built once and shared
+assert besapi.besapi.get_xsd_schemas() is besapi.besapi.get_xsd_schemas()
+assert len(besapi.besapi.get_xsd_schemas()) == len(besapi.besapi.XSD_SCHEMA_NAMES)
+
+
+class RequestResultXML(object):
+    text = '<BESAPI xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:noNamespaceSchemaLocation="BESAPI.xsd"><CustomSite Resource="https://localhost:52311/api/site/custom/Example"><Name>Example</Name></CustomSite></BESAPI>'
+    headers = {}
+
+
+rest_result_xml = besapi.besapi.RESTResult(RequestResultXML())
+assert rest_result_xml.valid
+assert "Example" == str(rest_result_xml.besobj.CustomSite.Name)
+assert b"<Name>Example</Name>" in rest_result_xml.besxml
+# response should only be parsed once for all representations
+assert rest_result_xml.besobj is rest_result_xml.xmlroot
+assert "Example" == rest_result_xml.besdict["CustomSite"]["Name"]
+# attributes are kept:
+assert (
+    "https://localhost:52311/api/site/custom/Example"
+    == rest_result_xml.besdict["CustomSite"]["@Resource"]
+)
+assert json.loads(rest_result_xml.besjson) == rest_result_xml.besdict
+assert rest_result_xml.besjson == rest_result_xml.write_json(io.StringIO()).getvalue()
+
+# repeated text elements become a list, and json is streamed from the tree:
+repeated_xml = etree.fromstring(
+    b'<BESAPI><Answer>a</Answer><Answer>b</Answer><Item ID="1">x</Item>'
+    b"<Deep><Deeper><Deepest/></Deeper></Deep></BESAPI>"
+)
+assert {
+    "Answer": ["a", "b"],
+    "Item": {"@ID": "1", "#text": "x"},
+    "Deep": {"Deeper": {"Deepest": {}}},
+} == besapi.besapi.elem2dict(repeated_xml)
+# deeper than the recursion limit:
+deep_xml = deep_elem = etree.Element("BESAPI")
+for _ in range(5000):
+    deep_elem = etree.SubElement(deep_elem, "a")
+deep_elem.text = "x"
+deep_dict = besapi.besapi.elem2dict(deep_xml)
+for _ in range(5000):
+    deep_dict = deep_dict["a"]
+assert "x" == deep_dict
+assert len("".join(besapi.besapi.iter_json(deep_xml))) > 5000 * 6
+for json_indent in (None, 2):
+    assert json.dumps(
+        besapi.besapi.elem2dict(repeated_xml), indent=json_indent
+    ) == "".join(besapi.besapi.iter_json(repeated_xml, json_indent))
+
+# validation policies:
+rest_result_lazy = besapi.besapi.RESTResult(RequestResultXML(), "lazy")
+# nothing should be parsed until the xml is used
+assert rest_result_lazy._xmlroot is None
+assert rest_result_lazy.valid
+assert besapi.besapi.RESTResult(RequestResultXML(), "never").valid
+assert not besapi.besapi.RESTResult(request_result, "never").valid
+assert not besapi.besapi.RESTResult(request_result, "always").valid
+try:
+    besapi.besapi.RESTResult(request_result, "sample")
+    raise AssertionError("sample policy should only be accepted by BESConnection")
+except ValueError:
+    pass
+
+# session relevance results are parsed incrementally:
+assert ["a", "b"] == list(
+    besapi.besapi.iter_relevance_answers(
+        io.BytesIO(
+            b"<BESAPI><Query><Result><Answer>a</Answer><Answer>b</Answer></Result></Query></BESAPI>"
+        )
+    )
+)
+assert [("1", "a"), ("2", ("b", "c"))] == list(
+    besapi.besapi.iter_relevance_answers(
+        io.BytesIO(
+            b"<BESAPI><Query><Result><Tuple><Answer>1</Answer><Answer>a</Answer></Tuple>"
+            b"<Tuple><Answer>2</Answer><Tuple><Answer>b</Answer><Answer>c</Answer></Tuple></Tuple>"
+            b"</Result></Query></BESAPI>"
+        )
+    )
+)
+assert ["ERROR: bad relevance"] == list(
+    besapi.besapi.iter_relevance_answers(
+        io.BytesIO(
+            b"<BESAPI><Query><Result></Result><Error>bad relevance</Error></Query></BESAPI>"
+        )
+    )
+)
+
+# answers before an error come first, whatever the chunk size:
+for chunk_size in (1, 5, 40, 70, 64 * 1024):
+    assert ["a", "b", "ERROR: oops"] == list(
+        besapi.besapi.iter_relevance_answers(
+            io.BytesIO(
+                b"<BESAPI><Query><Result><Answer>a</Answer><Answer>b</Answer></Result>"
+                b"<Error>oops</Error></Query></BESAPI>"
+            ),
+            chunk_size=chunk_size,
+        )
+    )
+
+# typed answers are converted by their type:
+typed_answers = list(
+    besapi.besapi.iter_relevance_answers(
+        io.BytesIO(
+            b'<BESAPI><Query><Result><Tuple><Answer type="integer">1</Answer>'
+            b'<Answer type="boolean">True</Answer><Answer type="string">a</Answer>'
+            b'<Answer type="time">Tue, 01 Mar 2022 12:00:00 +0000</Answer></Tuple>'
+            b'<Tuple><Answer type="integer">2</Answer><Answer type="boolean">False</Answer>'
+            b'<Answer type="string">b</Answer><Answer type="time">bad time</Answer></Tuple>'
+            b"</Result></Query></BESAPI>"
+        ),
+        typed=True,
+    )
+)
+assert (1, True, "a") == typed_answers[0][:3]
+assert 2022 == typed_answers[0][3].year
+# values that don't convert are kept as text:
+assert (2, False, "b", "bad time") == typed_answers[1]
+try:
+    list(
+        besapi.besapi.iter_relevance_answers(
+            io.BytesIO(b"<BESAPI><Query><Error>bad relevance</Error></Query></BESAPI>"),
+            typed=True,
+        )
+    )
+    raise AssertionError("typed answers should raise on a query error")
+except ValueError:
+    pass
+
+relevance_columns = besapi.besapi.RelevanceColumns(typed_answers)
+assert 2 == len(relevance_columns)
+assert "q" == relevance_columns[0].typecode
+assert [True, False] == relevance_columns[1]
+# a column falls back to a list when a value doesn't fit its array:
+relevance_columns.append((2**64, True, "c", "bad time"))
+assert isinstance(relevance_columns[0], list)
+assert (2**64, True, "c", "bad time") == list(relevance_columns)[2]
+
+# TTL/LRU cache:
+ttl_cache = besapi.besapi.TTLCache(maxsize=2, ttl=60)
+ttl_cache.set("a", 1)
+ttl_cache.set("b", 2)
+assert 1 == ttl_cache.get("a")
+ttl_cache.set("c", 3)
+# least recently used key is evicted:
+assert ttl_cache.get("b") is None
+assert 3 == ttl_cache.get("c")
+ttl_cache.set("d", 4, ttl=0)
+assert ttl_cache.get("d") is None
+ttl_cache.invalidate("a")
+assert "a" not in ttl_cache
+assert {"hits": 2, "misses": 2} == {
+    key: ttl_cache.stats()[key] for key in ("hits", "misses")
+}
+
+assert ("Task", "Example Task") == besapi.besapi.bes_type_and_title(
+    io.BytesIO(
+        b'<?xml version="1.0" encoding="UTF-8"?><BES><Task><Title>Example Task</Title>'
+        b"<Description>Title</Description></Task></BES>"
+    )
+)
+
+
+# a mock BigFix REST API server, for connections to login to:
+import mock_server
+
+mock, mock_rootserver = mock_server.start_mock_server(thread=True, num_computers=100)
+
+
+class ExportConnection(besapi.besapi.BESConnection):
+    """connection to the mock server that records exports instead of making them"""
+
+    def __init__(self):
+        super().__init__("test", "pass", mock_rootserver)
+        self.exported = []
+
+    def export_item_to_file(self, resource_url, item_path):
+        if "bad" in resource_url:
+            raise ValueError("bad item")
+        self.exported.append((resource_url, item_path))
+        with open(item_path, "w") as bes_file:
+            bes_file.write(resource_url)
+        return item_path
+
+
+with tempfile.TemporaryDirectory() as export_folder:
+    export_conn = ExportConnection()
+    export_errors = export_conn.export_items_to_files(
+        [
+            {"resource": "a1", "path": export_folder + "/Fixlet/a.bes"},
+            {"resource": "bad", "path": export_folder + "/Fixlet/b.bes"},
+            {"resource": "a2", "path": export_folder + "/Fixlet/a.bes"},
+            {"resource": "c", "path": export_folder + "/Task/c.bes"},
+        ],
+        max_workers=4,
+    )
+    # errors are collected, not raised:
+    assert [resource for resource, _ in export_errors] == ["bad"]
+    # same path, the last item in the listing wins:
+    assert sorted(export_conn.exported) == [
+        ("a2", export_folder + "/Fixlet/a.bes"),
+        ("c", export_folder + "/Task/c.bes"),
+    ]
+    assert os.path.isdir(export_folder + "/Task")
+
+# incremental export only fetches new or changed items:
+with tempfile.TemporaryDirectory() as export_folder:
+    export_items = [
+        {
+            "site_path": "custom/Example",
+            "id": item_id,
+            "resource": f"site/custom/Example/{item_id}",
+            "last_modified": "Tue, 01 Mar 2022 12:00:00 +0000",
+            "path": f"{export_folder}/Fixlet/{item_id}.bes",
+        }
+        for item_id in (1, 2, 3)
+    ]
+    export_conn = ExportConnection()
+    export_conn.export_items_incremental(export_items, export_folder)
+    assert len(export_conn.exported) == 3
+
+    export_items[1]["last_modified"] = "Wed, 02 Mar 2022 12:00:00 +0000"
+    del export_items[2]
+    export_conn = ExportConnection()
+    export_conn.export_items_incremental(
+        export_items, export_folder, remove_deleted=True
+    )
+    assert [resource for resource, _ in export_conn.exported] == [
+        "site/custom/Example/2"
+    ]
+    assert not os.path.exists(f"{export_folder}/Fixlet/3.bes")
+    assert sorted(besapi.besapi.read_export_manifest(export_folder)) == [
+        "site/custom/Example/1",
+        "site/custom/Example/2",
+    ]
+
+
+class QueryResult(object):
+    headers = {"content-type": "application/xml"}
+    status_code = 200
+    url = "https://localhost:52311/api/query"
+
+    def __init__(self, relevance):
+        if relevance == "bad":
+            self.text = "<BESAPI><Query><Result></Result><Error>bad relevance</Error></Query></BESAPI>"
+        else:
+            self.text = f"<BESAPI><Query><Result><Answer>{relevance}</Answer></Result></Query></BESAPI>"
+
+
+class QueryConnection(ExportConnection):
+    """connection that answers relevance with the relevance text"""
+
+    def session_relevance_xml(self, relevance, cache_ttl=None, **kwargs):
+        if relevance == "raise":
+            raise ConnectionError("no server")
+        return besapi.besapi.RESTResult(QueryResult(relevance))
+
+
+many_results = QueryConnection().session_relevance_many(
+    ["a", "bad", "raise", "b"], max_workers=4
+)
+assert 2 == many_results["num_errors"]
+assert [["a"], None, None, ["b"]] == [
+    result["answers"] for result in many_results["results"]
+]
+assert "bad relevance" == many_results["results"][1]["error"]
+assert "ConnectionError" in many_results["results"][2]["error"]
+
+# queries over every computer are split into partitions:
+assert (
+    "names of bes computers whose (id of it mod 4 = 1)"
+    == besapi.besapi.partition_relevance("names of bes computers", 4, 1)
+)
+assert (
+    "ids of bes computers whose ((id of it mod 4 = 3) and locked of it)"
+    == besapi.besapi.partition_relevance(
+        "ids of bes computers whose ({partition} and locked of it)", 4, 3
+    )
+)
+try:
+    besapi.besapi.partition_relevance("number of bes computers", 4, 0)
+    raise AssertionError("only relevance that can be partitioned is accepted")
+except ValueError:
+    pass
+
+
+class PartitionConnection(QueryConnection):
+    """connection that answers with the partition number"""
+
+    def session_relevance_iter(self, relevance, typed=False, **kwargs):
+        partition = int(relevance.split("= ")[1].rstrip(")"))
+        if partition == 2:
+            yield "<Nothing> Nothing returned, but no error."
+        else:
+            yield from (partition, partition * 10)
+
+
+partition_progress = []
+assert [0, 0, 1, 3, 10, 30] == sorted(
+    PartitionConnection().session_relevance_partitioned(
+        "ids of bes computers", 4, max_workers=2, progress=partition_progress.append
+    )
+)
+assert [1, 2, 3, 4] == [progress["completed"] for progress in partition_progress]
+assert 0 == sum(
+    progress["answers"] for progress in partition_progress if progress["partition"] == 2
+)
+
+
+class ErrorPartitionConnection(PartitionConnection):
+    """connection whose partitions have an error between answers"""
+
+    def session_relevance_iter(self, relevance, typed=False, **kwargs):
+        yield from ("a", "ERROR: oops", "b")
+
+
+try:
+    list(
+        ErrorPartitionConnection().session_relevance_partitioned(
+            "ids of bes computers", 2
+        )
+    )
+    raise AssertionError("an error in any partition should be raised")
+except ValueError as err:
+    assert "oops" in str(err)
+
+
+async def async_queries():
+    async with besapi.besapi.AsyncBESConnection.from_connection(
+        QueryConnection(), max_connections=2
+    ) as async_conn:
+        single_result = await async_conn.session_relevance_xml("a")
+        many_results = await async_conn.session_relevance_many(["a", "bad", "b"])
+    return single_result, many_results
+
+
+event_loop = asyncio.new_event_loop()
+async_result, async_many_results = event_loop.run_until_complete(async_queries())
+event_loop.close()
+assert "a" == str(async_result.besobj.Query.Result.Answer)
+assert 1 == async_many_results["num_errors"]
+assert ["b"] == async_many_results["results"][2]["answers"]
+
+# wrapping a connection doesn't change its transport or log it out:
+wrapped_conn = QueryConnection()
+wrapped_conn.configure_transport(pool_maxsize=3)
+wrapped_async_conn = besapi.besapi.AsyncBESConnection.from_connection(
+    wrapped_conn, max_connections=5
+)
+for conn, pool_maxsize in ((wrapped_conn, 3), (wrapped_async_conn.connection, 5)):
+    assert pool_maxsize == conn.session.get_adapter(conn.url(""))._pool_maxsize
+event_loop = asyncio.new_event_loop()
+event_loop.run_until_complete(wrapped_async_conn.close())
+event_loop.close()
+assert wrapped_conn.last_connected is not None
+
+# transport settings are applied with a mounted adapter:
+transport_conn = ExportConnection()
+transport_conn.configure_transport(
+    pool_maxsize=20, upload_blocksize=1024 * 1024, timeout=30, compression=False
+)
+transport_adapter = transport_conn.session.get_adapter(transport_conn.url(""))
+assert isinstance(transport_adapter, besapi.besapi.HTTPAdapterBiggerBlocksize)
+assert 20 == transport_adapter._pool_maxsize
+assert 30 == transport_adapter.timeout
+assert "identity" == transport_conn.session.headers["Accept-Encoding"]
+
+
+class UploadConnection(ExportConnection):
+    """connection that records uploads instead of sending them"""
+
+    def post(self, path, data, **kwargs):
+        file_sha1, file_sha256, file_size = besapi.besapi.hash_file(data.name)
+        self.exported.append(path)
+        upload_result = QueryResult("")
+        upload_result.text = (
+            f"<BESAPI><FileUpload><Name>test.txt</Name><Size>{file_size}</Size>"
+            f"<URL>http://example:{self.rootserver_port}/Uploads/{file_sha1}/test.txt.bfswd</URL>"
+            f"<SHA1>{file_sha1}</SHA1><SHA256>{file_sha256}</SHA256></FileUpload></BESAPI>"
+        )
+        return besapi.besapi.RESTResult(upload_result)
+
+
+with tempfile.TemporaryDirectory() as upload_folder:
+    upload_file_path = os.path.join(upload_folder, "test.txt")
+    with open(upload_file_path, "wb") as upload_file:
+        upload_file.write(b"test upload")
+    assert (
+        hashlib.sha1(b"test upload").hexdigest(),
+        hashlib.sha256(b"test upload").hexdigest(),
+        11,
+    ) == besapi.besapi.hash_file(upload_file_path)
+
+    upload_index = besapi.besapi.UploadIndex(os.path.join(upload_folder, "index.json"))
+    upload_conn = UploadConnection()
+    first_upload = upload_conn.upload(
+        upload_file_path, dedupe=True, upload_index=upload_index, verify_on_server=False
+    )
+    second_upload = upload_conn.upload(
+        upload_file_path, dedupe=True, upload_index=upload_index, verify_on_server=False
+    )
+    # the second upload should not send the file again:
+    assert 1 == len(upload_conn.exported)
+    assert second_upload.from_cache
+    assert upload_conn.parse_upload_result_to_prefetch(
+        first_upload
+    ) == upload_conn.parse_upload_result_to_prefetch(second_upload)
+
+    async def async_upload():
+        async with besapi.besapi.AsyncBESConnection.from_connection(
+            upload_conn, max_connections=2
+        ) as async_conn:
+            return await async_conn.upload(
+                upload_file_path,
+                dedupe=True,
+                upload_index=upload_index,
+                verify_on_server=False,
+            )
+
+    # dedupe options are passed on by the async connection too:
+    event_loop = asyncio.new_event_loop()
+    assert event_loop.run_until_complete(async_upload()).from_cache
+    event_loop.close()
+    assert 1 == len(upload_conn.exported)
+
+
+class ExpiringSession(besapi.besapi.requests.Session):
+    """session whose responses have the queued status codes"""
+
+    def __init__(self, status_codes):
+        super().__init__()
+        self.status_codes = list(status_codes)
+        self.sent = []
+
+    def request(self, method, url, *args, **kwargs):
+        data = kwargs.get("data")
+        self.sent.append((method, url, data.read() if hasattr(data, "read") else data))
+        response = besapi.besapi.requests.models.Response()
+        response.status_code = self.status_codes.pop(0)
+        response.url = url
+        response.headers["content-type"] = "application/xml"
+        response.raw = io.BytesIO(b"<BESAPI/>")
+        return response
+
+
+# a 401 logs in again and retries once, rewinding file data:
+login_conn = ExportConnection()
+login_conn.session = ExpiringSession([401, 200, 200])
+with tempfile.TemporaryFile() as post_file:
+    post_file.write(b"file data")
+    post_file.seek(0)
+    assert 200 == login_conn.post("sites", post_file).request.status_code
+assert ["post", "get", "post"] == [sent[0] for sent in login_conn.session.sent]
+assert login_conn.session.sent[1][1].endswith("/api/login")
+assert b"file data" == login_conn.session.sent[2][2]
+assert 1 == login_conn.login_retries
+assert not login_conn.needs_login()
+
+# checking the connection does not contact the server:
+assert login_conn
+assert login_conn.login()
+assert 3 == len(login_conn.session.sent)
+
+# rejected credentials return the 401 instead of retrying:
+login_conn.session.status_codes = [401, 401]
+assert 401 == login_conn.get("sites").request.status_code
+assert 1 == login_conn.login_retries
+assert login_conn.needs_login()
+
+# requests are measured per endpoint, and hooks see every request:
+hooked_requests = []
+login_conn.add_hook(
+    "pre_request", lambda method, url, kwargs: hooked_requests.append(url)
+)
+login_conn.add_hook(
+    "post_request",
+    lambda response, elapsed: hooked_requests.append(response.status_code),
+)
+login_conn.session.status_codes = [200]
+login_conn.get("computer/123").besobj
+assert [login_conn.url("computer/123"), 200] == hooked_requests
+login_stats = login_conn.stats()
+assert 1 == login_stats["login_retries"]
+assert {"GET computer", "GET login", "GET sites", "POST sites"} == set(
+    login_stats["endpoints"]
+)
+assert {401: 1, 200: 1} == login_stats["endpoints"]["POST sites"]["status_codes"]
+assert 1 == login_stats["endpoints"]["POST sites"]["retries"]
+assert 9 == login_stats["endpoints"]["GET computer"]["bytes"]
+assert 1 == sum(login_stats["endpoints"]["GET computer"]["latency_ms"].values())
+assert 1 == login_stats["timings"]["parse"]["count"]
+
+# bad settings raise ValueError, and cleaning up after it doesn't fail:
+real_stderr = sys.stderr
+sys.stderr = io.StringIO()
+try:
+    for bad_settings in ({"validation": "bad"}, {"validation_sample_rate": 0}):
+        try:
+            besapi.besapi.BESConnection(
+                "user",
+                "pass",
+                mock_rootserver,
+                **dict({"validation": "sample"}, **bad_settings),
+            )
+            raise AssertionError(f"{bad_settings} should not be accepted")
+        except ValueError:
+            pass
+    ignored_errors = sys.stderr.getvalue()
+finally:
+    sys.stderr = real_stderr
+assert "" == ignored_errors, ignored_errors
+
+# end to end against the mock server:
+mock_conn = besapi.besapi.BESConnection("user", "pass", mock_rootserver)
+assert mock_conn
+assert 100 == mock_conn.session_relevance_typed("number of bes computers")[0][0]
+mock_columns = mock_conn.session_relevance_typed(
+    "(id of it, name of it, last report time of it) of bes computers", columnar=True
+)
+assert 100 == len(mock_columns)
+assert "computer7" == mock_columns[1][7]
+assert list(range(100)) == sorted(
+    answer[0]
+    for answer in mock_conn.session_relevance_partitioned(
+        "(id of it, name of it) of bes computers", 4, typed=True
+    )
+)
+with tempfile.TemporaryDirectory() as mock_folder:
+    assert [] == mock_conn.export_site_contents(
+        "custom/Site0", mock_folder + "/", max_workers=4
+    )
+    assert 20 == sum(
+        len(files) for _, _, files in os.walk(os.path.join(mock_folder, "custom-Site0"))
+    )
+    if os.name == "posix":
+        # exported files get the usual permissions, not only the owner's:
+        umask = os.umask(0)
+        os.umask(umask)
+        for export_folder, _, files in os.walk(mock_folder):
+            for file_name in files:
+                export_mode = os.stat(os.path.join(export_folder, file_name)).st_mode
+                assert 0o666 & ~umask == export_mode & 0o777
+    # an item without a Title can't be named, and leaves no partial file:
+    untitled_folder = os.path.join(mock_folder, "untitled")
+    try:
+        mock_conn.export_item_by_resource("fixlet/custom/Site0/0", untitled_folder)
+        raise AssertionError("an item without a Title should fail to export")
+    except ValueError as err:
+        assert "no Title" in str(err)
+    assert [] == os.listdir(untitled_folder)
+    mock_upload_path = os.path.join(mock_folder, "upload.txt")
+    with open(mock_upload_path, "wb") as mock_upload:
+        mock_upload.write(b"mock upload")
+    mock_index = besapi.besapi.UploadIndex(os.path.join(mock_folder, "index.json"))
+    mock_conn.upload(mock_upload_path, dedupe=True, upload_index=mock_index)
+    assert mock_conn.upload(
+        mock_upload_path, dedupe=True, upload_index=mock_index
+    ).from_cache
+assert 1 == mock_conn.stats()["endpoints"]["POST upload"]["count"]
+
 import bescli
 
+# batch jobs run concurrently, in the order their `after` ids allow:
+with tempfile.TemporaryDirectory() as batch_folder:
+    batch_json_path = os.path.join(batch_folder, "jobs.json")
+    with open(batch_json_path, "w", encoding="utf-8") as batch_file:
+        json.dump(
+            {
+                "jobs": [
+                    "query number of bes computers",
+                    {"id": "sites", "command": "get", "args": "sites"},
+                    {"id": "bad", "command": "query", "args": "error"},
+                    {"command": "get", "args": "site/custom/Site0/content"},
+                    {"id": "skipped", "command": "get", "args": "sites"},
+                ]
+            },
+            batch_file,
+        )
+    batch_jobs = bescli.bescli.load_batch_jobs(batch_json_path)
+    batch_jobs[3]["after"] = ["sites"]
+    batch_jobs[4]["after"] = ["bad"]
+    batch_results = {
+        job_result["id"]: job_result
+        for job_result in bescli.bescli.run_batch(mock_conn, batch_jobs, 4)
+    }
+    assert ["100"] == batch_results[1]["result"]
+    assert "Site0" == batch_results["sites"]["result"]["CustomSite"][0]["Name"]
+    # 20 items, a quarter of them fixlets:
+    assert 5 == len(batch_results[4]["result"]["Fixlet"])
+    assert (
+        not batch_results["bad"]["ok"]
+        and "not defined" in batch_results["bad"]["error"]
+    )
+    assert (
+        not batch_results["skipped"]["ok"] and "result" not in batch_results["skipped"]
+    )
+
+    batch_script_path = os.path.join(batch_folder, "jobs.txt")
+    with open(batch_script_path, "w", encoding="utf-8") as batch_file:
+        batch_file.write("# comment\nget sites\nquery error\nwait\n\nget sites\n")
+    assert [[], [], [1, 2]] == [
+        job["after"] for job in bescli.bescli.load_batch_jobs(batch_script_path)
+    ]
+    batch_cli = bescli.bescli.BESCLInterface()
+    batch_cli.bes_conn = mock_conn
+    batch_cli.do_batch(batch_script_path + " 2")
+    # the failed query, and the job after it
+    assert 2 == batch_cli.num_errors
+
+    try:
+        with open(batch_json_path, "w", encoding="utf-8") as batch_file:
+            json.dump([{"command": "delete", "args": "sites"}], batch_file)
+        bescli.bescli.load_batch_jobs(batch_json_path)
+        raise AssertionError("unknown batch commands should fail")
+    except ValueError:
+        pass
+
+    # jobs after each other in a cycle would never start:
+    for cycle_jobs in (
+        [{"id": "a", "command": "get", "args": "sites", "after": ["a"]}],
+        [
+            {"id": "a", "command": "get", "args": "sites", "after": ["b"]},
+            {"id": "b", "command": "get", "args": "sites", "after": ["a"]},
+        ],
+    ):
+        with open(batch_json_path, "w", encoding="utf-8") as batch_file:
+            json.dump(cycle_jobs, batch_file)
+        try:
+            bescli.bescli.load_batch_jobs(batch_json_path)
+            raise AssertionError("batch jobs in a cycle should fail")
+        except ValueError as err:
+            assert "cycle" in str(err)
+    stuck_results = list(
+        bescli.bescli.run_batch(
+            mock_conn,
+            [
+                {"id": 1, "command": "get", "args": "sites", "after": []},
+                {"id": 2, "command": "get", "args": "sites", "after": [2]},
+            ],
+        )
+    )
+    assert [True, False] == [job_result["ok"] for job_result in stuck_results]
+
+    # without a terminal, batch mode fails instead of prompting for login:
+    no_login_cli = bescli.bescli.BESCLInterface()
+    no_login_cli.bes_conn = None
+    no_login_cli.BES_PASSWORD = None
+    no_login_cli.interactive = False
+    no_login_cli.do_batch(batch_script_path)
+    assert 1 == no_login_cli.num_errors
+
+    # query results are streamed to a file, a row for each answer:
+    query_out_path = os.path.join(batch_folder, "computers.tsv")
+    batch_cli.onecmd(
+        f"query --out {query_out_path} (id of it, name of it, last report time of it)"
+        " of bes computers"
+    )
+    with open(query_out_path, "r", encoding="utf-8") as query_out:
+        query_rows = query_out.read().splitlines()
+    assert 100 == len(query_rows)
+    assert "7\tcomputer7\tTue, 01 Mar 2022 12:00:00 +0000" == query_rows[7]
+    # no results are no rows:
+    batch_cli.onecmd(
+        f"query --out {query_out_path} (id of it) of bes computers "
+        "whose (id of it mod 200 = 150)"
+    )
+    with open(query_out_path, "r", encoding="utf-8") as query_out:
+        assert "" == query_out.read()
+    batch_cli.onecmd(f"query --format bad --out {query_out_path} names of bes sites")
+    batch_cli.onecmd(f"query --out {query_out_path} error")
+    assert 4 == batch_cli.num_errors
+    # an error after some answers is reported, not written as a row:
+    batch_cli.onecmd(f"query --out {query_out_path} partial error")
+    with open(query_out_path, "r", encoding="utf-8") as query_out:
+        assert ["0", "1", "2"] == query_out.read().splitlines()
+    assert 5 == batch_cli.num_errors
+
+query_rows = io.StringIO()
+assert 2 == bescli.bescli.write_query_rows(
+    ["a", ("b", ("c", 'd"'))], query_rows, "jsonl"
+)
+assert '["a"]\n["b", "c", "d\\""]\n' == query_rows.getvalue()
+query_rows = io.StringIO()
+bescli.bescli.write_query_rows([("b", 'd",')], query_rows, "csv")
+assert 'b,"d"","\r\n' == query_rows.getvalue()
+assert ({"format": "csv", "out": "x.csv"}, "names of bes sites") == (
+    bescli.bescli.split_query_options("--format csv --out x.csv names of bes sites")
+)
+assert ({}, "--names") == bescli.bescli.split_query_options("--names")
+
+# site content is indexed locally, so lookups don't need the server:
+with tempfile.TemporaryDirectory() as index_folder:
+    content_index = mock_conn.enable_content_index(
+        os.path.join(index_folder, "index.sqlite")
+    )
+    index_summary = mock_conn.refresh_content_index(max_workers=4)
+    assert (5, 100, []) == (
+        index_summary["sites"],
+        index_summary["added"],
+        index_summary["errors"],
+    )
+    # sites refreshed recently are skipped, the others only write changes:
+    assert 5 == mock_conn.refresh_content_index(max_age=60)["skipped"]
+    assert 20 == mock_conn.refresh_content_index(["custom/Site1"])["unchanged"]
+    mock_requests = mock_conn.stats()["endpoints"]["GET site"]["count"]
+    found_items = mock_conn.find_content("fixlet 1*", "custom/Site0")
+    assert ["Fixlet 1", "Fixlet 13", "Fixlet 17"] == [
+        item["name"] for item in found_items
+    ]
+    assert "custom/Site0" == found_items[0]["site_path"] and 1 == found_items[0]["id"]
+    assert [] == mock_conn.find_content("fixlet_1")
+    assert 5 == len(mock_conn.find_content("task 2", item_type="task"))
+    assert "Task 2" == mock_conn.get_indexed_content("custom/Site3", 2)[0]["name"]
+    assert 100 == len(mock_conn.content_changed_since(datetime.datetime(2022, 3, 1)))
+    assert [] == mock_conn.content_changed_since(datetime.datetime(2022, 3, 2))
+    # lookups don't make requests:
+    assert mock_requests == mock_conn.stats()["endpoints"]["GET site"]["count"]
+    assert {"added": 0, "changed": 1, "removed": 19, "unchanged": 0} == (
+        content_index.update_site(
+            mock_conn.rootserver,
+            "custom/Site4",
+            [
+                dict(
+                    mock_conn.get_indexed_content("custom/Site4", 1)[0],
+                    last_modified=None,
+                )
+            ],
+        )
+    )
+    assert 81 == len(content_index)
+
+    batch_cli.BES_CONTENT_INDEX = os.path.join(index_folder, "cli_index.sqlite")
+    mock_conn.content_index = None
+    batch_cli.do_index("stats")
+    batch_cli.do_index("refresh custom/Site2")
+    batch_cli.do_index("stats")
+    batch_cli.do_search("task 1")
+    batch_cli.do_changed("2022-03-01")
+    batch_cli.do_changed("not a date")
+    assert 20 == len(mock_conn.content_index)
+    mock_conn.content_index.close()
+    content_index.close()
+
+# lookups by name are cached, and forgotten when something is changed:
+mock_conn.enable_resolver_cache()
+mock_conn.metrics.reset()
+for _ in range(100):
+    assert "Group3" == str(mock_conn.get_computergroup("Group3", "custom/Site0").Name)
+    assert mock_conn.get_computergroup("Missing", "custom/Site0") is None
+    assert "custom/Site1" == mock_conn.validate_site_path("custom/Site1")
+    assert mock_conn.validate_site_path("custom/Missing") is None
+    assert mock_conn.get_user("user")
+    assert mock_conn.get_user("nobody") is None
+mock_stats = mock_conn.stats()
+assert 1 == mock_stats["endpoints"]["GET computergroups"]["count"]
+assert 2 == mock_stats["endpoints"]["GET site"]["count"]
+assert 2 == mock_stats["endpoints"]["GET operator"]["count"]
+assert (595, 5) == (
+    mock_stats["resolver_cache"]["hits"],
+    mock_stats["resolver_cache"]["misses"],
+)
+with tempfile.TemporaryDirectory() as group_folder:
+    group_file_path = os.path.join(group_folder, "group.bes")
+    with open(group_file_path, "w", encoding="utf-8") as group_file:
+        group_file.write(
+            "<BES><ComputerGroup><Title>New Group</Title></ComputerGroup></BES>"
+        )
+    new_group = mock_conn.create_group_from_file(group_file_path, "custom/Site0")
+    assert "New Group" == str(new_group.Name)
+    # exists now, so it is found in the listing made after it was created:
+    assert new_group is mock_conn.create_group_from_file(
+        group_file_path, "custom/Site0"
+    )
+assert 2 == mock_conn.stats()["endpoints"]["GET computergroups"]["count"]
+mock_conn.invalidate_resolver_cache("operators")
+assert mock_conn.get_user("user")
+assert 3 == mock_conn.stats()["endpoints"]["GET operator"]["count"]
+
+# a server error is not remembered as the site not existing:
+mock_conn.invalidate_resolver_cache()
+mock_conn.get = lambda path, **kwargs: types.SimpleNamespace(
+    request=types.SimpleNamespace(status_code=503)
+)
+assert mock_conn.validate_site_path("custom/Site1") is None
+del mock_conn.get
+assert "custom/Site1" == mock_conn.validate_site_path("custom/Site1")
+mock_conn.disable_resolver_cache()
+
+# a resolver cache shared between root servers keeps their lookups apart:
+one_site_mock, one_site_rootserver = mock_server.start_mock_server(
+    thread=True, num_sites=1
+)
+shared_resolver_cache = besapi.besapi.TTLCache(maxsize=8, ttl=60)
+for rootserver, site_exists in ((mock_rootserver, True), (one_site_rootserver, False)):
+    shared_conn = besapi.besapi.BESConnection("user", "pass", rootserver)
+    shared_conn.enable_resolver_cache(cache=shared_resolver_cache)
+    assert site_exists == bool(shared_conn.validate_site_path("custom/Site3"))
+    shared_conn.logout()
+mock_server.stop_mock_server(one_site_mock)
+
+# GET results with an ETag or Last-Modified are revalidated, not downloaded again:
+with tempfile.TemporaryDirectory() as http_cache_folder:
+    http_cache_path = os.path.join(http_cache_folder, "http_cache.sqlite")
+    mock_conn.enable_http_cache(cache_path=http_cache_path)
+    first_content = mock_conn.get("site/custom/Site0/content")
+    assert not first_content.from_cache
+    cached_content = mock_conn.get("site/custom/Site0/content")
+    assert cached_content.from_cache
+    assert first_content.besdict == cached_content.besdict
+    # changing a result doesn't change what later hits return:
+    cached_content.besobj.remove(cached_content.besobj.getchildren()[0])
+    cached_content.request.headers["ETag"] = "changed"
+    assert first_content.besdict == mock_conn.get("site/custom/Site0/content").besdict
+    assert 304 in mock_conn.stats()["endpoints"]["GET site"]["status_codes"]
+    # no validators, so not kept:
+    assert not mock_conn.get("sites").from_cache
+    assert not mock_conn.get("sites").from_cache
+    http_stats = mock_conn.stats()["http_cache"]
+    assert (2, 3, 1) == (http_stats["hits"], http_stats["misses"], http_stats["size"])
+    assert 2 * len(first_content.request.content) == http_stats["bytes_saved"]
+    # different params are a different url, so aren't revalidated as the same:
+    for fields in ("a", "b"):
+        assert not mock_conn.get(
+            "site/custom/Site0/content", params={"fields": fields}
+        ).from_cache
+    assert mock_conn.get("site/custom/Site0/content", params={"fields": "b"}).from_cache
+    mock_conn.http_cache.close()
+
+    # a later connection revalidates what was kept in the cache file:
+    cache_conn = besapi.besapi.BESConnection("user", "pass", mock_rootserver)
+    cache_conn.enable_http_cache(cache_path=http_cache_path)
+    reloaded_content = cache_conn.get("site/custom/Site0/content")
+    assert reloaded_content.from_cache
+    assert first_content.besdict == reloaded_content.besdict
+    assert cache_conn.get("site/custom/Site0/content").from_cache
+    assert 2 == cache_conn.http_cache.hits
+
+    # the least recently used are dropped to keep under max_bytes:
+    small_cache = cache_conn.enable_http_cache(
+        max_bytes=len(first_content.request.content) + 1
+    )
+    cache_conn.get("site/custom/Site0/content")
+    cache_conn.get("site/custom/Site1/content")
+    assert 1 == small_cache.evictions and 1 == len(small_cache)
+    assert not cache_conn.get("site/custom/Site0/content").from_cache
+    cache_conn.http_cache.close()
+    cache_conn.logout()
+mock_conn.disable_http_cache()
+mock_conn.logout()
+
+# a relevance cache shared between root servers keeps their answers apart:
+small_mock, small_mock_rootserver = mock_server.start_mock_server(
+    thread=True, num_computers=3
+)
+shared_relevance_cache = besapi.besapi.TTLCache(maxsize=8, ttl=60)
+for rootserver, num_computers in (
+    (mock_rootserver, "100"),
+    (small_mock_rootserver, "3"),
+):
+    shared_conn = besapi.besapi.BESConnection("user", "pass", rootserver)
+    shared_conn.enable_relevance_cache(cache=shared_relevance_cache)
+    assert num_computers == shared_conn.session_relevance_string(
+        "number of bes computers"
+    )
+    # changing a cached result doesn't change what later hits return:
+    cached_relevance = shared_conn.session_relevance_xml("number of bes computers")
+    assert cached_relevance.from_cache
+    cached_relevance.besobj.Query.remove(cached_relevance.besobj.Query.Result)
+    assert num_computers == shared_conn.session_relevance_string(
+        "number of bes computers"
+    )
+    shared_conn.logout()
+assert 2 == len(shared_relevance_cache)
+mock_server.stop_mock_server(small_mock)
+
+# when the session expires under many threads, only one of them logs in again:
+session_mock, session_rootserver = mock_server.start_mock_server(
+    thread=True, require_session=True, latency=0.01
+)
+session_conn = besapi.besapi.BESConnection("user", "pass", session_rootserver)
+assert 1 == session_conn.logins
+session_mock.RequestHandlerClass.session_token = "2"
+with concurrent.futures.ThreadPoolExecutor(max_workers=16) as session_executor:
+    assert [200] * 32 == list(
+        session_executor.map(
+            lambda _: session_conn.get("sites").request.status_code, range(32)
+        )
+    )
+assert 2 == session_conn.logins
+assert 2 == session_conn.stats()["endpoints"]["GET login"]["count"]
+session_conn.logout()
+mock_server.stop_mock_server(session_mock)
+
+# record responses to a cassette, then replay them without the server:
+with tempfile.TemporaryDirectory() as cassette_folder:
+    cassette_path = os.path.join(cassette_folder, "cassette.sqlite")
+    cassette_relevance = "(id of it, name of it) of bes computers"
+    recording_conn = besapi.besapi.BESConnection(
+        "user", "pass", mock_rootserver, cassette=cassette_path
+    )
+    recorded_answers = recording_conn.session_relevance_typed(cassette_relevance)
+    recorded_sites = recording_conn.get("sites").besdict
+    recording_conn.logout()
+    mock_server.stop_mock_server(mock)
+
+    replay_conn = besapi.besapi.BESConnection(
+        "user", "pass", "http://127.0.0.1:9", cassette=cassette_path, replay=True
+    )
+    assert recorded_answers == replay_conn.session_relevance_typed(cassette_relevance)
+    assert recorded_sites == replay_conn.get("sites").besdict
+    try:
+        replay_conn.get("computers")
+        raise AssertionError("requests that were not recorded should fail")
+    except besapi.besapi.requests.exceptions.ConnectionError:
+        pass
+    replay_conn.transport_options["cassette"].close()
+
+assert ("custom/Example", 8) == bescli.bescli.split_max_workers("custom/Example 8")
+assert ("custom/Example", 1) == bescli.bescli.split_max_workers("custom/Example")
+
 bigfix_cli = bescli.bescli.BESCLInterface()
 
 # just make sure these don't throw errors:
@@ -100,6 +1047,8 @@ bigfix_cli.do_ls()
 bigfix_cli.do_logout()
 bigfix_cli.do_error_count()
 bigfix_cli.do_version()
+bigfix_cli.do_stats()
+bigfix_cli.do_cassette("off")
 bigfix_cli.do_conf()
 
 # this should really only run if the config file is present: